@@ -0,0 +1,201 @@
+# admission.py - Per device rate limits and batch size limits of ingest
+#
+# A watch reconnecting with hours of readings sends them as fast as the network
+# allows, and every batch it gets in holds the SQLite write lock the other devices
+# wait for. Every device gets a token bucket refilled with INGEST_DEVICE_ROWS_PER_S
+# readings per second, holding at most INGEST_DEVICE_BURST_ROWS: a batch takes as
+# many tokens as it has readings, and is answered 429 with a Retry-After (the time
+# until the bucket holds them) when they are not there. A batch larger than the
+# bucket is let in once it is full, and the debt delays the next ones. Batches above
+# INGEST_MAX_BATCH_ROWS readings are refused with 413. The single-reading endpoints
+# (/api/heartrate, ...) take one token per reading from the same bucket.
+#
+# Streamed batches are checked as soon as their device_id is read (a device still in
+# debt is refused before any reading is parsed), then before every chunk is spooled,
+# against the readings streamed so far, and charged once committed. Together with the write-behind
+# queue serving devices in turn (DeviceQueues in ingest.py), this keeps the batches of
+# well-behaved devices from waiting behind a backlog.
+
+import datetime
+import math
+import threading
+import time
+
+# Devices rejected within this many seconds are listed as throttled in the stats
+THROTTLED_LISTING_S = 300
+
+# How often the devices that would start over the same are forgotten: bucket full
+# again, no rejection within THROTTLED_LISTING_S. The state (and the walk of stats())
+# stays the size of the devices active lately, not of every device ever seen
+EXPIRE_INTERVAL_S = 60
+
+
+class AdmissionRejected(Exception):
+    """A batch refused before being written: HTTP status, reason, Retry-After (s) or None."""
+
+    def __init__(self, status, reason, message, retry_after_s=None):
+        super().__init__(message)
+        self.status = status
+        self.reason = reason
+        self.retry_after_s = retry_after_s
+
+
+class AdmissionControl:
+    """Token buckets of the devices, and the rejections made, for the stats."""
+
+    def __init__(self, rows_per_s, burst_rows, max_batch_rows):
+        self.rows_per_s = rows_per_s
+        self.burst_rows = burst_rows
+        self.max_batch_rows = max_batch_rows
+        # Device id -> [tokens, monotonic time of the last refill]
+        self._buckets = {}
+        # Device id -> {reason: count, 'last': wall clock time of the last rejection}
+        self._devices = {}
+        self.rejected = {}
+        self._expired_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _expire(self, clock):
+        if clock - self._expired_at < EXPIRE_INTERVAL_S:
+            return
+        self._expired_at = clock
+        for device_id, (tokens, last) in list(self._buckets.items()):
+            if tokens + (clock - last) * self.rows_per_s >= self.burst_rows:
+                del self._buckets[device_id]
+        now = time.time()
+        for device_id, entry in list(self._devices.items()):
+            if now - entry['last'] >= THROTTLED_LISTING_S:
+                del self._devices[device_id]
+
+    def _tokens(self, device_id, now):
+        # Refilled up to the burst since the last call, new devices start full
+        self._expire(now)
+        bucket = self._buckets.get(device_id)
+        if bucket is None:
+            bucket = self._buckets[device_id] = [float(self.burst_rows), now]
+        else:
+            bucket[0] = min(float(self.burst_rows), bucket[0] + (now - bucket[1]) * self.rows_per_s)
+            bucket[1] = now
+        return bucket
+
+    def _check_size(self, device_id, rows):
+        if self.max_batch_rows and rows > self.max_batch_rows:
+            raise self._rejected(device_id, AdmissionRejected(
+                413, 'too_large', f'Batch of {rows} readings, at most {self.max_batch_rows} are accepted'))
+
+    def admit(self, device_id, rows):
+        """Take the tokens of a batch, or raise AdmissionRejected."""
+        self._check_size(device_id, rows)
+        if not self.rows_per_s:
+            return
+        with self._lock:
+            bucket = self._tokens(device_id, time.monotonic())
+            needed = min(rows, self.burst_rows)
+            if bucket[0] < needed:
+                retry_after_s = math.ceil((needed - bucket[0]) / self.rows_per_s)
+            else:
+                bucket[0] -= rows
+                return
+        raise self._rejected(device_id, AdmissionRejected(
+            429, 'rate_limited', f'Device {device_id} is over {self.rows_per_s} readings per second', retry_after_s))
+
+    def admit_stream(self, device_id, rows):
+        """For a batch being streamed, rows readings in so far: raise AdmissionRejected to stop it."""
+        self._check_size(device_id, rows)
+        if not self.rows_per_s:
+            return
+        with self._lock:
+            bucket = self._tokens(device_id, time.monotonic())
+            needed = min(rows, self.burst_rows)
+            if bucket[0] >= needed:
+                return
+            retry_after_s = math.ceil((needed - bucket[0]) / self.rows_per_s)
+        raise self._rejected(device_id, AdmissionRejected(
+            429, 'rate_limited', f'Device {device_id} is over {self.rows_per_s} readings per second', retry_after_s))
+
+    def charge(self, device_id, rows):
+        """Take the tokens of a streamed batch once written, possibly into debt."""
+        if not self.rows_per_s:
+            return
+        with self._lock:
+            self._tokens(device_id, time.monotonic())[0] -= rows
+
+    def refund(self, device_id, rows):
+        """Give back the tokens of an admitted batch that was not queued after all."""
+        self.charge(device_id, -rows)
+
+    def queue_full(self, device_id, rows, device_share, retry_after_s):
+        """
+        AdmissionRejected for an admitted batch the write-behind queue had no room for:
+        429 when the device's share of it was full, 503 when the whole queue was.
+        """
+        self.refund(device_id, rows)
+        if device_share:
+            error = AdmissionRejected(
+                429, 'device_queue_full', f'Device {device_id} has too many batches waiting, retry later', retry_after_s)
+        else:
+            error = AdmissionRejected(503, 'queue_full', 'Ingest queue is full, retry later', retry_after_s)
+        return self._rejected(device_id, error)
+
+    def database_busy(self, device_id, retry_after_s):
+        """AdmissionRejected (503) for a write that waited busy_timeout for the database lock in vain."""
+        return self._rejected(device_id, AdmissionRejected(
+            503, 'database_busy', 'Database is busy, retry later', retry_after_s))
+
+    def record(self, device_id, reason):
+        """Count a rejection for the stats, device_id may be None."""
+        with self._lock:
+            self._expire(time.monotonic())
+            self.rejected[reason] = self.rejected.get(reason, 0) + 1
+            if device_id is None:
+                return
+            entry = self._devices.setdefault(device_id, {})
+            entry[reason] = entry.get(reason, 0) + 1
+            entry['last'] = time.time()
+
+    def _rejected(self, device_id, error):
+        self.record(device_id, error.reason)
+        return error
+
+    def stats(self):
+        """Limits, rejections by reason and the devices throttled recently or in debt."""
+        now, clock = time.time(), time.monotonic()
+        with self._lock:
+            self._expire(clock)
+            devices = []
+            for device_id in set(self._devices) | set(self._buckets):
+                entry = self._devices.get(device_id, {})
+                tokens = self._tokens(device_id, clock)[0] if self.rows_per_s and device_id in self._buckets else None
+                recent = entry and now - entry['last'] < THROTTLED_LISTING_S
+                if not recent and not (tokens is not None and tokens < 0):
+                    continue
+                devices.append({
+                    'device_id': device_id,
+                    'tokens': None if tokens is None else round(tokens, 1),
+                    'rejected': {reason: count for reason, count in entry.items() if reason != 'last'},
+                    'last_rejected': datetime.datetime.fromtimestamp(entry['last']).isoformat() if entry else None,
+                })
+            rejected = dict(self.rejected)
+        return {
+            'limits': {
+                'device_rows_per_s': self.rows_per_s,
+                'device_burst_rows': self.burst_rows,
+                'max_batch_rows': self.max_batch_rows,
+            },
+            'rejected': rejected,
+            'throttled_devices': sorted(devices, key=lambda device: device['device_id']),
+        }
+
+
+def ingest_stats(admission, ingest_queue, top_devices=20):
+    """Admission stats, with the depth of the write-behind queue and its busiest devices."""
+    stats = admission.stats()
+    stats['queue'] = None
+    if ingest_queue is not None:
+        depths = sorted(ingest_queue.device_depths().items(), key=lambda item: -item[1])
+        stats['queue'] = {
+            'depth': ingest_queue.depth(),
+            'devices': len(depths),
+            'busiest_devices': [{'device_id': device_id, 'batches': count} for device_id, count in depths[:top_devices]],
+        }
+    return stats
@@ -1,439 +1,702 @@
 # app.py - Health Data Server with Batch Processing and Web Interface
 
 # Library imports
-from flask import Flask, request, jsonify, render_template
+from flask import Flask, Response, g, request, jsonify, render_template, stream_with_context
 from flask_cors import CORS
-import sqlite3
+try:
+    from flask_sock import Sock
+except ImportError:
+    Sock = None
+try:
+    import export
+except ImportError:
+    export = None
+from werkzeug.exceptions import BadRequest, RequestEntityTooLarge, UnsupportedMediaType, HTTPException
+import csv
 import datetime
+import io
+import itertools
 import os
 import json
+import sqlite3
+import threading
+import time
+import queue
+import atexit
+
+import config
+import db
+import logs
+from db import get_db, release_db
+from admission import AdmissionControl, AdmissionRejected, ingest_stats
+from ingest import API_SENSORS, DeviceQueueFull, IngestQueue, SENSOR_TABLES, STORAGE_TABLES, insert_readings, prepare_batch, recent_batches, write_batch_rows, log_batch
+from columnar import COLUMNAR_MIME_TYPE, decode_columnar_batch
+from body_encoding import install_decompressing_input
+from streaming import spool_streamed_batch
+from devices import device_details, device_ids
+from cache import ResponseCache
+from livefeed import LiveFeed
+from snapshot import device_snapshot
+from batch_stats import batch_aggregates
+import metrics
+from metrics import HTTP_REQUEST_SECONDS, INGEST_BATCHES, INGEST_ERRORS, INGEST_REJECTED, INGEST_STAGE_SECONDS
+from dedup import BatchDeduplicator, batch_key, client_key, content_digest
+from timestamps import format_timestamp_us, parse_timestamp_us
+from timestamp_migration import start_background_migration
+from rollup_backfill import rollups_complete, start_rollup_backfill
+from migrations import LATEST_VERSION, migrate
+from writer import RemoteAdmission, WriterClient, WriterUnavailable
+from partitions import prepare_partitions, start_maintenance
+from readings import decode_cursor, encode_cursor, iter_readings, latest_readings, reading_columns
+from rollups import rollup_series
+from timeseries import aligned_series, parse_duration_us, timeseries_response
 
 app = Flask(__name__)
-CORS(app)
+# X-Next-Cursor carries the keyset pagination cursor of the sensor GET endpoints
+CORS(app, expose_headers=['X-Next-Cursor'])
+
+# Request connections come from the shared pool and go back to it after each request
+app.teardown_appcontext(release_db)
+
+# Persistent WebSocket ingest channel, only available when flask-sock is installed
+sock = Sock(app) if Sock is not None else None
+app.config['SOCK_SERVER_OPTIONS'] = {
+    'ping_interval': config.STREAM_PING_INTERVAL_S,
+    'max_message_size': config.STREAM_MAX_FRAME_BYTES
+}
 
 os.makedirs('templates', exist_ok=True)
 
+log = logs.get_logger('app')
+
 def init_db():
-    if not os.path.exists('health_data.db'):
-        conn = sqlite3.connect('health_data.db')
-        c = conn.cursor()
-        
-        # Create heartrates table
-        c.execute('''
-            CREATE TABLE heartrates (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                device_id TEXT NOT NULL,
-                heart_rate INTEGER NOT NULL,
-                timestamp TEXT NOT NULL
-            )
-        ''')
-        
-        # Create skin temperature table
-        c.execute('''
-            CREATE TABLE skin_temperature (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                device_id TEXT NOT NULL,
-                value INTEGER NOT NULL,
-                timestamp TEXT NOT NULL
-            )
-        ''')
-        
-        # Create GSR table
-        c.execute('''
-            CREATE TABLE gsr (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                device_id TEXT NOT NULL,
-                value INTEGER NOT NULL,
-                timestamp TEXT NOT NULL
-            )
-        ''')
-
-        # Create Light table
-        c.execute('''
-            CREATE TABLE light (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                device_id TEXT NOT NULL,
-                value INTEGER NOT NULL,
-                timestamp TEXT NOT NULL
-            )
-        ''')
-
-        # Create PPG table
-        c.execute('''
-            CREATE TABLE ppg (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                device_id TEXT NOT NULL,
-                value INTEGER NOT NULL,
-                timestamp TEXT NOT NULL
-            )
-        ''')
-
-        # Create Accelerometer table
-        c.execute('''
-            CREATE TABLE accelerometer (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                device_id TEXT NOT NULL,
-                x_value REAL NOT NULL,
-                y_value REAL NOT NULL,
-                z_value REAL NOT NULL,
-                timestamp TEXT NOT NULL
-            )
-        ''')
-
-        # Create Gyroscope table
-        c.execute('''
-            CREATE TABLE gyroscope (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                device_id TEXT NOT NULL,
-                x_value REAL NOT NULL,
-                y_value REAL NOT NULL,
-                z_value REAL NOT NULL,
-                timestamp TEXT NOT NULL
-            )
-        ''')
-
-        # Create batch_logs table to track batch processing
-        c.execute('''
-            CREATE TABLE batch_logs (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                device_id TEXT NOT NULL,
-                batch_timestamp TEXT NOT NULL,
-                heart_rate_count INTEGER DEFAULT 0,
-                health_data_count INTEGER DEFAULT 0,
-                motion_data_count INTEGER DEFAULT 0,
-                total_records INTEGER DEFAULT 0,
-                processing_time_ms INTEGER DEFAULT 0,
-                created_at TEXT NOT NULL
-            )
-        ''')
-        
-        conn.commit()
-        conn.close()
-        print("Database created successfully")
-    else:
-        # Check if the new tables exist and create them if not
-        conn = sqlite3.connect('health_data.db')
-        c = conn.cursor()
-        
-        c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='skin_temperature'")
-        if not c.fetchone():
-            c.execute('''
-                CREATE TABLE skin_temperature (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    device_id TEXT NOT NULL,
-                    value INTEGER NOT NULL,
-                    timestamp TEXT NOT NULL
-                )
-            ''')
-            print("Created skin_temperature table")
-        
-        c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='gsr'")
-        if not c.fetchone():
-            c.execute('''
-                CREATE TABLE gsr (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    device_id TEXT NOT NULL,
-                    value INTEGER NOT NULL,
-                    timestamp TEXT NOT NULL
-                )
-            ''')
-            print("Created gsr table")
-
-        c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='light'")
-        if not c.fetchone():
-            c.execute('''
-                CREATE TABLE light (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    device_id TEXT NOT NULL,
-                    value INTEGER NOT NULL,
-                    timestamp TEXT NOT NULL
-                )
-            ''')
-            print("Created light table")
-
-        c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='ppg'")
-        if not c.fetchone():
-            c.execute('''
-                CREATE TABLE ppg (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    device_id TEXT NOT NULL,
-                    value INTEGER NOT NULL,
-                    timestamp TEXT NOT NULL
-                )
-            ''')
-            print("Created ppg table")
-
-        c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='accelerometer'")
-        if not c.fetchone():
-            c.execute('''
-                CREATE TABLE accelerometer (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    device_id TEXT NOT NULL,
-                    x_value REAL NOT NULL,
-                    y_value REAL NOT NULL,
-                    z_value REAL NOT NULL,
-                    timestamp TEXT NOT NULL
-                )
-            ''')
-            print("Created accelerometer table")
-
-        c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='gyroscope'")
-        if not c.fetchone():
-            c.execute('''
-                CREATE TABLE gyroscope (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    device_id TEXT NOT NULL,
-                    x_value REAL NOT NULL,
-                    y_value REAL NOT NULL,
-                    z_value REAL NOT NULL,
-                    timestamp TEXT NOT NULL
-                )
-            ''')
-            print("Created gyroscope table")
-
-        c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='batch_logs'")
-        if not c.fetchone():
-            c.execute('''
-                CREATE TABLE batch_logs (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    device_id TEXT NOT NULL,
-                    batch_timestamp TEXT NOT NULL,
-                    heart_rate_count INTEGER DEFAULT 0,
-                    health_data_count INTEGER DEFAULT 0,
-                    motion_data_count INTEGER DEFAULT 0,
-                    total_records INTEGER DEFAULT 0,
-                    processing_time_ms INTEGER DEFAULT 0,
-                    created_at TEXT NOT NULL
-                )
-            ''')
-            print("Created batch_logs table")
-            
-        conn.commit()
+    # Creates the database on first start and brings older ones up to date, see migrations.py
+    conn = db.connect()
+    try:
+        migrate(conn)
+    finally:
         conn.close()
-        print("Database ready")
+    # Live readings never create a partition inside the ingest transaction, see partitions.py
+    prepare_partitions(STORAGE_TABLES)
+    log.info('database_ready', schema_version=LATEST_VERSION)
+
+_started = False
+
+def create_app():
+    """
+    Prepare this process (logs, database, background work) and return the app, once per
+    process: `python app.py` for development, or a multi-worker server in production,
+    e.g. `gunicorn -c gunicorn.conf.py "app:create_app()"`. Settings come from config.py.
+    """
+    global _started
+    if _started:
+        return app
+    _started = True
+
+    # Structured logs, written from a background thread, see logs.py
+    logs.configure()
+    init_db()
+
+    if config.INGEST_MODE == 'writer':
+        # The writer process does the background writes, and tells this worker what the
+        # others committed
+        writer_client.subscribe(_apply_commit_notice)
+        writer_client.share_metrics(metrics.REGISTRY.collect)
+        return app
+
+    # Convert the timestamps of rows stored before ts_us existed, chunk by chunk next to ingest
+    if config.TIMESTAMP_MIGRATION == 'background':
+        start_background_migration()
+    # Rollups of the readings stored without them, see rollup_backfill.py
+    start_rollup_backfill()
+
+    # Partitions of the next period, and readings older than RETENTION_DAYS dropped a
+    # partition at a time
+    start_maintenance(STORAGE_TABLES)
+    return app
+
+# Ingest endpoints accept gzip / zstd compressed bodies, decompressed while they are read
+@app.before_request
+def decode_request_body():
+    if request.method == 'POST' and request.path.startswith('/api/'):
+        install_decompressing_input(
+            request.environ,
+            config.MAX_DECOMPRESSED_BODY_BYTES,
+            app.config.get('MAX_CONTENT_LENGTH')
+        )
+
+@app.errorhandler(BadRequest)
+@app.errorhandler(RequestEntityTooLarge)
+@app.errorhandler(UnsupportedMediaType)
+def request_body_error(e):
+    if request.method == 'POST':
+        INGEST_REJECTED.inc('invalid_body')
+    return jsonify({'error': e.description}), e.code
 
-# Initialize the database
-init_db()
+# Response time of every request, by route template (not path, so device ids do not
+# multiply the series), see metrics.py
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
 
-# Helper function to get device IDs
+@app.after_request
+def observe_request_time(response):
+    started = g.pop('request_started', None)
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        HTTP_REQUEST_SECONDS.observe(time.perf_counter() - started, request.method, route, str(response.status_code))
+    return response
+
+# Live feeds and WebSocket ingest hold a thread of the worker for as long as they stay
+# open: past STREAM_MAX_CONNECTIONS of them, new ones are answered 503 so that the other
+# threads keep serving requests
+_STREAM_ENDPOINTS = ('device_live_feed', 'stream_ingest')
+_stream_slots = threading.BoundedSemaphore(config.STREAM_MAX_CONNECTIONS)
+
+@app.before_request
+def limit_streams():
+    if request.endpoint not in _STREAM_ENDPOINTS:
+        return None
+    if not _stream_slots.acquire(blocking=False):
+        log.warning('stream_refused', endpoint=request.endpoint, limit=config.STREAM_MAX_CONNECTIONS)
+        response = jsonify({'error': 'Too many open streams on this worker, retry later', 'reason': 'streams_full'})
+        response.headers['Retry-After'] = str(config.INGEST_RETRY_AFTER_S)
+        return response, 503
+    g.stream_slot = True
+    return None
+
+@app.teardown_request
+def release_stream_slot(error=None):
+    # A live feed takes its slot along and gives it back when its client disconnects
+    if g.pop('stream_slot', False):
+        _stream_slots.release()
+
+# Helper function to get device IDs, from the registry maintained at ingest (see devices.py)
 def get_device_ids():
-    conn = sqlite3.connect('health_data.db')
-    c = conn.cursor()
-    c.execute("SELECT DISTINCT device_id FROM heartrates UNION SELECT DISTINCT device_id FROM skin_temperature UNION SELECT DISTINCT device_id FROM gsr UNION SELECT DISTINCT device_id FROM light")
-    devices = [row[0] for row in c.fetchall()]
-    conn.close()
-    return devices
+    return device_ids(get_db())
+
+# Registry entries with their sensors under the API sensor names
+def get_device_details(device_id=None):
+    sensor_names = {table: sensor for sensor, table in API_SENSORS.items()}
+    details = device_details(get_db(), device_id)
+    for device in details:
+        device['sensors'] = {sensor_names[table]: info for table, info in device['sensors'].items()}
+    return details
+
+# Recently stored batches, so that client retries are not inserted twice
+deduplicator = BatchDeduplicator(config.DEDUP_CACHE_SIZE)
+
+# Dashboard GET responses, invalidated by the commits of the devices they show
+response_cache = ResponseCache(config.RESPONSE_CACHE_SIZE, config.RESPONSE_CACHE_TTL_S)
+
+# Readings pushed to the live dashboards as they are committed
+live_feed = LiveFeed(config.LIVE_FEED_QUEUE_SIZE, config.LIVE_FEED_MAX_READINGS)
+
+# Batches are committed by the writer process in INGEST_MODE=writer, see writer.py
+writer_client = WriterClient() if config.INGEST_MODE == 'writer' else None
+
+def batch_committed(batch):
+    # Only called once the batch is committed, see cache.py and livefeed.py. In writer
+    # mode the writer passes the commits on to the other workers
+    tables = [table for table in SENSOR_TABLES if batch.count(table)] + ['batch_logs']
+    response_cache.invalidate(batch.device_id, tables)
+    live_feed.publish_batch(batch)
+
+def readings_committed(device_id, table, rows):
+    # Same for the single reading POST endpoints
+    response_cache.invalidate(device_id, [table])
+    live_feed.publish(device_id, table, rows)
+
+def _share_live_devices():
+    # The readings of the batches committed by the writer are only sent to the workers
+    # with live feed subscribers for their device
+    if writer_client is None:
+        return
+    try:
+        writer_client.watch(live_feed.device_ids())
+    except WriterUnavailable as e:
+        log.warning('live_devices_not_shared', error=str(e))
+
+def _apply_commit_notice(notice):
+    if notice[0] == 'batch':
+        batch_committed(notice[1])
+    else:
+        readings_committed(*notice[1:])
+
+def cached_response(table, compute):
+    """
+    Serve a GET request on table from the response cache, or compute() it,
+    a (response, status) pair, and cache it when successful.
+    """
+    device_id = request.args.get('device_id') or None
+    key = (table, device_id, request.path, tuple(sorted(request.args.items(multi=True))))
+    cached = response_cache.get(key)
+    if cached is not None:
+        body, headers = cached
+        return Response(body, status=200, mimetype='application/json', headers=headers)
+
+    generation = response_cache.generation(table, device_id)
+    response, status = compute()
+    if status == 200:
+        headers = {name: value for name, value in response.headers.items() if name == 'X-Next-Cursor'}
+        response_cache.put(key, generation, (response.get_data(), headers))
+    return response, status
+
+# Write-behind queue used when INGEST_MODE is 'queued'
+ingest_queue = IngestQueue(
+    config.DATABASE_PATH,
+    maxsize=config.INGEST_QUEUE_SIZE,
+    flush_interval_ms=config.INGEST_FLUSH_INTERVAL_MS,
+    max_group_size=config.INGEST_MAX_GROUP_SIZE,
+    on_drop=lambda batch: deduplicator.forget(batch.batch_key),
+    on_commit=batch_committed,
+    device_maxsize=config.INGEST_DEVICE_QUEUE_SIZE,
+    max_group_rows=config.INGEST_MAX_GROUP_ROWS
+)
+atexit.register(ingest_queue.stop)
+
+# Per device rate limits and batch size limit (see admission.py), kept by the writer
+# process in writer mode so they hold across workers
+if config.INGEST_MODE == 'writer':
+    admission = RemoteAdmission(writer_client)
+else:
+    admission = AdmissionControl(
+        config.INGEST_DEVICE_ROWS_PER_S, config.INGEST_DEVICE_BURST_ROWS, config.INGEST_MAX_BATCH_ROWS)
 
 # Batch processing endpoint
 @app.route('/api/batch', methods=['POST'])
 def store_batch_data():
     try:
-        import time
         start_time = time.time()
+        conn = get_db()
+
+        # A retry carrying the client's Idempotency-Key is answered before the body is even read
+        header_batch_id = request.headers.get('Idempotency-Key')
+        if header_batch_id:
+            original = deduplicator.lookup(conn, client_key(header_batch_id))
+            if original is not None:
+                return _duplicate_batch_response(original)
+
+        # Large JSON payloads (e.g. a watch catching up after being offline) are
+        # parsed incrementally so they never sit in memory as a whole
+        if request.is_json and _should_stream_batch():
+            return _store_streamed_batch_data(start_time, header_batch_id)
         
-        # Get batch data from request
-        data = request.json
-        device_id = data.get('device_id', 'unknown')
-        batch_timestamp = data.get('batch_timestamp', datetime.datetime.now().isoformat())
-        
-        # Initialize counters
-        heart_rate_count = 0
-        health_data_count = 0
-        motion_data_count = 0
-        
-        conn = sqlite3.connect('health_data.db')
-        c = conn.cursor()
-        
-        # Begin transaction for atomic batch processing
-        c.execute('BEGIN TRANSACTION')
-        
+        # Get batch data from request and group it by table, either from the
+        # compact columnar format or from the JSON format sent by older app builds
         try:
-            # Process heart rate data
-            if 'heart_rate_data' in data and data['heart_rate_data']:
-                heart_rate_batch = []
-                for hr_reading in data['heart_rate_data']:
-                    heart_rate_batch.append((
-                        device_id,
-                        hr_reading.get('heart_rate'),
-                        hr_reading.get('timestamp')
-                    ))
-                
-                c.executemany(
-                    'INSERT INTO heartrates (device_id, heart_rate, timestamp) VALUES (?, ?, ?)',
-                    heart_rate_batch
-                )
-                heart_rate_count = len(heart_rate_batch)
-                print(f"Inserted {heart_rate_count} heart rate readings")
-
-            # Process health data (skin temp, GSR, light, PPG)
-            if 'health_data' in data and data['health_data']:
-                # Group health data by type for batch insertion
-                skin_temp_batch = []
-                gsr_batch = []
-                light_batch = []
-                ppg_batch = []
-                
-                for health_reading in data['health_data']:
-                    data_type = health_reading.get('data_type')
-                    value = health_reading.get('value')
-                    timestamp = health_reading.get('timestamp')
-                    
-                    if data_type == 'skin_temperature':
-                        skin_temp_batch.append((device_id, value, timestamp))
-                    elif data_type == 'gsr':
-                        gsr_batch.append((device_id, value, timestamp))
-                    elif data_type == 'light':
-                        light_batch.append((device_id, value, timestamp))
-                    elif data_type == 'ppg':
-                        ppg_batch.append((device_id, value, timestamp))
-                
-                # Insert batched health data
-                if skin_temp_batch:
-                    c.executemany(
-                        'INSERT INTO skin_temperature (device_id, value, timestamp) VALUES (?, ?, ?)',
-                        skin_temp_batch
-                    )
-                    print(f"Inserted {len(skin_temp_batch)} skin temperature readings")
-                
-                if gsr_batch:
-                    c.executemany(
-                        'INSERT INTO gsr (device_id, value, timestamp) VALUES (?, ?, ?)',
-                        gsr_batch
-                    )
-                    print(f"Inserted {len(gsr_batch)} GSR readings")
-                
-                if light_batch:
-                    c.executemany(
-                        'INSERT INTO light (device_id, value, timestamp) VALUES (?, ?, ?)',
-                        light_batch
-                    )
-                    print(f"Inserted {len(light_batch)} light readings")
-                
-                if ppg_batch:
-                    c.executemany(
-                        'INSERT INTO ppg (device_id, value, timestamp) VALUES (?, ?, ?)',
-                        ppg_batch
-                    )
-                    print(f"Inserted {len(ppg_batch)} PPG readings")
-                
-                health_data_count = len(skin_temp_batch) + len(gsr_batch) + len(light_batch) + len(ppg_batch)
-
-            # Process motion data (accelerometer, gyroscope)
-            if 'motion_data' in data and data['motion_data']:
-                # Group motion data by type for batch insertion
-                accelerometer_batch = []
-                gyroscope_batch = []
-                
-                for motion_reading in data['motion_data']:
-                    data_type = motion_reading.get('data_type')
-                    x_value = motion_reading.get('x_value')
-                    y_value = motion_reading.get('y_value')
-                    z_value = motion_reading.get('z_value')
-                    timestamp = motion_reading.get('timestamp')
-                    
-                    if data_type == 'accelerometer':
-                        accelerometer_batch.append((device_id, x_value, y_value, z_value, timestamp))
-                    elif data_type == 'gyroscope':
-                        gyroscope_batch.append((device_id, x_value, y_value, z_value, timestamp))
-                
-                # Insert batched motion data
-                if accelerometer_batch:
-                    c.executemany(
-                        'INSERT INTO accelerometer (device_id, x_value, y_value, z_value, timestamp) VALUES (?, ?, ?, ?, ?)',
-                        accelerometer_batch
-                    )
-                    print(f"Inserted {len(accelerometer_batch)} accelerometer readings")
-                
-                if gyroscope_batch:
-                    c.executemany(
-                        'INSERT INTO gyroscope (device_id, x_value, y_value, z_value, timestamp) VALUES (?, ?, ?, ?, ?)',
-                        gyroscope_batch
-                    )
-                    print(f"Inserted {len(gyroscope_batch)} gyroscope readings")
-                
-                motion_data_count = len(accelerometer_batch) + len(gyroscope_batch)
-
-            # Calculate processing time
-            processing_time_ms = int((time.time() - start_time) * 1000)
-            total_records = heart_rate_count + health_data_count + motion_data_count
-            
-            # Log batch processing info
-            c.execute('''
-                INSERT INTO batch_logs 
-                (device_id, batch_timestamp, heart_rate_count, health_data_count, motion_data_count, 
-                 total_records, processing_time_ms, created_at) 
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                device_id, batch_timestamp, heart_rate_count, health_data_count, 
-                motion_data_count, total_records, processing_time_ms, 
-                datetime.datetime.now().isoformat()
-            ))
-            
-            # Commit transaction
+            with INGEST_STAGE_SECONDS.time('decode'):
+                body = request.get_data()
+                if request.mimetype == COLUMNAR_MIME_TYPE:
+                    batch = decode_columnar_batch(body)
+                else:
+                    batch = prepare_batch(request.get_json(silent=True))
+        except ValueError as e:
+            INGEST_REJECTED.inc('invalid_payload')
+            return jsonify({'error': f'Invalid batch payload: {str(e)}'}), 400
+
+        # Without a client id, a retry is recognised by its content
+        batch.batch_key = batch_key(header_batch_id, batch.client_batch_id, content_digest(body))
+        try:
+            status, summary = _ingest_batch(conn, batch, start_time)
+        except AdmissionRejected as e:
+            return _rejected_response(e)
+
+        if status == 'duplicate':
+            return _duplicate_batch_response(summary)
+        if status == 'queued':
+            return jsonify({
+                'message': 'Batch data queued for processing',
+                'summary': summary
+            }), 202
+        return jsonify({
+            'message': 'Batch data processed successfully',
+            'summary': summary
+        }), 201
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        INGEST_ERRORS.inc('exception')
+        log.error('batch_failed', exc_info=True, error=str(e))
+        return jsonify({'error': f'Batch processing failed: {str(e)}'}), 500
+
+def _ingest_batch(conn, batch, start_time):
+    """
+    Store a prepared batch, shared by /api/batch and the WebSocket stream.
+
+    Returns (status, summary) with status 'stored', 'queued' or 'duplicate'.
+    Raises AdmissionRejected when the batch is refused: over its device's limits,
+    or the writer is saturated (queue full, database locked) or unreachable.
+    """
+    try:
+        status, summary = _store_batch(conn, batch, start_time)
+    except WriterUnavailable as e:
+        raise _writer_unavailable(e)
+    except sqlite3.OperationalError as e:
+        # busy_timeout ran out waiting for the write lock (sync mode)
+        if not db.is_busy(e):
+            raise
+        admission.refund(batch.device_id, batch.total_records)
+        raise _database_busy(batch.device_id)
+    INGEST_BATCHES.inc(status)
+    return status, summary
+
+def _database_busy(device_id):
+    return admission.database_busy(device_id, config.INGEST_RETRY_AFTER_S)
+
+def _writer_unavailable(error):
+    log.error('writer_unavailable', error=str(error))
+    # It may have stopped answering with the batch queued: retried with the same
+    # Idempotency-Key, a batch committed meanwhile is answered as a duplicate
+    return AdmissionRejected(503, 'writer_unavailable', 'Writer is unavailable, the batch may still be stored: '
+                             'retry it with the same Idempotency-Key', config.INGEST_RETRY_AFTER_S)
+
+def _rejected_response(error):
+    INGEST_REJECTED.inc(error.reason)
+    response = jsonify({'error': str(error), 'reason': error.reason})
+    if error.retry_after_s is not None:
+        response.headers['Retry-After'] = str(error.retry_after_s)
+    return response, error.status
+
+def _store_batch(conn, batch, start_time):
+    with INGEST_STAGE_SECONDS.time('dedup'):
+        original = deduplicator.lookup(conn, batch.batch_key)
+    if original is not None:
+        return 'duplicate', original
+
+    if config.INGEST_MODE == 'writer':
+        # Committed by the writer process together with the batches of the other workers
+        batch.processing_time_ms = int((time.time() - start_time) * 1000)
+        try:
+            summary = writer_client.submit(batch)
+        except RuntimeError:
+            # A concurrent retry of the same batch, sent by another worker, committed first
+            original = deduplicator.lookup(conn, batch.batch_key)
+            if original is None:
+                raise
+            return 'duplicate', original
+        deduplicator.remember(batch.batch_key, summary)
+        batch_committed(batch)
+        return 'stored', summary
+
+    # The writer process admits the batches of writer mode itself
+    admission.admit(batch.device_id, batch.total_records)
+
+    if config.INGEST_MODE == 'queued':
+        # Hand the batch to the writer thread, it is committed together with other devices' batches
+        batch.processing_time_ms = int((time.time() - start_time) * 1000)
+        deduplicator.remember(batch.batch_key, batch.summary())
+        try:
+            ingest_queue.submit(batch)
+        except queue.Full as e:
+            deduplicator.forget(batch.batch_key)
+            raise admission.queue_full(batch.device_id, batch.total_records,
+                                       isinstance(e, DeviceQueueFull), config.INGEST_RETRY_AFTER_S)
+        return 'queued', batch.summary()
+
+    c = conn.cursor()
+
+    # Begin transaction for atomic batch processing, holding the write lock from the
+    # start (see _store_reading)
+    c.execute('BEGIN IMMEDIATE')
+
+    try:
+        commit_start = time.time()
+        with INGEST_STAGE_SECONDS.time('write'):
+            write_batch_rows(c, batch)
+
+        # Calculate processing time
+        batch.processing_time_ms = int((time.time() - start_time) * 1000)
+        commit_time_ms = int((time.time() - commit_start) * 1000)
+
+        # Log batch processing info
+        with INGEST_STAGE_SECONDS.time('log'):
+            log_batch(c, batch, commit_time_ms=commit_time_ms)
+
+        # Commit transaction
+        with INGEST_STAGE_SECONDS.time('commit'):
             conn.commit()
-            
-            response_data = {
+        deduplicator.remember(batch.batch_key, batch.summary())
+        batch_committed(batch)
+
+        log.info('batch_processed', device_id=batch.device_id, total_records=batch.total_records,
+                 processing_time_ms=batch.processing_time_ms)
+        return 'stored', batch.summary()
+
+    except sqlite3.IntegrityError:
+        # A concurrent retry of the same batch committed first
+        conn.rollback()
+        original = deduplicator.lookup(conn, batch.batch_key)
+        if original is None:
+            raise
+        admission.refund(batch.device_id, batch.total_records)
+        return 'duplicate', original
+
+    except Exception as e:
+        # Rollback transaction on error
+        conn.rollback()
+        raise e
+
+def _should_stream_batch():
+    content_length = request.environ.get('body_encoding.content_length', request.content_length)
+    return content_length is None or content_length > config.STREAMING_INGEST_MIN_BYTES
+
+def _duplicate_batch_response(summary):
+    return jsonify({
+        'message': 'Batch already processed',
+        'duplicate': True,
+        'summary': summary
+    }), 200
+
+def _store_streamed_batch_data(start_time, header_batch_id):
+    # Streamed batches are written directly in their own transaction, also in queued
+    # mode, and sent to the writer process in writer mode. Their readings are spooled
+    # while the body is read, the transaction only starts once it has been read whole
+    conn = get_db()
+    batch = None
+    try:
+        try:
+            with INGEST_STAGE_SECONDS.time('stream'):
+                batch = spool_streamed_batch(request.stream, config.STREAMING_INGEST_CHUNK_ROWS,
+                                             before_flush=admission.admit_stream)
+        except ValueError as e:
+            INGEST_REJECTED.inc('invalid_payload')
+            return jsonify({'error': f'Invalid batch payload: {str(e)}'}), 400
+        except AdmissionRejected as e:
+            # The device went over its rate (or the size limit) while streaming
+            return _rejected_response(e)
+        except WriterUnavailable as e:
+            return _rejected_response(_writer_unavailable(e))
+
+        # The batch id / content hash is only known once the whole body was read
+        batch.batch_key = batch_key(header_batch_id, batch.client_batch_id, batch.content_digest)
+        if config.INGEST_MODE == 'writer':
+            # Its spooled rows follow it to the writer a chunk at a time, see WriterClient.submit
+            try:
+                status, summary = _ingest_batch(conn, batch, start_time)
+            except AdmissionRejected as e:
+                return _rejected_response(e)
+            if status == 'duplicate':
+                return _duplicate_batch_response(summary)
+            return jsonify({
                 'message': 'Batch data processed successfully',
-                'summary': {
-                    'device_id': device_id,
-                    'total_records': total_records,
-                    'heart_rate_count': heart_rate_count,
-                    'health_data_count': health_data_count,
-                    'motion_data_count': motion_data_count,
-                    'processing_time_ms': processing_time_ms
-                }
-            }
-            
-            print(f"Batch processed: {total_records} total records in {processing_time_ms}ms")
-            return jsonify(response_data), 201
-            
-        except Exception as e:
-            # Rollback transaction on error
-            conn.rollback()
-            raise e
-            
+                'summary': summary
+            }), 201
+
+        original = deduplicator.lookup(conn, batch.batch_key)
+        if original is not None:
+            INGEST_BATCHES.inc('duplicate')
+            return _duplicate_batch_response(original)
+
+        c = conn.cursor()
+        c.execute('BEGIN IMMEDIATE')
+        commit_start = time.time()
+        with INGEST_STAGE_SECONDS.time('write'):
+            write_batch_rows(c, batch)
+        batch.processing_time_ms = int((time.time() - start_time) * 1000)
+        commit_time_ms = int((time.time() - commit_start) * 1000)
+        with INGEST_STAGE_SECONDS.time('log'):
+            log_batch(c, batch, commit_time_ms=commit_time_ms)
+        with INGEST_STAGE_SECONDS.time('commit'):
+            conn.commit()
+        INGEST_BATCHES.inc('stored')
+        admission.charge(batch.device_id, batch.total_records)
+        deduplicator.remember(batch.batch_key, batch.summary())
+        batch_committed(batch)
+
+        log.info('batch_processed', device_id=batch.device_id, total_records=batch.total_records,
+                 processing_time_ms=batch.processing_time_ms, streamed=True)
+        return jsonify({
+            'message': 'Batch data processed successfully',
+            'summary': batch.summary()
+        }), 201
+
+    except sqlite3.IntegrityError:
+        conn.rollback()
+        original = deduplicator.lookup(conn, batch.batch_key)
+        if original is None:
+            raise
+        INGEST_BATCHES.inc('duplicate')
+        return _duplicate_batch_response(original)
+
+    except sqlite3.OperationalError as e:
+        conn.rollback()
+        # busy_timeout ran out waiting for the write lock
+        if not db.is_busy(e):
+            raise
+        return _rejected_response(_database_busy(batch.device_id))
+
+    except Exception:
+        conn.rollback()
+        raise
+
+    finally:
+        if batch is not None:
+            batch.close()
+
+def _ingest_stream_frame(frame, device_id):
+    # Frames are small batches: JSON objects shaped like the /api/batch payload
+    # (text frames) or columnar batches (binary frames). Each one gets an ack
+    start_time = time.time()
+    seq = None
+    try:
+        with INGEST_STAGE_SECONDS.time('decode'):
+            if isinstance(frame, bytes):
+                batch = decode_columnar_batch(frame)
+                seq = batch.client_batch_id
+                body = frame
+            else:
+                data = json.loads(frame)
+                if isinstance(data, dict):
+                    seq = data.get('seq')
+                    # The device is usually named once, when connecting
+                    if device_id:
+                        data.setdefault('device_id', device_id)
+                batch = prepare_batch(data)
+                body = frame.encode()
+    except ValueError as e:
+        INGEST_REJECTED.inc('invalid_payload')
+        return {'seq': seq, 'status': 'error', 'error': f'Invalid frame: {str(e)}'}
+
+    batch.batch_key = batch_key(None, batch.client_batch_id, content_digest(body))
+
+    # A connection from the pool per frame, an idle socket does not hold one
+    conn = db.pool.acquire()
+    try:
+        status, summary = _ingest_batch(conn, batch, start_time)
+    except AdmissionRejected as e:
+        # 'busy' when the server is saturated, 'throttled' when the device is over its rate
+        INGEST_REJECTED.inc(e.reason)
+        return {'seq': seq, 'status': _FRAME_REJECTED_STATUS.get(e.status, 'error'), 'reason': e.reason,
+                'error': str(e), 'retry_after_s': e.retry_after_s}
     except Exception as e:
-        print(f"Error processing batch: {str(e)}")
-        return jsonify({'error': f'Batch processing failed: {str(e)}'}), 500
-    
+        INGEST_ERRORS.inc('exception')
+        log.error('stream_frame_failed', exc_info=True, seq=seq, error=str(e))
+        return {'seq': seq, 'status': 'error', 'error': f'Frame processing failed: {str(e)}'}
     finally:
-        if 'conn' in locals():
-            conn.close()
+        db.pool.release(conn)
+
+    return {'seq': seq, 'status': status, 'summary': summary}
+
+_FRAME_REJECTED_STATUS = {429: 'throttled', 503: 'busy'}
+
+if sock is not None:
+    # Streaming ingest endpoint: ws://<server>/api/stream?device_id=<id>
+    @sock.route('/api/stream')
+    def stream_ingest(ws):
+        device_id = request.args.get('device_id')
+        while True:
+            frame = ws.receive()
+            ws.send(json.dumps(_ingest_stream_frame(frame, device_id)))
 
 # Get batch processing statistics
 @app.route('/api/batch/stats', methods=['GET'])
 def get_batch_stats():
     try:
-        device_id = request.args.get('device_id', None)
-        limit = request.args.get('limit', 50)
-        
-        conn = sqlite3.connect('health_data.db')
-        conn.row_factory = sqlite3.Row
-        c = conn.cursor()
-        
-        query = 'SELECT * FROM batch_logs'
-        params = []
-        
-        if device_id:
-            query += ' WHERE device_id = ?'
-            params.append(device_id)
-            
-        query += ' ORDER BY created_at DESC LIMIT ?'
-        params.append(limit)
-        
-        c.execute(query, params)
-        results = [dict(row) for row in c.fetchall()]
-        conn.close()
-        
-        return jsonify(results), 200
+        # ?aggregate=1 for per device and bucket aggregates, see _batch_aggregates
+        if request.args.get('aggregate', '0') not in ('0', 'false'):
+            return _batch_aggregates()
+        return cached_response('batch_logs', _batch_stats)
         
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+def _batch_stats():
+    device_id = request.args.get('device_id', None)
+    limit = request.args.get('limit', 50)
+    return jsonify(recent_batches(get_db(), device_id, limit)), 200
+
+# Aggregate mode of /api/batch/stats (see batch_stats.py), not cached: its default range
+# ends now. Parameters:
+#   device_id       one device (all of them by default)
+#   since / until   ISO timestamps, the last hour by default
+#   bucket          bucket width ('30s', '5m', ...), 1 minute by default
+#   gap             gaps between batches longer than this are listed, 1 minute by default
+def _batch_aggregates():
+    try:
+        bucket_us = parse_duration_us(request.args.get('bucket', '1m'))
+        until_us = parse_timestamp_us(request.args['until']) if 'until' in request.args else int(time.time() * 1_000_000)
+        if 'since' in request.args:
+            since_us = parse_timestamp_us(request.args['since'])
+        else:
+            # Buckets on round times (whole minutes for 1m, ...)
+            since_us = (until_us - 3_600_000_000) // bucket_us * bucket_us
+        gap_us = parse_duration_us(request.args.get('gap', '1m'))
+        devices = batch_aggregates(get_db(), since_us, until_us, bucket_us, gap_us, request.args.get('device_id'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({
+        'since': format_timestamp_us(since_us),
+        'until': format_timestamp_us(until_us),
+        'bucket_s': bucket_us / 1_000_000,
+        'gap_threshold_s': gap_us / 1_000_000,
+        'devices': devices,
+    }), 200
+
+# Rate limits, rejections and throttled devices of ingest, and the write-behind queue
+# (queued and writer mode) with the devices holding the most of it
+@app.route('/api/ingest/stats', methods=['GET'])
+def get_ingest_stats():
+    try:
+        if config.INGEST_MODE == 'writer':
+            return jsonify(admission.stats()), 200
+        return jsonify(ingest_stats(admission, ingest_queue if config.INGEST_MODE == 'queued' else None)), 200
+    except WriterUnavailable as e:
+        return jsonify({'error': str(e)}), 503
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+# Hit / miss counters of the dashboard response cache
+@app.route('/api/cache/stats', methods=['GET'])
+def get_cache_stats():
+    return jsonify(response_cache.stats()), 200
+
+# Gauges computed when /metrics is scraped
+def _file_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+metrics.REGISTRY.register(metrics.Gauge(
+    'db_file_bytes', 'Size of the SQLite database file.', lambda: _file_size(config.DATABASE_PATH)))
+metrics.REGISTRY.register(metrics.Gauge(
+    'db_wal_bytes', 'Size of the SQLite write-ahead log.', lambda: _file_size(config.DATABASE_PATH + '-wal')))
+metrics.REGISTRY.register(metrics.Gauge(
+    'ingest_queue_depth', 'Batches waiting for the writer thread.',
+    lambda: ingest_queue.depth() if config.INGEST_MODE != 'writer' else None))
+metrics.REGISTRY.register(metrics.Gauge(
+    'ingest_throttled_devices', 'Devices rejected by admission control recently, or over their rate.',
+    lambda: len(admission.stats()['throttled_devices']) if config.INGEST_MODE != 'writer' else None))
+metrics.REGISTRY.register(metrics.Gauge(
+    'live_feed_subscribers', 'Open live feed streams.', live_feed.subscriber_count))
+metrics.REGISTRY.register(metrics.Gauge(
+    'response_cache_entries', 'Responses held by the response cache.', lambda: response_cache.stats()['entries']))
+metrics.REGISTRY.register(metrics.Gauge(
+    'response_cache_lookups', 'Response cache lookups, per result.',
+    lambda: {('hit',): response_cache.hits, ('miss',): response_cache.misses}, labels=('result',), kind='counter'))
+metrics.REGISTRY.register(metrics.Gauge(
+    'log_records_dropped', 'Log records dropped because the log queue was full.', logs.dropped_records, kind='counter'))
+
+# Prometheus scrape endpoint
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    if config.INGEST_MODE != 'writer':
+        return Response(metrics.REGISTRY.render(), mimetype=None, content_type=metrics.CONTENT_TYPE)
+    # Those of every worker and of the writer, gathered by the writer (see metrics.py)
+    collected = metrics.REGISTRY.collect()
+    try:
+        snapshots = writer_client.metrics(collected)
+    except WriterUnavailable as e:
+        log.warning('metrics_not_gathered', error=str(e))
+        snapshots = [(str(os.getpid()), collected)]
+    return Response(metrics.render_snapshots(snapshots), mimetype=None, content_type=metrics.CONTENT_TYPE)
+
 # Web interface routes (those need to be updated, OLD UI)
 @app.route('/')
 def home():
-    devices = get_device_ids()
+    devices = get_device_details()
     return render_template('index.html', devices=devices)
 
 @app.route('/device/<device_id>')
@@ -442,9 +705,101 @@ def device_data(device_id):
 
 @app.route('/api/devices')
 def get_devices():
+    # ?details=1 adds first / last seen and the per-sensor counts
+    if request.args.get('details', '0') not in ('0', 'false'):
+        return jsonify(get_device_details())
     devices = get_device_ids()
     return jsonify(devices)
 
+@app.route('/api/devices/<device_id>')
+def get_device(device_id):
+    details = get_device_details(device_id)
+    if not details:
+        return jsonify({'error': f"Unknown device '{device_id}'"}), 404
+    return jsonify(details[0])
+
+# What the device page shows in one response, read in a single transaction (see snapshot.py):
+# ?limit= readings per sensor (100), ?batches= recent batches (10)
+@app.route('/api/devices/<device_id>/snapshot')
+def get_device_snapshot(device_id):
+    try:
+        limit = int(request.args.get('limit', 100))
+        batch_limit = int(request.args.get('batches', 10))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    try:
+        snapshot = device_snapshot(get_db(), device_id, limit, batch_limit)
+        if snapshot is None:
+            return jsonify({'error': f"Unknown device '{device_id}'"}), 404
+        return jsonify(snapshot), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+# Server-Sent Events stream of the readings of a device as they are committed, see
+# livefeed.py. ?sensors=heartrate,gsr limits it to some sensors (all by default)
+@app.route('/api/devices/<device_id>/live')
+def device_live_feed(device_id):
+    sensors = [sensor for sensor in request.args.get('sensors', '').split(',') if sensor]
+    unknown = [sensor for sensor in sensors if sensor not in API_SENSORS]
+    if unknown:
+        return jsonify({'error': f"Unknown sensor '{unknown[0]}', expected one of {', '.join(API_SENSORS)}"}), 400
+    subscription = live_feed.subscribe(device_id, sensors)
+    _share_live_devices()
+    # The stream outlives the request, its slot is released once the server closes it
+    slot = g.pop('stream_slot', False)
+
+    def generate():
+        try:
+            # Sent right away so that the client knows it is subscribed
+            yield 'retry: 3000\n\n'
+            while True:
+                message = subscription.get(config.LIVE_FEED_KEEPALIVE_S)
+                yield message if message is not None else ': keepalive\n\n'
+        finally:
+            # Runs when the client disconnects and the server closes the generator
+            live_feed.unsubscribe(subscription)
+            _share_live_devices()
+
+    response = Response(generate(), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    if slot:
+        response.call_on_close(_stream_slots.release)
+    return response
+
+def _store_reading(table, row):
+    """
+    Store one reading of the single-reading endpoints, in a write transaction of its own.
+    Raises AdmissionRejected like _ingest_batch: over the device's rate, database
+    locked or writer unreachable.
+    """
+    device_id = row[0]
+    if config.INGEST_MODE == 'writer':
+        # Admitted and committed by the writer process, like the batches
+        try:
+            writer_client.store_readings(table, [row])
+        except WriterUnavailable as e:
+            raise _writer_unavailable(e)
+        readings_committed(device_id, table, [row])
+        return
+
+    admission.admit(device_id, 1)
+    conn = get_db()
+    c = conn.cursor()
+    try:
+        # Take the write lock up front: a read transaction upgraded to a write fails at
+        # once, without waiting, when another connection committed meanwhile
+        c.execute('BEGIN IMMEDIATE')
+        insert_readings(c, table, [row])
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        # busy_timeout ran out waiting for the write lock
+        if isinstance(e, sqlite3.OperationalError) and db.is_busy(e):
+            admission.refund(device_id, 1)
+            raise _database_busy(device_id)
+        raise
+    readings_committed(device_id, table, [row])
+
 # EXISTING API routes for health data (kept for backward compatibility)
 @app.route('/api/heartrate', methods=['POST'])
 def store_heartrate():
@@ -454,21 +809,25 @@ def store_heartrate():
         device_id = data.get('device_id', 'unknown')
         heart_rate = data.get('heart_rate')
         timestamp = data.get('timestamp', datetime.datetime.now().isoformat())
+        try:
+            ts_us = parse_timestamp_us(timestamp)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
         
         # Validate heart rate
         if not heart_rate or not isinstance(heart_rate, int):
             return jsonify({'error': 'Invalid heart rate value'}), 400
             
         # Store in database
-        conn = sqlite3.connect('health_data.db')
-        c = conn.cursor()
-        c.execute('INSERT INTO heartrates (device_id, heart_rate, timestamp) VALUES (?, ?, ?)',
-                  (device_id, heart_rate, timestamp))
-        conn.commit()
-        conn.close()
+        row = (device_id, heart_rate, timestamp, ts_us)
+        _store_reading('heartrates', row)
         
         return jsonify({'message': 'Heart rate recorded successfully'}), 201
         
+    except AdmissionRejected as e:
+        return _rejected_response(e)
+    except HTTPException:
+        raise
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -480,21 +839,25 @@ def store_skin_temperature():
         device_id = data.get('device_id', 'unknown')
         value = data.get('value')
         timestamp = data.get('timestamp', datetime.datetime.now().isoformat())
+        try:
+            ts_us = parse_timestamp_us(timestamp)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
         
         # Validate data
         if value is None or not isinstance(value, int):
             return jsonify({'error': 'Invalid skin temperature value'}), 400
             
         # Store in database
-        conn = sqlite3.connect('health_data.db')
-        c = conn.cursor()
-        c.execute('INSERT INTO skin_temperature (device_id, value, timestamp) VALUES (?, ?, ?)',
-                  (device_id, value, timestamp))
-        conn.commit()
-        conn.close()
+        row = (device_id, value, timestamp, ts_us)
+        _store_reading('skin_temperature', row)
         
         return jsonify({'message': 'Skin temperature recorded successfully'}), 201
         
+    except AdmissionRejected as e:
+        return _rejected_response(e)
+    except HTTPException:
+        raise
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -506,21 +869,25 @@ def store_gsr():
         device_id = data.get('device_id', 'unknown')
         value = data.get('value')
         timestamp = data.get('timestamp', datetime.datetime.now().isoformat())
+        try:
+            ts_us = parse_timestamp_us(timestamp)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
         
         # Validate data
         if value is None or not isinstance(value, int):
             return jsonify({'error': 'Invalid GSR value'}), 400
             
         # Store in database
-        conn = sqlite3.connect('health_data.db')
-        c = conn.cursor()
-        c.execute('INSERT INTO gsr (device_id, value, timestamp) VALUES (?, ?, ?)',
-                  (device_id, value, timestamp))
-        conn.commit()
-        conn.close()
+        row = (device_id, value, timestamp, ts_us)
+        _store_reading('gsr', row)
         
         return jsonify({'message': 'GSR recorded successfully'}), 201
         
+    except AdmissionRejected as e:
+        return _rejected_response(e)
+    except HTTPException:
+        raise
     except Exception as e:
         return jsonify({'error': str(e)}), 500
     
@@ -532,21 +899,25 @@ def store_light():
         device_id = data.get('device_id', 'unknown')
         value = data.get('value')
         timestamp = data.get('timestamp', datetime.datetime.now().isoformat())
+        try:
+            ts_us = parse_timestamp_us(timestamp)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
         
         # Validate data
         if value is None or not isinstance(value, int):
             return jsonify({'error': 'Invalid light value'}), 400
             
         # Store in database
-        conn = sqlite3.connect('health_data.db')
-        c = conn.cursor()
-        c.execute('INSERT INTO light (device_id, value, timestamp) VALUES (?, ?, ?)',
-                  (device_id, value, timestamp))
-        conn.commit()
-        conn.close()
+        row = (device_id, value, timestamp, ts_us)
+        _store_reading('light', row)
         
         return jsonify({'message': 'light recorded successfully'}), 201
         
+    except AdmissionRejected as e:
+        return _rejected_response(e)
+    except HTTPException:
+        raise
     except Exception as e:
         return jsonify({'error': str(e)}), 500
     
@@ -559,21 +930,25 @@ def store_ppg():
         device_id = data.get('device_id', 'unknown')
         value = data.get('value')
         timestamp = data.get('timestamp', datetime.datetime.now().isoformat())
+        try:
+            ts_us = parse_timestamp_us(timestamp)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
 
         # Validate data
         if value is None or not isinstance(value, int):
             return jsonify({'error': 'Invalid PPG value'}), 400
 
         # Store in database
-        conn = sqlite3.connect('health_data.db')
-        c = conn.cursor()
-        c.execute('INSERT INTO ppg (device_id, value, timestamp) VALUES (?, ?, ?)',
-                  (device_id, value, timestamp))
-        conn.commit()
-        conn.close()
+        row = (device_id, value, timestamp, ts_us)
+        _store_reading('ppg', row)
 
         return jsonify({'message': 'PPG recorded successfully'}), 201
 
+    except AdmissionRejected as e:
+        return _rejected_response(e)
+    except HTTPException:
+        raise
     except Exception as e:
         return jsonify({'error': str(e)}), 500
     
@@ -587,17 +962,21 @@ def store_accelerometer():
         y_value = data.get('y_value')
         z_value = data.get('z_value')
         timestamp = data.get('timestamp', datetime.datetime.now().isoformat())
+        try:
+            ts_us = parse_timestamp_us(timestamp)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
 
         # Store in database
-        conn = sqlite3.connect('health_data.db')
-        c = conn.cursor()
-        c.execute('INSERT INTO accelerometer (device_id, x_value, y_value, z_value, timestamp) VALUES (?, ?, ?, ?, ?)',
-                  (device_id, x_value, y_value, z_value, timestamp))
-        conn.commit()
-        conn.close()
+        row = (device_id, x_value, y_value, z_value, timestamp, ts_us)
+        _store_reading('accelerometer', row)
 
         return jsonify({'message': 'Accelerometer data recorded successfully'}), 201
 
+    except AdmissionRejected as e:
+        return _rejected_response(e)
+    except HTTPException:
+        raise
     except Exception as e:
         return jsonify({'error': str(e)}), 500
     
@@ -611,46 +990,105 @@ def store_gyroscope():
         y_value = data.get('y_value')
         z_value = data.get('z_value')
         timestamp = data.get('timestamp', datetime.datetime.now().isoformat())
+        try:
+            ts_us = parse_timestamp_us(timestamp)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
 
         # Store in database
-        conn = sqlite3.connect('health_data.db')
-        c = conn.cursor()
-        c.execute('INSERT INTO gyroscope (device_id, x_value, y_value, z_value, timestamp) VALUES (?, ?, ?, ?, ?)',
-                  (device_id, x_value, y_value, z_value, timestamp))
-        conn.commit()
-        conn.close()
+        row = (device_id, x_value, y_value, z_value, timestamp, ts_us)
+        _store_reading('gyroscope', row)
 
         return jsonify({'message': 'Gyroscope data recorded successfully'}), 201
 
+    except AdmissionRejected as e:
+        return _rejected_response(e)
+    except HTTPException:
+        raise
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+# Shared by the sensor GET endpoints. Without parameters other than device_id and
+# limit they return the newest readings as before. Otherwise:
+#   since / until   ISO timestamps, readings with since <= timestamp < until
+#   order           'desc' (default) or 'asc'
+#   cursor          the X-Next-Cursor header of the previous page: continue after it
+#   format          'json' (default, pages of limit readings), 'ndjson' or 'csv'
+#                   (streamed, all readings of the range unless limit is given)
+# Readings are read through a keyset cursor on (ts_us, id), see readings.py, so
+# memory stays constant whatever the range size.
+READING_QUERY_ARGS = ('since', 'until', 'order', 'cursor', 'format')
+STREAM_FORMATS = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv'}
+
+def sensor_readings_response(table):
+    # Streamed formats are never cached, they can be of any size
+    if request.args.get('format', 'json') in STREAM_FORMATS:
+        return _sensor_readings(table)
+    return cached_response(table, lambda: _sensor_readings(table))
+
+def _sensor_readings(table):
+    device_id = request.args.get('device_id', None)
+    conn = get_db()
+    if not any(arg in request.args for arg in READING_QUERY_ARGS):
+        # Newest readings across the time partitions, see partitions.py
+        results = latest_readings(conn, table, device_id, request.args.get('limit', 100))
+        return jsonify(results), 200
+
+    response_format = request.args.get('format', 'json')
+    order = request.args.get('order', 'desc')
+    try:
+        since_us = parse_timestamp_us(request.args['since']) if 'since' in request.args else None
+        until_us = parse_timestamp_us(request.args['until']) if 'until' in request.args else None
+        after = decode_cursor(request.args['cursor']) if 'cursor' in request.args else None
+        limit = request.args.get('limit', None if response_format in STREAM_FORMATS else 100)
+        limit = int(limit) if limit is not None else None
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if order not in ('asc', 'desc'):
+        return jsonify({'error': "order must be 'asc' or 'desc'"}), 400
+    if limit is not None and limit < 1:
+        return jsonify({'error': 'limit must be at least 1'}), 400
+    if response_format not in ('json',) + tuple(STREAM_FORMATS):
+        return jsonify({'error': "format must be 'json', 'ndjson' or 'csv'"}), 400
+
+    readings = iter_readings(conn, table, device_id, since_us, until_us, after, descending=order == 'desc')
+
+    if response_format == 'json':
+        # One reading more than the page tells whether there is a next page
+        page = list(itertools.islice(readings, limit + 1))
+        response = jsonify(page[:limit])
+        if len(page) > limit:
+            response.headers['X-Next-Cursor'] = encode_cursor(page[limit - 1])
+        return response, 200
+
+    if limit is not None:
+        readings = itertools.islice(readings, limit)
+    columns = reading_columns(table)
+
+    def generate():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        if response_format == 'csv':
+            writer.writerow(columns)
+        for reading in readings:
+            if response_format == 'csv':
+                writer.writerow([reading[column] for column in columns])
+            else:
+                buffer.write(json.dumps({column: reading[column] for column in columns}) + '\n')
+            # Sent in pieces of about 64 KB
+            if buffer.tell() >= 65536:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue()
+
+    return Response(stream_with_context(generate()), mimetype=STREAM_FORMATS[response_format])
+
 @app.route('/api/heartrate', methods=['GET'])
 def get_heartrates():
     try:
-        # Get parameters
-        device_id = request.args.get('device_id', None)
-        limit = request.args.get('limit', 100)
-        
-        conn = sqlite3.connect('health_data.db')
-        conn.row_factory = sqlite3.Row
-        c = conn.cursor()
-        
-        query = 'SELECT * FROM heartrates'
-        params = []
-        
-        if device_id:
-            query += ' WHERE device_id = ?'
-            params.append(device_id)
-            
-        query += ' ORDER BY timestamp DESC LIMIT ?'
-        params.append(limit)
-        
-        c.execute(query, params)
-        results = [dict(row) for row in c.fetchall()]
-        conn.close()
-        
-        return jsonify(results), 200
+        # device_id, limit, since, until, order, cursor and format, see above
+        return sensor_readings_response('heartrates')
         
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -658,29 +1096,8 @@ def get_heartrates():
 @app.route('/api/skin_temperature', methods=['GET'])
 def get_skin_temperature():
     try:
-        # Get parameters
-        device_id = request.args.get('device_id', None)
-        limit = request.args.get('limit', 100)
-        
-        conn = sqlite3.connect('health_data.db')
-        conn.row_factory = sqlite3.Row
-        c = conn.cursor()
-        
-        query = 'SELECT * FROM skin_temperature'
-        params = []
-        
-        if device_id:
-            query += ' WHERE device_id = ?'
-            params.append(device_id)
-            
-        query += ' ORDER BY timestamp DESC LIMIT ?'
-        params.append(limit)
-        
-        c.execute(query, params)
-        results = [dict(row) for row in c.fetchall()]
-        conn.close()
-        
-        return jsonify(results), 200
+        # device_id, limit, since, until, order, cursor and format, see above
+        return sensor_readings_response('skin_temperature')
         
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -688,29 +1105,8 @@ def get_skin_temperature():
 @app.route('/api/gsr', methods=['GET'])
 def get_gsr():
     try:
-        # Get parameters
-        device_id = request.args.get('device_id', None)
-        limit = request.args.get('limit', 100)
-        
-        conn = sqlite3.connect('health_data.db')
-        conn.row_factory = sqlite3.Row
-        c = conn.cursor()
-        
-        query = 'SELECT * FROM gsr'
-        params = []
-        
-        if device_id:
-            query += ' WHERE device_id = ?'
-            params.append(device_id)
-            
-        query += ' ORDER BY timestamp DESC LIMIT ?'
-        params.append(limit)
-        
-        c.execute(query, params)
-        results = [dict(row) for row in c.fetchall()]
-        conn.close()
-        
-        return jsonify(results), 200
+        # device_id, limit, since, until, order, cursor and format, see above
+        return sensor_readings_response('gsr')
         
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -718,29 +1114,8 @@ def get_gsr():
 @app.route('/api/light', methods=['GET'])
 def get_light():
     try:
-        # Get parameters
-        device_id = request.args.get('device_id', None)
-        limit = request.args.get('limit', 100)
-        
-        conn = sqlite3.connect('health_data.db')
-        conn.row_factory = sqlite3.Row
-        c = conn.cursor()
-        
-        query = 'SELECT * FROM light'
-        params = []
-        
-        if device_id:
-            query += ' WHERE device_id = ?'
-            params.append(device_id)
-            
-        query += ' ORDER BY timestamp DESC LIMIT ?'
-        params.append(limit)
-        
-        c.execute(query, params)
-        results = [dict(row) for row in c.fetchall()]
-        conn.close()
-        
-        return jsonify(results), 200
+        # device_id, limit, since, until, order, cursor and format, see above
+        return sensor_readings_response('light')
         
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -748,29 +1123,8 @@ def get_light():
 @app.route('/api/ppg', methods=['GET'])
 def get_ppg():
     try:
-        # Get parameters
-        device_id = request.args.get('device_id', None)
-        limit = request.args.get('limit', 100)
-        
-        conn = sqlite3.connect('health_data.db')
-        conn.row_factory = sqlite3.Row
-        c = conn.cursor()
-        
-        query = 'SELECT * FROM ppg'
-        params = []
-        
-        if device_id:
-            query += ' WHERE device_id = ?'
-            params.append(device_id)
-            
-        query += ' ORDER BY timestamp DESC LIMIT ?'
-        params.append(limit)
-        
-        c.execute(query, params)
-        results = [dict(row) for row in c.fetchall()]
-        conn.close()
-        
-        return jsonify(results), 200
+        # device_id, limit, since, until, order, cursor and format, see above
+        return sensor_readings_response('ppg')
         
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -778,29 +1132,8 @@ def get_ppg():
 @app.route('/api/accelerometer', methods=['GET'])
 def get_accelerometer():
     try:
-        # Get parameters
-        device_id = request.args.get('device_id', None)
-        limit = request.args.get('limit', 100)
-        
-        conn = sqlite3.connect('health_data.db')
-        conn.row_factory = sqlite3.Row
-        c = conn.cursor()
-        
-        query = 'SELECT * FROM accelerometer'
-        params = []
-        
-        if device_id:
-            query += ' WHERE device_id = ?'
-            params.append(device_id)
-            
-        query += ' ORDER BY timestamp DESC LIMIT ?'
-        params.append(limit)
-        
-        c.execute(query, params)
-        results = [dict(row) for row in c.fetchall()]
-        conn.close()
-        
-        return jsonify(results), 200
+        # device_id, limit, since, until, order, cursor and format, see above
+        return sensor_readings_response('accelerometer')
         
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -808,35 +1141,126 @@ def get_accelerometer():
 @app.route('/api/gyroscope', methods=['GET'])
 def get_gyroscope():
     try:
+        # device_id, limit, since, until, order, cursor and format, see above
+        return sensor_readings_response('gyroscope')
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+# Min / max / mean of a sensor over a time range, from the rollups (see rollups.py)
+@app.route('/api/rollups', methods=['GET'])
+def get_rollups():
+    try:
+        # Get parameters
+        device_id = request.args.get('device_id')
+        sensor = request.args.get('sensor', 'heartrate')
+        if not device_id:
+            return jsonify({'error': 'device_id is required'}), 400
+        if sensor not in API_SENSORS:
+            return jsonify({'error': f"Unknown sensor '{sensor}', expected one of {', '.join(API_SENSORS)}"}), 400
+        try:
+            end_us = parse_timestamp_us(request.args['end']) if 'end' in request.args else int(time.time() * 1_000_000)
+            start_us = parse_timestamp_us(request.args['start']) if 'start' in request.args \
+                else end_us - 24 * 3600 * 1_000_000
+            points = int(request.args.get('points', 500))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        if start_us >= end_us or points < 1:
+            return jsonify({'error': 'start must be before end and points at least 1'}), 400
+
+        conn = get_db()
+        resolution, step_us, series = rollup_series(conn, API_SENSORS[sensor], device_id, start_us, end_us, points)
+
+        return jsonify({
+            'device_id': device_id,
+            'sensor': sensor,
+            'resolution': resolution,
+            'step_ms': step_us // 1000,
+            # False while some readings of the range are not rolled up yet (rollup_backfill.py)
+            'complete': rollups_complete(conn, device_id, API_SENSORS[sensor], start_us, end_us),
+            'points': series
+        }), 200
+
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+# Several sensors of a device aligned to one time grid, as columns (see timeseries.py)
+@app.route('/api/timeseries', methods=['GET'])
+def get_timeseries():
+    try:
+        # Get parameters
+        device_id = request.args.get('device_id')
+        sensors = request.args.get('sensors', 'heartrate').split(',')
+        method = request.args.get('method', 'mean')
+        if not device_id:
+            return jsonify({'error': 'device_id is required'}), 400
+        unknown = [sensor for sensor in sensors if sensor not in API_SENSORS]
+        if unknown:
+            return jsonify({'error': f"Unknown sensors {', '.join(unknown)}, expected some of {', '.join(API_SENSORS)}"}), 400
+        try:
+            end_us = parse_timestamp_us(request.args['end']) if 'end' in request.args else int(time.time() * 1_000_000)
+            start_us = parse_timestamp_us(request.args['start']) if 'start' in request.args \
+                else end_us - 3600 * 1_000_000
+            step_us = parse_duration_us(request.args.get('step', '1s'))
+            tolerance_us = parse_duration_us(request.args['tolerance']) if 'tolerance' in request.args else None
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        if start_us >= end_us:
+            return jsonify({'error': 'start must be before end'}), 400
+        if (end_us - start_us) // step_us > config.TIMESERIES_MAX_POINTS:
+            return jsonify({'error': f'More than {config.TIMESERIES_MAX_POINTS} points, use a larger step'}), 400
+
+        conn = get_db()
+        tables = {sensor: API_SENSORS[sensor] for sensor in sensors}
+        try:
+            grid, channels, sources = aligned_series(conn, device_id, tables.values(), start_us, end_us, step_us,
+                                                     method, tolerance_us)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+        return jsonify(timeseries_response(device_id, tables, grid, channels, sources, step_us, method)), 200
+
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+# Readings of a sensor as one Parquet file, streamed a row group at a time (see export.py)
+@app.route('/api/export', methods=['GET'])
+def export_parquet():
+    try:
+        if export is None:
+            return jsonify({'error': 'Parquet export needs pyarrow'}), 501
         # Get parameters
         device_id = request.args.get('device_id', None)
-        limit = request.args.get('limit', 100)
-        
-        conn = sqlite3.connect('health_data.db')
-        conn.row_factory = sqlite3.Row
-        c = conn.cursor()
-        
-        query = 'SELECT * FROM gyroscope'
-        params = []
-        
-        if device_id:
-            query += ' WHERE device_id = ?'
-            params.append(device_id)
-            
-        query += ' ORDER BY timestamp DESC LIMIT ?'
-        params.append(limit)
-        
-        c.execute(query, params)
-        results = [dict(row) for row in c.fetchall()]
-        conn.close()
-        
-        return jsonify(results), 200
-        
+        sensor = request.args.get('sensor', None)
+        if sensor not in API_SENSORS:
+            return jsonify({'error': f"Unknown sensor '{sensor}', expected one of {', '.join(API_SENSORS)}"}), 400
+        try:
+            start_us = parse_timestamp_us(request.args['start']) if 'start' in request.args else None
+            end_us = parse_timestamp_us(request.args['end']) if 'end' in request.args else None
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+        conn = get_db()
+        body = export.stream_parquet(conn, API_SENSORS[sensor], device_id, start_us, end_us)
+
+        return Response(stream_with_context(body), mimetype=export.PARQUET_MIME_TYPE,
+                        headers={'Content-Disposition': f'attachment; filename="{sensor}.parquet"'})
+
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 # Run the server
 if __name__ == '__main__':
     print("Starting Health Data Server...")
-    print("  GET /api/batch/stats - for batch processing statistics")
-    app.run(host='192.168.0.98', port=5000, debug=True)
\ No newline at end of file
+    print("  GET /api/batch/stats - for batch processing statistics (?aggregate=1 for per device aggregates)")
+    print("  GET /api/cache/stats - for response cache hit/miss counters")
+    print("  GET /metrics - for Prometheus metrics (ingest stage timings, counters, database size)")
+    print("  GET /api/devices/<device_id>/snapshot - for everything the device page shows, in one request")
+    print("  GET /api/devices/<device_id>/live - for a Server-Sent Events feed of new readings")
+    print("  GET /api/rollups - for min/max/mean of a sensor over a time range")
+    print("  GET /api/timeseries - for several sensors of a device aligned to one time grid")
+    if export is not None:
+        print("  GET /api/export - for a Parquet file of a sensor's readings")
+    if sock is not None:
+        print("  WS  /api/stream - for continuous streaming ingest")
+    create_app().run(host=config.SERVER_HOST, port=config.SERVER_PORT, debug=config.SERVER_DEBUG == 'on')
\ No newline at end of file
@@ -0,0 +1,119 @@
+# batch_stats.py - Ingest health aggregated from the batch logs
+#
+# batch_aggregates groups the batches received in a time range by device and by time
+# bucket and reports, per bucket: the number of batches, readings per second, the
+# p50 / p95 / p99 of processing_time_ms and the longest gap between two consecutive
+# batches. Gaps longer than a threshold are also listed one by one, since a watch
+# that stops sending for minutes has usually lost its connection.
+#
+# Only the batches of the range are read, through the created_us indexes of
+# batch_logs (migration 7), so a monitoring page can poll it every few seconds.
+
+import numpy as np
+
+from timestamps import format_timestamp_us
+
+PERCENTILES = (50, 95, 99)
+
+# Largest number of buckets a range may be split into
+MAX_BUCKETS = 10_000
+
+
+def _group_stats(groups, records, processing_ms, gaps_us):
+    """
+    Statistics of every run of equal values of groups (rows sorted by group): first
+    row, number of batches, readings, processing_time_ms percentiles and longest gap.
+    """
+    starts = np.flatnonzero(np.r_[True, groups[1:] != groups[:-1]])
+    counts = np.diff(np.r_[starts, len(groups)])
+    # Processing times sorted inside every group, percentiles interpolated like np.percentile
+    ordered = processing_ms[np.lexsort((processing_ms, groups))]
+    percentiles = {}
+    for p in PERCENTILES:
+        position = (counts - 1) * (p / 100)
+        lower = np.floor(position).astype(np.int64)
+        low, high = ordered[starts + lower], ordered[starts + np.ceil(position).astype(np.int64)]
+        percentiles[f'p{p}'] = low + (high - low) * (position - lower)
+    return starts, counts, np.add.reduceat(records, starts), percentiles, np.maximum.reduceat(gaps_us, starts)
+
+
+def _summary(i, stats, seconds):
+    _, counts, rows, percentiles, max_gaps = stats
+    return {
+        'batches': int(counts[i]),
+        'rows': int(rows[i]),
+        'rows_per_sec': round(float(rows[i]) / seconds, 3),
+        'processing_time_ms': {name: round(float(values[i]), 1) for name, values in percentiles.items()},
+        # Gaps are -1 for the first batch of a device in the range
+        'max_gap_s': round(float(max_gaps[i]) / 1_000_000, 3) if max_gaps[i] >= 0 else None,
+    }
+
+
+def batch_aggregates(conn, since_us, until_us, bucket_us, gap_us, device_id=None):
+    """
+    Batches received in [since_us, until_us), per device (sorted by id) and per bucket
+    of bucket_us starting at since_us. Buckets without batches are left out. Gaps
+    are measured between batches of the range, the time since the last one is
+    given separately as since_last_batch_s.
+    """
+    if bucket_us <= 0 or until_us <= since_us:
+        raise ValueError('The range and the bucket must not be empty')
+    if -(-(until_us - since_us) // bucket_us) > MAX_BUCKETS:
+        raise ValueError(f'More than {MAX_BUCKETS} buckets, use a larger bucket or a shorter range')
+
+    query = ('SELECT device_id, created_us, total_records, processing_time_ms FROM batch_logs '
+             'WHERE created_us >= ? AND created_us < ?')
+    params = [since_us, until_us]
+    if device_id:
+        query += ' AND device_id = ?'
+        params.append(device_id)
+    # Plain tuples, and in the order of the created_us index: no sort in SQLite
+    cursor = conn.cursor()
+    cursor.row_factory = None
+    rows = cursor.execute(query + ' ORDER BY created_us', params).fetchall()
+    if not rows:
+        return []
+
+    device_ids, created_us, records, processing_ms = zip(*rows)
+    names = sorted(set(device_ids))
+    numbers = {name: number for number, name in enumerate(names)}
+    devices = np.array([numbers[name] for name in device_ids], dtype=np.int64)
+    # By device, then by time
+    order = np.lexsort((np.array(created_us, dtype=np.int64), devices))
+    devices = devices[order]
+    created_us = np.array(created_us, dtype=np.int64)[order]
+    records = np.array(records, dtype=np.float64)[order]
+    processing_ms = np.array(processing_ms, dtype=np.float64)[order]
+    # Gap between every batch and the previous one of its device (-1 for the first)
+    gaps_us = np.r_[-1, np.diff(created_us)]
+    gaps_us[np.r_[True, devices[1:] != devices[:-1]]] = -1
+
+    n_buckets = -(-(until_us - since_us) // bucket_us)
+    bins = (created_us - since_us) // bucket_us
+    by_device = _group_stats(devices, records, processing_ms, gaps_us)
+    by_bucket = _group_stats(devices * n_buckets + bins, records, processing_ms, gaps_us)
+    bucket_devices = devices[by_bucket[0]]
+    long_gaps = np.flatnonzero(gaps_us > gap_us)
+
+    results = []
+    for i, (first, count) in enumerate(zip(*by_device[:2])):
+        last_us = int(created_us[first + count - 1])
+        buckets = []
+        for j in np.flatnonzero(bucket_devices == devices[first]):
+            bucket_start = since_us + int(bins[by_bucket[0][j]]) * bucket_us
+            seconds = (min(bucket_start + bucket_us, until_us) - bucket_start) / 1_000_000
+            buckets.append(dict(ts_us=bucket_start, timestamp=format_timestamp_us(bucket_start),
+                                **_summary(j, by_bucket, seconds)))
+        results.append(dict(
+            device_id=names[devices[first]],
+            **_summary(i, by_device, (until_us - since_us) / 1_000_000),
+            last_batch=format_timestamp_us(last_us),
+            since_last_batch_s=round((until_us - last_us) / 1_000_000, 3),
+            buckets=buckets,
+            gaps=[{
+                'from': format_timestamp_us(int(created_us[k - 1])),
+                'to': format_timestamp_us(int(created_us[k])),
+                'duration_s': round(float(gaps_us[k]) / 1_000_000, 3),
+            } for k in long_gaps[(long_gaps >= first) & (long_gaps < first + count)]],
+        ))
+    return results
@@ -0,0 +1,124 @@
+# chunk_storage.py - Disk usage and bulk read time of row vs chunked storage
+#
+# Stores the same accelerometer readings (--devices watches at 50 Hz for --hours,
+# arriving in batches of --batch-seconds like the watches send them) once as rows and
+# once as chunks (CHUNKED_STORAGE=on), then compares the database sizes and the time
+# to read one device's day back into numpy arrays.
+#
+# Usage (from backend_server/):  python benchmarks/chunk_storage.py [--devices 10] [--hours 2]
+
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import config  # noqa: E402
+import db  # noqa: E402
+from chunks import iter_chunks  # noqa: E402
+from ingest import insert_readings  # noqa: E402
+from migrations import migrate  # noqa: E402
+from partitions import DAY_US, table_partitions  # noqa: E402
+from timestamps import format_timestamp_us  # noqa: E402
+
+START_US = 1735689600 * 1_000_000  # 2025-01-01
+STEP_US = 20_000  # 50 Hz
+
+
+def fill(path, chunked, devices, hours, batch_seconds):
+    config.CHUNKED_STORAGE = 'on' if chunked else 'off'
+    conn = db.connect(path)
+    migrate(conn)
+    rng = random.Random(1)
+    samples = 0
+    started = time.perf_counter()
+    per_batch = batch_seconds * 1_000_000 // STEP_US
+    for batch_start in range(START_US, START_US + hours * 3_600_000_000, batch_seconds * 1_000_000):
+        conn.execute('BEGIN')
+        c = conn.cursor()
+        for device_id in devices:
+            rows = []
+            for i in range(per_batch):
+                ts_us = batch_start + i * STEP_US + rng.randrange(-500, 500)
+                rows.append((device_id, rng.gauss(0, 1), rng.gauss(0, 1), rng.gauss(9.81, 0.1),
+                             format_timestamp_us(ts_us), ts_us))
+            insert_readings(c, 'accelerometer', rows)
+            samples += len(rows)
+        conn.commit()
+    elapsed = time.perf_counter() - started
+    conn.execute('VACUUM')
+    conn.close()
+    return samples, elapsed
+
+
+def read_rows(conn, device_id):
+    ts, xyz = [], []
+    for name, _, _ in table_partitions(conn, 'accelerometer', START_US, START_US + DAY_US):
+        found = conn.execute(
+            f'SELECT ts_us, x_value, y_value, z_value FROM {name} '
+            'WHERE device_id = ? AND ts_us >= ? AND ts_us < ? ORDER BY ts_us',
+            (device_id, START_US, START_US + DAY_US)
+        ).fetchall()
+        ts.append(np.array([row[0] for row in found], dtype=np.int64))
+        xyz.append(np.array([row[1:] for row in found], dtype=np.float64).reshape(-1, 3))
+    return np.concatenate(ts), np.concatenate(xyz)
+
+
+def read_chunks(conn, device_id):
+    ts, xyz = [], []
+    for _, ts_us, columns in iter_chunks(conn, 'accelerometer', device_id, START_US, START_US + DAY_US):
+        ts.append(ts_us)
+        xyz.append(np.column_stack(columns))
+    return np.concatenate(ts), np.concatenate(xyz)
+
+
+def time_reads(path, read, devices, n):
+    conn = db.connect(path)
+    latencies = []
+    count = 0
+    for _ in range(n):
+        started = time.perf_counter()
+        ts_us, _ = read(conn, random.choice(devices))
+        latencies.append(time.perf_counter() - started)
+        count = len(ts_us)
+    conn.close()
+    return sorted(latencies)[len(latencies) // 2], count
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Row vs chunked storage of accelerometer readings')
+    parser.add_argument('--devices', type=int, default=10)
+    parser.add_argument('--hours', type=int, default=2, help='hours of 50 Hz readings per device')
+    parser.add_argument('--batch-seconds', type=int, default=10, help='seconds of readings per watch batch')
+    parser.add_argument('--reads', type=int, default=5, help='bulk reads timed per storage mode')
+    parser.add_argument('--workdir', default=None)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='chunk_storage_', dir=args.workdir)
+    devices = [f'bench-watch-{i}' for i in range(args.devices)]
+    results = {}
+    try:
+        for mode, chunked, read in (('rows', False, read_rows), ('chunks', True, read_chunks)):
+            path = os.path.join(workdir, f'{mode}.db')
+            samples, elapsed = fill(path, chunked, devices, args.hours, args.batch_seconds)
+            size = os.path.getsize(path)
+            read_s, count = time_reads(path, read, devices, args.reads)
+            results[mode] = (size, read_s)
+            print(f"  {mode:7s} {samples:,} samples in {elapsed:6.1f} s   "
+                  f"{size / 2**20:8.1f} MiB ({size / samples:5.1f} B/sample)   "
+                  f"read one device's day ({count:,} samples): {read_s * 1000:8.1f} ms")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print(f"\n  chunks: {results['rows'][0] / results['chunks'][0]:.1f}x less disk, "
+          f"{results['rows'][1] / results['chunks'][1]:.1f}x faster bulk reads")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+# dashboard_queries.py - Latency of the dashboard queries on a large accelerometer table,
+# before and after the device/time indexes of migration 2
+#
+# Fills a fresh database at schema version 1 (tables only) with --rows accelerometer
+# readings spread over --devices watches, times the GET /api/accelerometer query,
+# applies the remaining migrations and times it again.
+#
+# Usage (from backend_server/):  python benchmarks/dashboard_queries.py [--rows 50000000] [--queries 50]
+#
+# 50M rows need about 4 GB of disk and take a while to generate, --rows 5000000
+# shows the same picture faster (the unindexed query grows linearly with the table).
+
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import db  # noqa: E402
+from ingest import INSERT_STATEMENTS  # noqa: E402
+from migrations import LATEST_VERSION, migrate  # noqa: E402
+
+QUERIES = {
+    'latest 100 of one device': 'SELECT * FROM accelerometer WHERE device_id = ? ORDER BY ts_us DESC LIMIT 100',
+    'latest 1000 of one device': 'SELECT * FROM accelerometer WHERE device_id = ? ORDER BY ts_us DESC LIMIT 1000',
+}
+
+START_US = 1735689600 * 1_000_000  # 2025-01-01
+
+
+def fill(conn, rows, devices, chunk=200_000):
+    # ~50 Hz per device, interleaved like batches arriving from many watches
+    step_us = 20_000
+    started = time.perf_counter()
+    for offset in range(0, rows, chunk):
+        conn.execute('BEGIN')
+        conn.executemany(INSERT_STATEMENTS['accelerometer'], (
+            (devices[i % len(devices)], random.random(), random.random(), 9.81,
+             time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime((START_US + i // len(devices) * step_us) // 1_000_000)),
+             START_US + i // len(devices) * step_us)
+            for i in range(offset, min(rows, offset + chunk))
+        ))
+        conn.commit()
+        print(f"\r  inserted {min(rows, offset + chunk):,} / {rows:,} rows", end='', flush=True)
+    print(f"  ({time.perf_counter() - started:.1f} s)")
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def time_queries(conn, devices, n):
+    for name, query in QUERIES.items():
+        plan = ' / '.join(row[3] for row in conn.execute('EXPLAIN QUERY PLAN ' + query, (devices[0],)))
+        latencies = []
+        for _ in range(n):
+            started = time.perf_counter()
+            conn.execute(query, (random.choice(devices),)).fetchall()
+            latencies.append(time.perf_counter() - started)
+        print(f"  {name:28s} p50 {percentile(latencies, 50) * 1000:9.2f} ms   "
+              f"p95 {percentile(latencies, 95) * 1000:9.2f} ms   [{plan}]")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Dashboard query latency with and without the device/time indexes')
+    parser.add_argument('--rows', type=int, default=50_000_000)
+    parser.add_argument('--devices', type=int, default=20)
+    parser.add_argument('--queries', type=int, default=50, help='executions of each query per phase')
+    parser.add_argument('--workdir', default=None, help='directory for the database (needs several GB for 50M rows)')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='dashboard_queries_', dir=args.workdir)
+    devices = [f'bench-watch-{i}' for i in range(args.devices)]
+    conn = db.connect(os.path.join(workdir, 'bench.db'))
+    try:
+        migrate(conn, target=1)
+        fill(conn, args.rows, devices)
+
+        print(f"\n[schema version 1, no indexes]")
+        time_queries(conn, devices, args.queries)
+
+        started = time.perf_counter()
+        migrate(conn)
+        print(f"  (migrations up to version {LATEST_VERSION} took {time.perf_counter() - started:.1f} s)")
+
+        print(f"\n[schema version {LATEST_VERSION}, (device_id, ts_us) indexes]")
+        time_queries(conn, devices, args.queries)
+    finally:
+        conn.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,161 @@
+# db_mixed_load.py - Mixed read/write load on the database layer, before and after pooling/WAL
+#
+# Runs writer threads inserting /api/batch sized transactions next to reader threads
+# running the dashboard query, twice:
+#   legacy - a new connection per operation in the default rollback-journal mode
+#            (what every route did before db.py)
+#   pooled - connections from db.ConnectionPool in WAL mode with the tuned pragmas
+#
+# Usage (from backend_server/):  python benchmarks/db_mixed_load.py [--seconds 10] [--writers 4] [--readers 8]
+
+import argparse
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+_workdir = tempfile.mkdtemp(prefix='db_mixed_load_')
+os.environ['DATABASE_PATH'] = os.path.join(_workdir, 'import.db')
+os.environ.setdefault('INGEST_MODE', 'sync')
+
+import config  # noqa: E402
+import db  # noqa: E402
+import app as server  # noqa: E402
+from ingest import INSERT_STATEMENTS  # noqa: E402
+from timestamps import parse_timestamp_us  # noqa: E402
+
+DEVICES = [f'bench-watch-{i}' for i in range(10)]
+READ_QUERY = 'SELECT * FROM heartrates WHERE device_id = ? ORDER BY ts_us DESC LIMIT 100'
+
+
+def create_database(path, wal):
+    config.DATABASE_PATH = path
+    server.init_db()
+    conn = sqlite3.connect(path)
+    if not wal:
+        conn.execute('PRAGMA journal_mode=DELETE')
+    timestamps = (f'2025-01-01T00:{i // 60 % 60:02d}:{i % 60:02d}.{i % 1000:03d}' for i in range(50000))
+    conn.executemany(INSERT_STATEMENTS['heartrates'], (
+        (random.choice(DEVICES), random.randint(50, 180), timestamp, parse_timestamp_us(timestamp))
+        for timestamp in timestamps
+    ))
+    conn.commit()
+    conn.close()
+
+
+def batch_rows(device_id, n):
+    now = time.strftime('%Y-%m-%dT%H:%M:%S.000')
+    now_us = parse_timestamp_us(now)
+    return (
+        [(device_id, random.randint(50, 180), now, now_us) for _ in range(10)],
+        [(device_id, random.random(), random.random(), 9.81, now, now_us) for _ in range(n)],
+    )
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def run(mode, path, seconds, writers, readers, motion_rows):
+    if mode == 'pooled':
+        pool = db.ConnectionPool(path, max_idle=writers + readers)
+
+        def acquire():
+            return pool.acquire()
+
+        def release(conn):
+            pool.release(conn)
+    else:
+        def acquire():
+            return sqlite3.connect(path)
+
+        def release(conn):
+            conn.close()
+
+    stop = threading.Event()
+    lock = threading.Lock()
+    write_latencies, read_latencies = [], []
+    errors = {'write': 0, 'read': 0}
+
+    def writer():
+        while not stop.is_set():
+            hr, motion = batch_rows(random.choice(DEVICES), motion_rows)
+            started = time.perf_counter()
+            conn = acquire()
+            try:
+                c = conn.cursor()
+                c.execute('BEGIN TRANSACTION')
+                c.executemany(INSERT_STATEMENTS['heartrates'], hr)
+                c.executemany(INSERT_STATEMENTS['accelerometer'], motion)
+                conn.commit()
+                elapsed = time.perf_counter() - started
+                with lock:
+                    write_latencies.append(elapsed)
+            except sqlite3.OperationalError:
+                conn.rollback()
+                with lock:
+                    errors['write'] += 1
+            finally:
+                release(conn)
+
+    def reader():
+        while not stop.is_set():
+            started = time.perf_counter()
+            conn = acquire()
+            try:
+                conn.execute(READ_QUERY, (random.choice(DEVICES),)).fetchall()
+                elapsed = time.perf_counter() - started
+                with lock:
+                    read_latencies.append(elapsed)
+            except sqlite3.OperationalError:
+                with lock:
+                    errors['read'] += 1
+            finally:
+                release(conn)
+
+    threads = [threading.Thread(target=writer) for _ in range(writers)]
+    threads += [threading.Thread(target=reader) for _ in range(readers)]
+    for thread in threads:
+        thread.start()
+    time.sleep(seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    print(f"\n[{mode}]")
+    print(f"  writes: {len(write_latencies) / seconds:8.1f} batches/s   "
+          f"p50 {percentile(write_latencies, 50) * 1000:7.2f} ms   "
+          f"p95 {percentile(write_latencies, 95) * 1000:7.2f} ms   "
+          f"p99 {percentile(write_latencies, 99) * 1000:7.2f} ms   errors {errors['write']}")
+    print(f"  reads:  {len(read_latencies) / seconds:8.1f} queries/s   "
+          f"p50 {percentile(read_latencies, 50) * 1000:7.2f} ms   "
+          f"p95 {percentile(read_latencies, 95) * 1000:7.2f} ms   "
+          f"p99 {percentile(read_latencies, 99) * 1000:7.2f} ms   errors {errors['read']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Mixed read/write load, legacy vs pooled WAL connections')
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--writers', type=int, default=4)
+    parser.add_argument('--readers', type=int, default=8)
+    parser.add_argument('--motion-rows', type=int, default=300, help='accelerometer rows per write batch')
+    args = parser.parse_args()
+
+    for mode, wal in (('legacy', False), ('pooled', True)):
+        path = os.path.join(_workdir, f'{mode}.db')
+        create_database(path, wal)
+        run(mode, path, args.seconds, args.writers, args.readers, args.motion_rows)
+    shutil.rmtree(_workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+# ingest_logging.py - /api/batch latency with the different ways of writing the server logs
+#
+# Runs the app in-process on a scratch database and has --watches threads post small
+# batches (the case where a log line per batch costs the most relative to the insert)
+# for --seconds with every log setting:
+#   every  DEBUG, nothing sampled, written by the request thread: a line per sensor table
+#          and per batch, like the print() calls the server used to make
+#   sync   INFO (a line per batch) written by the request thread
+#   async  INFO written by the listener thread, batch_processed sampled at --sample
+# The log lines go to a stream that takes --write-delay-us per write, to stand for a
+# terminal or a pipe to a slow log collector (0 writes to /dev/null).
+#
+# Batches are stored by the request threads (INGEST_MODE=sync, --ingest-mode), so that
+# batch_processed is logged where the latency is measured, without admission limits.
+# Latencies are those of the stored batches, failed requests are reported apart.
+#
+# Usage (from backend_server/):  python benchmarks/ingest_logging.py [--watches 8] [--write-delay-us 200]
+
+import argparse
+import collections
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from watch_fleet import WatchSimulator, percentile  # noqa: E402
+
+# A watch sending one second of a few sensors per batch, 15 readings
+RATES = {'heartrates': 1, 'skin_temperature': 1, 'gsr': 1, 'light': 1, 'ppg': 1,
+         'accelerometer': 5, 'gyroscope': 5}
+
+MODES = ('every', 'sync', 'async')
+
+
+class SlowStream:
+    """Writes to /dev/null, waiting delay_s per write (the GIL is released, as in a blocking write)."""
+
+    def __init__(self, delay_s):
+        self.delay_s = delay_s
+        self.file = open(os.devnull, 'w')
+
+    def write(self, text):
+        if self.delay_s:
+            time.sleep(self.delay_s)
+        return self.file.write(text)
+
+    def flush(self):
+        self.file.flush()
+
+
+def run(app, mode, args, stream):
+    import logs
+    if mode == 'every':
+        logs.configure(level='DEBUG', sampling='', rate_limit=0, asynchronous=False, stream=stream)
+    elif mode == 'sync':
+        logs.configure(level='INFO', sampling='', rate_limit=0, asynchronous=False, stream=stream)
+    else:
+        logs.configure(level='INFO', sampling={'batch_processed': args.sample}, asynchronous=True, stream=stream)
+
+    latencies = []
+    errors = collections.Counter()
+    lock = threading.Lock()
+    stop = threading.Event()
+
+    def watch(index):
+        client = app.test_client()
+        simulator = WatchSimulator(f'{mode}-watch-{index:03d}', RATES, 1)
+        start_ms = 1735689600000 + index
+        mine, failed = [], collections.Counter()
+        while not stop.is_set():
+            body, content_type, _ = simulator.batch(start_ms, 'json')
+            started = time.perf_counter()
+            response = client.post('/api/batch', data=body, content_type=content_type)
+            if response.status_code in (201, 202):
+                mine.append(time.perf_counter() - started)
+            else:
+                failed[response.status_code] += 1
+            start_ms += 1000
+        with lock:
+            latencies.extend(mine)
+            errors.update(failed)
+
+    threads = [threading.Thread(target=watch, args=(i,)) for i in range(args.watches)]
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    time.sleep(args.seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+    logs.shutdown()
+
+    latencies.sort()
+    ms = [percentile(latencies, p) * 1000 for p in (50, 95, 99)] if latencies else [float('nan')] * 3
+    print(f"{mode:6s} {len(latencies) / elapsed:8.1f} batches/s   "
+          f"p50 {ms[0]:6.2f} ms   p95 {ms[1]:6.2f} ms   p99 {ms[2]:6.2f} ms", flush=True)
+    if errors:
+        print(f"       failed: {', '.join(f'{count} x {status}' for status, count in sorted(errors.items()))}",
+              flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare /api/batch latency with synchronous and queued logging')
+    parser.add_argument('--watches', type=int, default=8)
+    parser.add_argument('--seconds', type=float, default=10, help='per mode')
+    parser.add_argument('--write-delay-us', type=float, default=200, help='time taken by every log write')
+    parser.add_argument('--sample', type=float, default=0.1, help='share of batch_processed lines kept (async)')
+    parser.add_argument('--modes', default=','.join(MODES))
+    parser.add_argument('--ingest-mode', default='sync', choices=('sync', 'queued'),
+                        help='sync stores (and logs) batches in the request threads')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='ingest-logging-')
+    os.environ['DATABASE_PATH'] = os.path.join(workdir, 'logging.db')
+    os.environ['INGEST_MODE'] = args.ingest_mode
+    # Watches post as fast as they can, far above the per device rate limit
+    os.environ['INGEST_DEVICE_ROWS_PER_S'] = '0'
+    cwd = os.getcwd()
+    # app.py creates templates/ next to where it runs
+    os.chdir(workdir)
+    try:
+        from app import create_app
+        app = create_app()
+        stream = SlowStream(args.write_delay_us / 1_000_000)
+        print(f"{args.watches} watches, {args.ingest_mode} ingest, {args.write_delay_us:g} us per log write, "
+              f"{args.seconds:g} s per mode")
+        for mode in args.modes.split(','):
+            run(app, mode, args, stream)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
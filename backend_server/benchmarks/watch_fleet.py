@@ -0,0 +1,347 @@
+# watch_fleet.py - Load generator simulating a fleet of watches sending batches
+#
+# Every simulated watch behaves like MainActivity.sendBatchedDataToServer: it buffers
+# readings for --interval seconds (BATCH_SEND_INTERVAL, 10 s on the watch) and sends
+# them as one /api/batch payload. Watches start at random offsets within the interval,
+# as real devices do. The run reports requests/s, rows/s, latency percentiles and
+# errors, so ingest changes can be compared on the same load.
+#
+# Against a running server:
+#   python benchmarks/watch_fleet.py --url http://127.0.0.1:5000 --watches 200 --seconds 60
+# Or let the benchmark start one on a scratch database (server settings come from the
+# environment, e.g. INGEST_MODE=queued):
+#   python benchmarks/watch_fleet.py --spawn-server --watches 200 --seconds 60
+# --workers N spawns gunicorn with N workers instead (gunicorn.conf.py, INGEST_MODE=writer
+# unless set otherwise).
+#
+# Payload options: --format json|columnar, --gzip, --keep-alive (the watch opens a
+# new connection per batch), --transport ws (one /api/stream frame per batch).
+#
+# --backlog-watches N adds N watches catching up after being offline: they send
+# --backlog-seconds of readings per batch, back to back, waiting the Retry-After of
+# 429/503 answers. They are reported apart, the fleet's latency is what admission
+# control (admission.py) has to keep bounded.
+
+import argparse
+import functools
+import gzip
+import http.client
+import json
+import math
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from columnar import COLUMNAR_MIME_TYPE, encode_columnar_batch  # noqa: E402
+
+SERVER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+
+@functools.lru_cache(maxsize=4096)
+def _local_second(epoch_s):
+    return time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(epoch_s))
+
+
+def iso(epoch_ms):
+    # The watch's SimpleDateFormat("yyyy-MM-dd'T'HH:mm:ss.SSS"), local time
+    return f'{_local_second(epoch_ms // 1000)}.{epoch_ms % 1000:03d}'
+
+
+def sample_times(start_ms, interval_s, hz):
+    count = int(interval_s * hz)
+    return [start_ms + int(i * 1000 / hz) for i in range(count)]
+
+
+class WatchSimulator:
+    """Synthetic readings of one watch at the configured sensor rates."""
+
+    def __init__(self, device_id, rates, interval_s):
+        self.device_id = device_id
+        self.rates = rates
+        self.interval_s = interval_s
+        self.heart_rate = random.randint(60, 90)
+
+    def readings(self, start_ms):
+        # (stream type, timestamps, columns) for every sensor with a non-zero rate
+        streams = {}
+        if self.rates['heartrates']:
+            times = sample_times(start_ms, self.interval_s, self.rates['heartrates'])
+            self.heart_rate = max(50, min(180, self.heart_rate + random.randint(-2, 2)))
+            streams['heartrates'] = (times, [self.heart_rate] * len(times))
+        for sensor, low, high in (('skin_temperature', 30, 36), ('gsr', 0, 1000),
+                                  ('light', 0, 2000), ('ppg', 0, 4096)):
+            if self.rates[sensor]:
+                times = sample_times(start_ms, self.interval_s, self.rates[sensor])
+                streams[sensor] = (times, [random.randint(low, high) for _ in times])
+        for sensor in ('accelerometer', 'gyroscope'):
+            if self.rates[sensor]:
+                times = sample_times(start_ms, self.interval_s, self.rates[sensor])
+                streams[sensor] = (times,
+                                   [math.sin(t / 300) for t in times],
+                                   [math.cos(t / 300) for t in times],
+                                   [9.81 + random.gauss(0, 0.05) for _ in times])
+        return streams
+
+    def json_payload(self, start_ms, streams):
+        # Same layout as the JSONObject built by sendBatchedDataToServer
+        payload = {'device_id': self.device_id, 'batch_timestamp': iso(start_ms)}
+        if 'heartrates' in streams:
+            times, values = streams['heartrates']
+            payload['heart_rate_data'] = [{'heart_rate': v, 'timestamp': iso(t)} for t, v in zip(times, values)]
+        health = [{'data_type': sensor, 'value': v, 'timestamp': iso(t)}
+                  for sensor in ('skin_temperature', 'gsr', 'light', 'ppg') if sensor in streams
+                  for t, v in zip(*streams[sensor])]
+        if health:
+            payload['health_data'] = health
+        motion = [{'data_type': sensor, 'x_value': x, 'y_value': y, 'z_value': z, 'timestamp': iso(t)}
+                  for sensor in ('accelerometer', 'gyroscope') if sensor in streams
+                  for t, x, y, z in zip(*streams[sensor])]
+        if motion:
+            payload['motion_data'] = motion
+        return json.dumps(payload).encode('utf-8')
+
+    def batch(self, start_ms, body_format):
+        """Return (body, content type, number of readings) of the batch starting at start_ms."""
+        streams = self.readings(start_ms)
+        rows = sum(len(columns[0]) for columns in streams.values())
+        if body_format == 'columnar':
+            return encode_columnar_batch(self.device_id, iso(start_ms), streams), COLUMNAR_MIME_TYPE, rows
+        return self.json_payload(start_ms, streams), 'application/json', rows
+
+
+class Results:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.rows = 0
+        self.statuses = {}
+        self.late = 0
+
+    def record(self, status, latency, rows):
+        with self.lock:
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+            if isinstance(status, int) and 200 <= status < 300:
+                self.latencies.append(latency)
+                self.rows += rows
+
+
+def send_http(url, body, content_type, args, connection):
+    headers = {'Content-Type': content_type}
+    if args.gzip:
+        body = gzip.compress(body, compresslevel=6)
+        headers['Content-Encoding'] = 'gzip'
+    if connection is None:
+        connection = http.client.HTTPConnection(url.hostname, url.port or 80, timeout=args.timeout)
+    connection.request('POST', '/api/batch', body=body, headers=headers)
+    response = connection.getresponse()
+    response.read()
+    if not args.keep_alive:
+        connection.close()
+        connection = None
+    return response.status, response.getheader('Retry-After'), connection
+
+
+def run_watch(index, args, url, rates, results, stop):
+    watch = WatchSimulator(f'fleet-watch-{index:05d}', rates, args.interval)
+    connection = None
+    ws = None
+    if args.transport == 'ws':
+        import simple_websocket
+        ws_url = f"ws://{url.netloc}/api/stream?device_id={watch.device_id}"
+
+    # Staggered start, then one batch every interval on a fixed schedule
+    next_send = time.monotonic() + random.uniform(0, args.interval)
+    while not stop.wait(max(0.0, next_send - time.monotonic())):
+        if time.monotonic() - next_send > args.interval:
+            # The previous request took longer than the whole interval
+            with results.lock:
+                results.late += 1
+        next_send += args.interval
+
+        start_ms = int(time.time() * 1000) - int(args.interval * 1000)
+        body, content_type, rows = watch.batch(start_ms, args.format)
+        started = time.perf_counter()
+        try:
+            if args.transport == 'ws':
+                if ws is None:
+                    ws = simple_websocket.Client.connect(ws_url)
+                ws.send(body if args.format == 'columnar' else body.decode('utf-8'))
+                ack = json.loads(ws.receive(timeout=args.timeout) or '{}')
+                status = {'stored': 201, 'queued': 202, 'duplicate': 200, 'busy': 503,
+                          'throttled': 429}.get(ack.get('status'), 'error')
+            else:
+                status, _, connection = send_http(url, body, content_type, args, connection)
+        except Exception as e:
+            status = type(e).__name__
+            connection = None
+            ws = None
+        results.record(status, time.perf_counter() - started, rows)
+
+    if ws is not None:
+        ws.close()
+    if connection is not None:
+        connection.close()
+
+
+def run_backlog_watch(index, args, url, rates, results, stop):
+    watch = WatchSimulator(f'backlog-watch-{index:03d}', rates, args.backlog_seconds)
+    # Its readings start a day ago and are sent as fast as the server takes them
+    start_ms = int(time.time() * 1000) - 86_400_000
+    connection = None
+    while not stop.is_set():
+        body, content_type, rows = watch.batch(start_ms, args.format)
+        started = time.perf_counter()
+        retry_after = None
+        try:
+            status, retry_after, connection = send_http(url, body, content_type, args, connection)
+        except Exception as e:
+            status = type(e).__name__
+            connection = None
+        results.record(status, time.perf_counter() - started, rows)
+        if isinstance(status, int) and 200 <= status < 300:
+            start_ms += int(args.backlog_seconds * 1000)
+        else:
+            stop.wait(float(retry_after) if retry_after else 1.0)
+    if connection is not None:
+        connection.close()
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def report(results, seconds, client_cpu, args):
+    latencies = sorted(results.latencies)
+    total = sum(results.statuses.values())
+    ok = len(latencies)
+    print(f"\n{args.watches} watches, {args.interval:g} s batches, {args.format} over {args.transport}"
+          f"{' (gzip)' if args.gzip else ''}{' (keep-alive)' if args.keep_alive else ''}, {seconds:.1f} s")
+    print(f"  requests: {total / seconds:9.1f} /s   ({total} sent, {ok} ok)")
+    print(f"  rows:     {results.rows / seconds:9.1f} /s")
+    print(f"  latency:  p50 {percentile(latencies, 50) * 1000:8.1f} ms   p95 {percentile(latencies, 95) * 1000:8.1f} ms   "
+          f"p99 {percentile(latencies, 99) * 1000:8.1f} ms   max {percentile(latencies, 100) * 1000:8.1f} ms")
+    errors = {status: n for status, n in results.statuses.items() if not (isinstance(status, int) and 200 <= status < 300)}
+    error_count = sum(errors.values())
+    print(f"  errors:   {error_count / total * 100 if total else 0.0:9.2f} %   {errors or ''}")
+    print(f"  statuses: {dict(sorted(results.statuses.items(), key=str))}   late sends: {results.late}")
+    # A busy generator delays sends itself; numbers are only meaningful well below 100 %
+    print(f"  client CPU: {client_cpu / seconds * 100:.0f} % of one core")
+
+
+def report_backlog(results, seconds, args):
+    stored = len(results.latencies)
+    print(f"{args.backlog_watches} backlog watches, {args.backlog_seconds:g} s of readings per batch")
+    print(f"  rows:     {results.rows / seconds:9.1f} /s   ({stored} batches stored)")
+    print(f"  statuses: {dict(sorted(results.statuses.items(), key=str))}")
+
+
+def spawn_server(port, workers):
+    # The server under test runs in its own process (own GIL) on a scratch database,
+    # with the ingest settings taken from this environment
+    workdir = tempfile.mkdtemp(prefix='watch_fleet_')
+    env = dict(os.environ, DATABASE_PATH=os.path.join(workdir, 'fleet.db'))
+    if workers:
+        env.update(SERVER_HOST='127.0.0.1', SERVER_PORT=str(port), WEB_WORKERS=str(workers))
+        command = [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', 'app:create_app()']
+    else:
+        command = [sys.executable, '-c', f"import app; app.create_app().run(host='127.0.0.1', port={port}, threaded=True)"]
+    process = subprocess.Popen(command, cwd=SERVER_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
+            connection.request('GET', '/api/devices')
+            connection.getresponse().read()
+            connection.close()
+            return process, workdir
+        except OSError:
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError('Server did not start')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulate a fleet of watches sending /api/batch payloads')
+    parser.add_argument('--url', default='http://127.0.0.1:5000')
+    parser.add_argument('--spawn-server', action='store_true', help='start a server on a scratch database')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='with --spawn-server: gunicorn workers (0 runs the development server)')
+    parser.add_argument('--watches', type=int, default=50)
+    parser.add_argument('--seconds', type=float, default=30)
+    parser.add_argument('--interval', type=float, default=10, help='seconds between batches of a watch')
+    parser.add_argument('--format', choices=('json', 'columnar'), default='json')
+    parser.add_argument('--transport', choices=('http', 'ws'), default='http')
+    parser.add_argument('--gzip', action='store_true')
+    parser.add_argument('--keep-alive', action='store_true', help='reuse one HTTP connection per watch')
+    parser.add_argument('--timeout', type=float, default=10, help='request timeout, as on the watch')
+    parser.add_argument('--backlog-watches', type=int, default=0, help='watches sending a backlog, back to back')
+    parser.add_argument('--backlog-seconds', type=float, default=300, help='seconds of readings per backlog batch')
+    # Sensor rates in Hz. SENSOR_DELAY_NORMAL is ~5 Hz, motion sensors use samplingPeriod (30 Hz)
+    parser.add_argument('--hr-hz', type=float, default=1)
+    parser.add_argument('--skin-temp-hz', type=float, default=5)
+    parser.add_argument('--gsr-hz', type=float, default=5)
+    parser.add_argument('--light-hz', type=float, default=5)
+    parser.add_argument('--ppg-hz', type=float, default=25)
+    parser.add_argument('--motion-hz', type=float, default=30, help='accelerometer and gyroscope')
+    args = parser.parse_args()
+
+    rates = {
+        'heartrates': args.hr_hz, 'skin_temperature': args.skin_temp_hz, 'gsr': args.gsr_hz,
+        'light': args.light_hz, 'ppg': args.ppg_hz,
+        'accelerometer': args.motion_hz, 'gyroscope': args.motion_hz,
+    }
+
+    server = workdir = None
+    if args.spawn_server:
+        port = 5000 + random.randint(100, 900)
+        server, workdir = spawn_server(port, args.workers)
+        args.url = f'http://127.0.0.1:{port}'
+    url = urllib.parse.urlsplit(args.url)
+
+    results = Results()
+    backlog_results = Results()
+    stop = threading.Event()
+    threads = [threading.Thread(target=run_watch, args=(i, args, url, rates, results, stop), daemon=True)
+               for i in range(args.watches)]
+    threads += [threading.Thread(target=run_backlog_watch, args=(i, args, url, rates, backlog_results, stop), daemon=True)
+                for i in range(args.backlog_watches)]
+    started = time.monotonic()
+    cpu_started = time.process_time()
+    try:
+        for thread in threads:
+            thread.start()
+        while time.monotonic() - started < args.seconds:
+            time.sleep(min(5.0, args.seconds - (time.monotonic() - started)))
+            with results.lock:
+                done, rows = sum(results.statuses.values()), results.rows
+            print(f"  {time.monotonic() - started:6.1f} s: {done} requests, {rows} rows", flush=True)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join(args.timeout + 1)
+        elapsed = time.monotonic() - started
+        client_cpu = time.process_time() - cpu_started
+        if server is not None:
+            server.terminate()
+            server.wait()
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report(results, elapsed, client_cpu, args)
+    if args.backlog_watches:
+        report_backlog(backlog_results, elapsed, args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+# body_encoding.py - Streaming decompression of gzip / zstd request bodies
+
+import gzip
+import io
+import zlib
+
+from werkzeug.exceptions import BadRequest, RequestEntityTooLarge, UnsupportedMediaType
+from werkzeug.wsgi import get_content_length, get_input_stream
+
+# zstd support is optional, bodies encoded with it are refused when the package is missing
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+_DECOMPRESSION_ERRORS = (OSError, EOFError, zlib.error)
+if zstandard is not None:
+    _DECOMPRESSION_ERRORS += (zstandard.ZstdError,)
+
+
+def supported_encodings():
+    return ('gzip', 'zstd') if zstandard is not None else ('gzip',)
+
+
+class _CappedReader(io.RawIOBase):
+    """Raw stream over a decompressing reader that refuses to inflate past max_size bytes."""
+
+    def __init__(self, reader, max_size):
+        self._reader = reader
+        self._max_size = max_size
+        self._size = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        try:
+            n = self._reader.readinto(b)
+        except _DECOMPRESSION_ERRORS as e:
+            raise BadRequest(f'Could not decompress request body: {str(e)}')
+        self._size += n
+        if self._size > self._max_size:
+            raise RequestEntityTooLarge(f'Decompressed request body exceeds {self._max_size} bytes')
+        return n
+
+
+def _open_decompressor(encoding, raw):
+    if encoding == 'gzip':
+        return gzip.GzipFile(fileobj=raw, mode='rb')
+    if encoding == 'zstd' and zstandard is not None:
+        return zstandard.ZstdDecompressor().stream_reader(raw, read_across_frames=True)
+    raise UnsupportedMediaType(f"Unsupported Content-Encoding '{encoding}', use one of: {', '.join(supported_encodings())}")
+
+
+def install_decompressing_input(environ, max_decompressed_size, max_content_length=None):
+    """
+    Replace the WSGI input of a request sent with Content-Encoding by a stream
+    that decompresses it on the fly.
+
+    Nothing is decompressed up front: the body is inflated chunk by chunk as
+    the request handler reads it, and reading fails with 413 as soon as more
+    than max_decompressed_size bytes come out.
+    """
+    encoding = environ.get('HTTP_CONTENT_ENCODING', '').strip().lower()
+    if encoding in ('', 'identity'):
+        return
+
+    raw = get_input_stream(environ, max_content_length=max_content_length)
+    reader = _CappedReader(_open_decompressor(encoding, raw), max_decompressed_size)
+
+    # Keep the on-the-wire size around for handlers that pick a strategy by body size
+    environ['body_encoding.content_length'] = get_content_length(environ)
+    environ['wsgi.input'] = io.BufferedReader(reader)
+    environ['wsgi.input_terminated'] = True
+    environ.pop('CONTENT_LENGTH', None)
+    environ.pop('HTTP_CONTENT_ENCODING', None)
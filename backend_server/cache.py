@@ -0,0 +1,84 @@
+# cache.py - Read-through cache of the dashboard GET responses
+#
+# Entries are keyed by (table, device_id, query parameters) and hold the response body.
+# Every (table, device_id) has a generation counter, bumped when ingest commits
+# readings of that device into that table. An entry is only valid while the
+# generation it was computed at is current, so an ingest commit invalidates exactly
+# the entries of its devices and tables (plus the all-devices entries of the tables,
+# device_id None) without scanning the cache. A response computed while a commit
+# landed is not stored, it may predate the commit.
+
+import collections
+import threading
+import time
+
+
+class ResponseCache:
+    """Size bounded LRU of response bodies with ingest-driven invalidation."""
+
+    def __init__(self, capacity, ttl_s):
+        self.capacity = capacity
+        self.ttl_s = ttl_s
+        self._entries = collections.OrderedDict()
+        self._generations = collections.defaultdict(int)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def generation(self, table, device_id):
+        """Current generation of (table, device_id), to pass to put()."""
+        with self._lock:
+            return self._generations[(table, device_id)]
+
+    def get(self, key):
+        """Cached value of key = (table, device_id, ...), or None."""
+        if not self.capacity:
+            return None
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                generation, expires, value = entry
+                if generation == self._generations[key[:2]] and now < expires:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, generation, value):
+        if not self.capacity:
+            return
+        with self._lock:
+            # Computed before an invalidation that has happened since
+            if generation != self._generations[key[:2]]:
+                return
+            self._entries[key] = (generation, time.monotonic() + self.ttl_s, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, device_id, tables):
+        """Called once readings of device_id in the given tables are committed."""
+        with self._lock:
+            for table in tables:
+                self._generations[(table, device_id)] += 1
+                self._generations[(table, None)] += 1
+                self.invalidations += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'capacity': self.capacity,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / lookups, 4) if lookups else None,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+            }
@@ -0,0 +1,195 @@
+# chunks.py - Compact chunked storage for the high-rate streams (CHUNKED_STORAGE=on)
+#
+# Instead of one row per sample, the readings of a device are stored as one row per
+# fixed window of CHUNK_SECONDS in <table>_chunks (partitioned by time like the
+# sensor tables, see partitions.py):
+#
+#   device_id   the watch
+#   ts_us       start of the window (epoch microseconds, a multiple of CHUNK_SECONDS)
+#   first_us    timestamp of the first sample
+#   last_us     timestamp of the last sample
+#   count       number of samples
+#   data        little-endian packed arrays, each of count entries:
+#                 int32 timestamp deltas in microseconds (first one 0, from first_us)
+#                 then the value columns: float32 x, y, z (motion) or int32 value (PPG)
+#
+# A sample costs 16 bytes (motion) / 8 bytes (PPG) instead of a ~100 byte row plus
+# its index entry. decode_chunk returns numpy arrays without any per-sample Python work.
+# Readings arriving for a window that already has a chunk are merged into it.
+
+import sqlite3
+
+import numpy as np
+
+import config
+from partitions import create_partition, partition_name, partition_start, table_partitions
+from timestamps import format_timestamp_us
+
+# Streams that can be stored in chunks, with the dtype and names of their value columns
+CHUNKED_STREAMS = {
+    'accelerometer': (np.dtype('<f4'), ('x_value', 'y_value', 'z_value')),
+    'gyroscope': (np.dtype('<f4'), ('x_value', 'y_value', 'z_value')),
+    'ppg': (np.dtype('<i4'), ('value',)),
+}
+
+CHUNK_TABLES = {table: f'{table}_chunks' for table in CHUNKED_STREAMS}
+
+_DELTA_DTYPE = np.dtype('<i4')
+
+_SELECT_COLUMNS = 'device_id, ts_us, first_us, last_us, count, data'
+
+
+def chunk_us():
+    # Windows must not straddle two partitions, and the deltas of a window fit in an int32
+    if 86400 % config.CHUNK_SECONDS or config.CHUNK_SECONDS > 2000:
+        raise ValueError('CHUNK_SECONDS must divide a day and be at most 2000')
+    return config.CHUNK_SECONDS * 1_000_000
+
+
+def uses_chunks(table):
+    """Whether new readings of table are written as chunks."""
+    return config.CHUNKED_STORAGE == 'on' and table in CHUNKED_STREAMS
+
+
+def encode_chunk(ts_us, columns):
+    """Pack sorted int64 timestamps and the value columns. Returns (first_us, last_us, data)."""
+    deltas = np.diff(ts_us, prepend=ts_us[0]).astype(_DELTA_DTYPE)
+    data = deltas.tobytes() + b''.join(np.ascontiguousarray(column).tobytes() for column in columns)
+    return int(ts_us[0]), int(ts_us[-1]), data
+
+
+def decode_chunk(table, first_us, count, data):
+    """Unpack a chunk into (int64 timestamps, [value columns]) numpy arrays."""
+    value_dtype, names = CHUNKED_STREAMS[table]
+    deltas = np.frombuffer(data, dtype=_DELTA_DTYPE, count=count)
+    ts_us = first_us + np.cumsum(deltas, dtype=np.int64)
+    offset = count * _DELTA_DTYPE.itemsize
+    columns = []
+    for _ in names:
+        columns.append(np.frombuffer(data, dtype=value_dtype, count=count, offset=offset))
+        offset += count * value_dtype.itemsize
+    return ts_us, columns
+
+
+def write_chunk_rows(c, table, rows):
+    """
+    Store rows of a chunked stream, (device_id, values..., timestamp, ts_us) as
+    passed to insert_readings, merging them into the chunks of their windows.
+    Runs inside the caller's transaction.
+    """
+    value_dtype, names = CHUNKED_STREAMS[table]
+    window = chunk_us()
+    groups = {}
+    for row in rows:
+        groups.setdefault((row[0], row[-1] // window * window), []).append(row)
+
+    for (device_id, window_start), group in groups.items():
+        ts_us = np.fromiter((row[-1] for row in group), dtype=np.int64, count=len(group))
+        columns = [np.fromiter((row[1 + i] for row in group), dtype=value_dtype, count=len(group))
+                   for i in range(len(names))]
+
+        chunk_table = CHUNK_TABLES[table]
+        name = partition_name(chunk_table, partition_start(window_start))
+        try:
+            c.execute(f'SELECT id, first_us, count, data FROM {name} WHERE device_id = ? AND ts_us = ?',
+                      (device_id, window_start))
+        except sqlite3.OperationalError as e:
+            # First chunk of a new period
+            if 'no such table' not in str(e):
+                raise
+            create_partition(c, chunk_table, partition_start(window_start))
+            c.execute(f'SELECT id, first_us, count, data FROM {name} WHERE device_id = ? AND ts_us = ?',
+                      (device_id, window_start))
+        existing = c.fetchone()
+
+        if existing is not None:
+            old_ts, old_columns = decode_chunk(table, existing[1], existing[2], existing[3])
+            ts_us = np.concatenate([old_ts, ts_us])
+            columns = [np.concatenate([old, new]) for old, new in zip(old_columns, columns)]
+
+        # Deltas need ascending timestamps, readings of a batch can arrive in any order
+        order = np.argsort(ts_us, kind='stable')
+        ts_us = ts_us[order]
+        columns = [column[order] for column in columns]
+        first_us, last_us, data = encode_chunk(ts_us, columns)
+
+        if existing is None:
+            c.execute(
+                f'INSERT INTO {name} (device_id, ts_us, first_us, last_us, count, data) VALUES (?, ?, ?, ?, ?, ?)',
+                (device_id, window_start, first_us, last_us, len(ts_us), data)
+            )
+        else:
+            c.execute(
+                f'UPDATE {name} SET first_us = ?, last_us = ?, count = ?, data = ? WHERE id = ?',
+                (first_us, last_us, len(ts_us), data, existing[0])
+            )
+
+
+def iter_chunks(conn, table, device_id=None, start_us=None, end_us=None, newest_first=False):
+    """
+    Decoded chunks of table overlapping [start_us, end_us), ordered by window:
+    yields (device_id, ts_us array, [value columns]) with the samples outside the
+    range already cut off.
+    """
+    chunk_table = CHUNK_TABLES[table]
+    window = chunk_us()
+    conditions, params = [], []
+    if device_id:
+        conditions.append('device_id = ?')
+        params.append(device_id)
+    if start_us is not None:
+        conditions.append('last_us >= ?')
+        params.append(start_us)
+    if end_us is not None:
+        # ts_us (the window start) bounds the search through the index
+        conditions.append('ts_us < ? AND first_us < ?')
+        params.extend([end_us, end_us])
+    if start_us is not None:
+        conditions.append('ts_us > ?')
+        params.append(start_us - window)
+    where = f" WHERE {' AND '.join(conditions)}" if conditions else ''
+    order = 'DESC' if newest_first else 'ASC'
+
+    found = table_partitions(conn, chunk_table, start_us, end_us)
+    if not newest_first:
+        found = found[:1] + found[:0:-1]
+    for name, _, _ in found:
+        for row in conn.execute(f'SELECT {_SELECT_COLUMNS} FROM {name}{where} ORDER BY ts_us {order}', params):
+            ts_us, columns = decode_chunk(table, row['first_us'], row['count'], row['data'])
+            if (start_us is not None and ts_us[0] < start_us) or (end_us is not None and ts_us[-1] >= end_us):
+                keep = np.ones(len(ts_us), dtype=bool)
+                if start_us is not None:
+                    keep &= ts_us >= start_us
+                if end_us is not None:
+                    keep &= ts_us < end_us
+                ts_us = ts_us[keep]
+                columns = [column[keep] for column in columns]
+                if not len(ts_us):
+                    continue
+            yield row['device_id'], ts_us, columns
+
+
+def chunk_reading_dicts(table, device_id, ts_us, columns):
+    """Readings of a decoded chunk as dicts shaped like the rows of the sensor tables."""
+    _, names = CHUNKED_STREAMS[table]
+    values = [column.tolist() for column in columns]
+    return [
+        dict(id=None, device_id=device_id, timestamp=format_timestamp_us(ts), ts_us=ts,
+             **{name: value[i] for name, value in zip(names, values)})
+        for i, ts in enumerate(ts_us.tolist())
+    ]
+
+
+def latest_chunk_readings(conn, table, device_id=None, limit=100):
+    """The newest chunked readings of table, as dicts, newest first."""
+    limit = int(limit)
+    window = chunk_us()
+    readings = []
+    for chunk_device, ts_us, columns in iter_chunks(conn, table, device_id, newest_first=True):
+        # Chunks come by descending window start: once enough readings are collected,
+        # a window ending before the oldest of them cannot contribute anymore
+        if len(readings) >= limit and int(ts_us[0]) // window * window + window <= readings[-1]['ts_us']:
+            break
+        readings = sorted(readings + chunk_reading_dicts(table, chunk_device, ts_us, columns),
+                          key=lambda reading: reading['ts_us'], reverse=True)[:limit]
+    return readings
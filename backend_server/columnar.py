@@ -0,0 +1,164 @@
+# columnar.py - Compact binary columnar batch format for /api/batch
+#
+# Body layout (all integers little endian):
+#   magic           4 bytes  b'WSC1'
+#   header_length   uint32   length of the JSON header, padded so the first stream starts 8-byte aligned
+#   header          JSON     {"device_id": ..., "batch_timestamp": ..., "batch_id": ... (optional),
+#                             "streams": [{"type": "accelerometer", "count": n}, ...]}
+#   streams         one section per header entry, in the same order:
+#                     timestamps  int64[n]    epoch milliseconds
+#                     heart rate / health streams:  value int32[n]
+#                     motion streams:               x float32[n], y float32[n], z float32[n]
+#                   every section is zero-padded to a multiple of 8 bytes
+#
+# Stream types are the table names used by the JSON format: heartrates,
+# skin_temperature, gsr, light, ppg, accelerometer and gyroscope.
+
+import datetime
+import itertools
+import json
+import struct
+
+import numpy as np
+
+from ingest import PreparedBatch, INSERT_STATEMENTS, MOTION_DATA_TYPES
+
+COLUMNAR_MIME_TYPE = 'application/x-sensor-columnar'
+
+MAGIC = b'WSC1'
+_PREFIX = struct.Struct('<4sI')
+
+_TIMESTAMP_DTYPE = np.dtype('<i8')
+_VALUE_DTYPE = np.dtype('<i4')
+_AXIS_DTYPE = np.dtype('<f4')
+
+
+def _padded(length):
+    return (length + 7) & ~7
+
+
+def _section_length(stream_type, count):
+    axes = 3 if stream_type in MOTION_DATA_TYPES else 1
+    value_size = _AXIS_DTYPE.itemsize if axes == 3 else _VALUE_DTYPE.itemsize
+    return _padded(count * _TIMESTAMP_DTYPE.itemsize + axes * count * value_size)
+
+
+def _utc_offset_ms(epoch_ms):
+    moment = datetime.datetime.fromtimestamp(epoch_ms / 1000, tz=datetime.timezone.utc)
+    return int(moment.astimezone().utcoffset().total_seconds() * 1000)
+
+
+def _timestamps_to_iso(epoch_ms):
+    # The watch reports local wall-clock time, so render the strings the same way
+    # as the JSON payloads ('yyyy-MM-ddTHH:mm:ss.SSS' without a UTC offset). The
+    # offset is looked up once per minute of the batch: a batch spanning a DST change
+    # gets the offset of each side
+    if len(epoch_ms) == 0:
+        return []
+    minutes, minute_index = np.unique(epoch_ms // 60_000, return_inverse=True)
+    offsets_ms = np.array([_utc_offset_ms(int(minute) * 60_000) for minute in minutes], dtype=np.int64)
+    local = (epoch_ms + offsets_ms[minute_index]).astype('datetime64[ms]')
+    return np.datetime_as_string(local, unit='ms').tolist()
+
+
+def decode_columnar_batch(body):
+    """
+    Decode a columnar /api/batch body into a PreparedBatch.
+
+    The column arrays are numpy views over the request body (no copy); they
+    are only materialised as row tuples for executemany. Raises ValueError
+    for malformed bodies.
+    """
+    buffer = memoryview(body)
+    if len(buffer) < _PREFIX.size:
+        raise ValueError('Columnar payload is too short')
+    magic, header_length = _PREFIX.unpack_from(buffer, 0)
+    if magic != MAGIC:
+        raise ValueError('Not a columnar batch payload')
+
+    offset = _PREFIX.size + header_length
+    if offset > len(buffer):
+        raise ValueError('Columnar header is truncated')
+    try:
+        header = json.loads(bytes(buffer[_PREFIX.size:offset]))
+    except ValueError:
+        raise ValueError('Columnar header is not valid JSON')
+    if not isinstance(header, dict) or not isinstance(header.get('streams', []), list):
+        raise ValueError('Columnar header must be an object with a streams list')
+
+    batch = PreparedBatch(
+        header.get('device_id', 'unknown'),
+        header.get('batch_timestamp', datetime.datetime.now().isoformat())
+    )
+    batch.client_batch_id = header.get('batch_id')
+    device_id = batch.device_id
+
+    for stream in header.get('streams', []):
+        stream_type = stream.get('type') if isinstance(stream, dict) else None
+        count = stream.get('count') if isinstance(stream, dict) else None
+        if stream_type not in INSERT_STATEMENTS:
+            raise ValueError(f'Unknown stream type: {stream_type}')
+        if not isinstance(count, int) or count < 0:
+            raise ValueError(f'Invalid count for {stream_type} stream')
+
+        section_length = _section_length(stream_type, count)
+        if offset + section_length > len(buffer):
+            raise ValueError(f'{stream_type} stream is truncated')
+
+        timestamps = np.frombuffer(buffer, dtype=_TIMESTAMP_DTYPE, count=count, offset=offset)
+        column_offset = offset + count * _TIMESTAMP_DTYPE.itemsize
+        iso_timestamps = _timestamps_to_iso(timestamps)
+        ts_us = (timestamps * 1000).tolist()
+
+        if stream_type in MOTION_DATA_TYPES:
+            axes = []
+            for _ in range(3):
+                axes.append(np.frombuffer(buffer, dtype=_AXIS_DTYPE, count=count, offset=column_offset))
+                column_offset += count * _AXIS_DTYPE.itemsize
+            if count and not all(np.isfinite(axis).all() for axis in axes):
+                raise ValueError(f'Invalid {stream_type} value')
+            batch.rows[stream_type].extend(zip(
+                itertools.repeat(device_id, count), axes[0].tolist(), axes[1].tolist(), axes[2].tolist(), iso_timestamps, ts_us
+            ))
+        else:
+            values = np.frombuffer(buffer, dtype=_VALUE_DTYPE, count=count, offset=column_offset)
+            batch.rows[stream_type].extend(zip(itertools.repeat(device_id, count), values.tolist(), iso_timestamps, ts_us))
+
+        offset += section_length
+
+    return batch
+
+
+def encode_columnar_batch(device_id, batch_timestamp, streams, batch_id=None):
+    """
+    Build a columnar /api/batch body.
+
+    streams maps a stream type to a tuple of columns: (timestamps_ms, values)
+    for heart rate and health streams, (timestamps_ms, x, y, z) for motion streams.
+    """
+    header_streams = []
+    sections = []
+    for stream_type, columns in streams.items():
+        if stream_type not in INSERT_STATEMENTS:
+            raise ValueError(f'Unknown stream type: {stream_type}')
+        expected_columns = 4 if stream_type in MOTION_DATA_TYPES else 2
+        if len(columns) != expected_columns:
+            raise ValueError(f'{stream_type} stream needs {expected_columns} columns')
+        timestamps = np.asarray(columns[0], dtype=_TIMESTAMP_DTYPE)
+        value_dtype = _AXIS_DTYPE if stream_type in MOTION_DATA_TYPES else _VALUE_DTYPE
+        section = timestamps.tobytes() + b''.join(
+            np.asarray(column, dtype=value_dtype).tobytes() for column in columns[1:]
+        )
+        sections.append(section + b'\0' * (_padded(len(section)) - len(section)))
+        header_streams.append({'type': stream_type, 'count': len(timestamps)})
+
+    header = {
+        'device_id': device_id,
+        'batch_timestamp': batch_timestamp,
+        'streams': header_streams
+    }
+    if batch_id is not None:
+        header['batch_id'] = batch_id
+    header = json.dumps(header).encode('utf-8')
+    header += b' ' * (_padded(_PREFIX.size + len(header)) - _PREFIX.size - len(header))
+    return _PREFIX.pack(MAGIC, len(header)) + header + b''.join(sections)
@@ -0,0 +1,145 @@
+# config.py - Server configuration, overridable through environment variables
+
+import os
+
+# SQLite database file used by the server
+DATABASE_PATH = os.environ.get('DATABASE_PATH', 'health_data.db')
+
+# Connection tuning, see db.py
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 8))
+DB_CACHE_SIZE_KB = int(os.environ.get('DB_CACHE_SIZE_KB', 64 * 1024))
+DB_MMAP_SIZE_BYTES = int(os.environ.get('DB_MMAP_SIZE_BYTES', 256 * 1024 * 1024))
+DB_BUSY_TIMEOUT_MS = int(os.environ.get('DB_BUSY_TIMEOUT_MS', 5000))
+DB_STATEMENT_CACHE_SIZE = int(os.environ.get('DB_STATEMENT_CACHE_SIZE', 256))
+
+# How /api/batch writes to the database:
+#   'sync'   - the request opens its own transaction and commits before answering
+#   'queued' - the request only validates the payload and hands it to the
+#              background writer thread, which group-commits batches from many devices
+#   'writer' - for several worker processes: the request sends the batch to the writer
+#              process (see writer.py), which group-commits the batches of every worker,
+#              and answers once it is committed
+INGEST_MODE = os.environ.get('INGEST_MODE', 'sync')
+
+# Maximum number of batches waiting for the writer thread before /api/batch answers 503
+INGEST_QUEUE_SIZE = int(os.environ.get('INGEST_QUEUE_SIZE', 1000))
+
+# How long the writer keeps collecting batches before committing a group
+INGEST_FLUSH_INTERVAL_MS = int(os.environ.get('INGEST_FLUSH_INTERVAL_MS', 5))
+
+# Upper bound on the number of batches committed in one transaction
+INGEST_MAX_GROUP_SIZE = int(os.environ.get('INGEST_MAX_GROUP_SIZE', 200))
+
+# ... and on the readings committed in one transaction (0 for no limit), so that the
+# batches of a device catching up do not make a group slow for every other device
+INGEST_MAX_GROUP_ROWS = int(os.environ.get('INGEST_MAX_GROUP_ROWS', 50000))
+
+# Admission control (see admission.py): readings per second and device, the most a
+# device can send at once (its token bucket), the largest batch accepted (0 for no
+# limit), batches a device may have waiting in the write-behind queue, and the
+# Retry-After (seconds) of a full queue or of a busy database. A watch records about
+# 100 readings per second, the default rate lets it catch up 20 times faster.
+INGEST_DEVICE_ROWS_PER_S = float(os.environ.get('INGEST_DEVICE_ROWS_PER_S', 2000))
+INGEST_DEVICE_BURST_ROWS = int(os.environ.get('INGEST_DEVICE_BURST_ROWS', 20000))
+INGEST_MAX_BATCH_ROWS = int(os.environ.get('INGEST_MAX_BATCH_ROWS', 0))
+INGEST_DEVICE_QUEUE_SIZE = int(os.environ.get('INGEST_DEVICE_QUEUE_SIZE', 100))
+INGEST_RETRY_AFTER_S = int(os.environ.get('INGEST_RETRY_AFTER_S', 1))
+
+# Hard cap on the size of a gzip / zstd request body once decompressed
+MAX_DECOMPRESSED_BODY_BYTES = int(os.environ.get('MAX_DECOMPRESSED_BODY_BYTES', 64 * 1024 * 1024))
+
+# JSON /api/batch bodies larger than this on the wire (or of unknown length) are parsed
+# incrementally and written in chunks instead of being loaded with request.json
+STREAMING_INGEST_MIN_BYTES = int(os.environ.get('STREAMING_INGEST_MIN_BYTES', 1024 * 1024))
+
+# Rows per executemany call when a batch is parsed incrementally
+STREAMING_INGEST_CHUNK_ROWS = int(os.environ.get('STREAMING_INGEST_CHUNK_ROWS', 5000))
+
+# Number of recently stored batch keys kept in memory to answer client retries
+DEDUP_CACHE_SIZE = int(os.environ.get('DEDUP_CACHE_SIZE', 10000))
+
+# Conversion of rows stored before integer timestamps: 'background' runs it in a thread
+# when the server starts, 'off' leaves it to `python timestamp_migration.py`
+TIMESTAMP_MIGRATION = os.environ.get('TIMESTAMP_MIGRATION', 'background')
+TIMESTAMP_MIGRATION_CHUNK_ROWS = int(os.environ.get('TIMESTAMP_MIGRATION_CHUNK_ROWS', 5000))
+
+# WebSocket ingest (/api/stream): largest accepted frame, and how often idle
+# connections are pinged so that dropped watches are noticed
+STREAM_MAX_FRAME_BYTES = int(os.environ.get('STREAM_MAX_FRAME_BYTES', 1024 * 1024))
+STREAM_PING_INTERVAL_S = int(os.environ.get('STREAM_PING_INTERVAL_S', 25))
+
+# Sensor readings are stored in one table per 'day' or 'week' (see partitions.py).
+# Choose before the first start: existing partitions keep their period
+PARTITION_PERIOD = os.environ.get('PARTITION_PERIOD', 'week')
+
+# Readings older than this many days are dropped, 0 keeps everything. The partitions
+# of the next period are created every RETENTION_CHECK_INTERVAL_S as well
+RETENTION_DAYS = int(os.environ.get('RETENTION_DAYS', 0))
+RETENTION_CHECK_INTERVAL_S = int(os.environ.get('RETENTION_CHECK_INTERVAL_S', 3600))
+
+# Store accelerometer, gyroscope and PPG readings as packed per-device chunks of
+# CHUNK_SECONDS instead of one row per sample ('on' / 'off'), see chunks.py.
+# CHUNK_SECONDS must divide a day
+CHUNKED_STORAGE = os.environ.get('CHUNKED_STORAGE', 'off')
+CHUNK_SECONDS = int(os.environ.get('CHUNK_SECONDS', 60))
+
+# Maintain the 1 s / 1 min / 1 h rollups of every sensor at ingest ('on' / 'off'),
+# see rollups.py. Readings stored without them are rolled up in the background at the
+# next start with them on (rollup_backfill.py), at most about this many per transaction
+ROLLUPS = os.environ.get('ROLLUPS', 'on')
+ROLLUP_BACKFILL_CHUNK_ROWS = int(os.environ.get('ROLLUP_BACKFILL_CHUNK_ROWS', 20000))
+
+# Largest grid /api/timeseries computes (points per channel)
+TIMESERIES_MAX_POINTS = int(os.environ.get('TIMESERIES_MAX_POINTS', 100_000))
+
+# Read-through cache of the dashboard GET responses (see cache.py): number of cached
+# responses (0 disables it) and how long one is served at most. Ingest invalidates
+# the entries of the devices it writes right away, the TTL only bounds staleness
+# from writers outside this process
+RESPONSE_CACHE_SIZE = int(os.environ.get('RESPONSE_CACHE_SIZE', 1024))
+RESPONSE_CACHE_TTL_S = float(os.environ.get('RESPONSE_CACHE_TTL_S', 60))
+
+# Live feed of the device dashboard (GET /api/devices/<device_id>/live, see livefeed.py):
+# messages a client may fall behind by before it is told to reload, largest number of
+# readings of one sensor pushed per commit (more are reloaded), and how often idle
+# streams get a keepalive comment
+LIVE_FEED_QUEUE_SIZE = int(os.environ.get('LIVE_FEED_QUEUE_SIZE', 256))
+LIVE_FEED_MAX_READINGS = int(os.environ.get('LIVE_FEED_MAX_READINGS', 1000))
+LIVE_FEED_KEEPALIVE_S = float(os.environ.get('LIVE_FEED_KEEPALIVE_S', 15))
+
+# Server logs (see logs.py): lowest level written (DEBUG adds a line per sensor table
+# of every batch), 'text' or 'json' lines, sampling probabilities of events
+# ('batch_processed=0.1,readings_inserted=0.01'), records per second and event (0 for
+# no limit), and 'on' to write them from a background thread through a queue of
+# LOG_QUEUE_SIZE records
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'text')
+LOG_SAMPLING = os.environ.get('LOG_SAMPLING', '')
+LOG_RATE_LIMIT = int(os.environ.get('LOG_RATE_LIMIT', 20))
+LOG_ASYNC = os.environ.get('LOG_ASYNC', 'on')
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', 10000))
+
+# Address of the built-in development server (python app.py)
+SERVER_HOST = os.environ.get('SERVER_HOST', '0.0.0.0')
+SERVER_PORT = int(os.environ.get('SERVER_PORT', 5000))
+SERVER_DEBUG = os.environ.get('SERVER_DEBUG', 'off')
+
+# Production server (gunicorn.conf.py): worker processes and threads per worker
+WEB_WORKERS = int(os.environ.get('WEB_WORKERS', 4))
+WEB_THREADS = int(os.environ.get('WEB_THREADS', 8))
+
+# Live feeds and WebSocket ingest connections open at once per worker process, each
+# holds one of its threads: half of WEB_THREADS by default, more are answered 503
+STREAM_MAX_CONNECTIONS = int(os.environ.get('STREAM_MAX_CONNECTIONS', max(1, WEB_THREADS // 2)))
+
+# Writer process of INGEST_MODE=writer (see writer.py): Unix socket the workers connect
+# to and the key they authenticate with, how long a worker waits for a batch to be
+# committed, commit notices buffered per worker before they are dropped, and how often
+# the workers send their metrics to it for /metrics (see metrics.py).
+# There is no default key: messages are unpickled, whoever has it can run code in the
+# writer. gunicorn.conf.py generates one per launch
+WRITER_ADDRESS = os.environ.get('WRITER_ADDRESS', DATABASE_PATH + '.writer.sock')
+WRITER_AUTHKEY = os.environ.get('WRITER_AUTHKEY', '').encode()
+WRITER_TIMEOUT_S = float(os.environ.get('WRITER_TIMEOUT_S', 30))
+WRITER_NOTICE_QUEUE_SIZE = int(os.environ.get('WRITER_NOTICE_QUEUE_SIZE', 10000))
+METRICS_PUSH_INTERVAL_S = float(os.environ.get('METRICS_PUSH_INTERVAL_S', 5))
@@ -0,0 +1,104 @@
+# db.py - Shared SQLite connection layer (WAL mode, tuned pragmas, pooled connections)
+
+import queue
+import sqlite3
+import threading
+
+from flask import g
+
+import config
+
+# Applied to every connection. WAL lets the dashboard readers run while /api/batch
+# writes, synchronous=NORMAL only fsyncs at checkpoints (safe in WAL mode), and the
+# cache / mmap sizes keep hot pages of the sensor tables in memory.
+PRAGMAS = (
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    f'PRAGMA cache_size=-{config.DB_CACHE_SIZE_KB}',
+    f'PRAGMA mmap_size={config.DB_MMAP_SIZE_BYTES}',
+    f'PRAGMA busy_timeout={config.DB_BUSY_TIMEOUT_MS}',
+    'PRAGMA temp_store=MEMORY',
+)
+
+
+# Primary result codes of a database locked by another connection
+_BUSY_CODES = (sqlite3.SQLITE_BUSY, sqlite3.SQLITE_LOCKED)
+
+
+def is_busy(error):
+    """Whether an sqlite3 error is SQLITE_BUSY / SQLITE_LOCKED, i.e. worth retrying later."""
+    if not isinstance(error, sqlite3.OperationalError):
+        return False
+    code = getattr(error, 'sqlite_errorcode', None)
+    if code is not None:
+        return code & 0xff in _BUSY_CODES
+    return 'locked' in str(error) or 'busy' in str(error)
+
+
+def connect(path=None):
+    """Open a configured connection to the health database."""
+    conn = sqlite3.connect(
+        path or config.DATABASE_PATH,
+        timeout=config.DB_BUSY_TIMEOUT_MS / 1000.0,
+        check_same_thread=False,
+        # Statements are compiled once per connection and reused from this cache,
+        # which is why connections are pooled instead of reopened per request
+        cached_statements=config.DB_STATEMENT_CACHE_SIZE
+    )
+    conn.row_factory = sqlite3.Row
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+
+class ConnectionPool:
+    """
+    Pool of open connections. A connection is used by one thread at a time:
+    it is taken out of the pool for a request and put back afterwards.
+    """
+
+    def __init__(self, path=None, max_idle=8):
+        self.path = path
+        self._idle = queue.LifoQueue(maxsize=max_idle)
+        self._lock = threading.Lock()
+        self.created = 0
+
+    def acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                self.created += 1
+            return connect(self.path)
+
+    def release(self, conn):
+        # Never hand out a connection with a transaction left open
+        if conn.in_transaction:
+            conn.rollback()
+        try:
+            self._idle.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def close_all(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+pool = ConnectionPool(max_idle=config.DB_POOL_SIZE)
+
+
+def get_db():
+    """Connection for the current request, returned to the pool on teardown."""
+    if 'db' not in g:
+        g.db = pool.acquire()
+    return g.db
+
+
+def release_db(exception=None):
+    conn = g.pop('db', None)
+    if conn is not None:
+        pool.release(conn)
@@ -0,0 +1,74 @@
+# dedup.py - Recognise batches that were already stored (client retries after a timeout)
+
+import collections
+import hashlib
+import threading
+
+SUMMARY_COLUMNS = ('device_id', 'total_records', 'heart_rate_count', 'health_data_count',
+                   'motion_data_count', 'processing_time_ms')
+
+
+def client_key(batch_id):
+    """Key for a batch identified by the client (Idempotency-Key header or batch_id field)."""
+    return f'id:{batch_id}'
+
+
+def content_key(digest):
+    return f'b2:{digest}'
+
+
+def content_hasher():
+    return hashlib.blake2b(digest_size=16)
+
+
+def content_digest(body):
+    return hashlib.blake2b(body, digest_size=16).hexdigest()
+
+
+def batch_key(header_batch_id, payload_batch_id, digest):
+    # A client supplied id wins over the content hash
+    if header_batch_id:
+        return client_key(header_batch_id)
+    if payload_batch_id is not None and payload_batch_id != '':
+        return client_key(payload_batch_id)
+    return content_key(digest)
+
+
+class BatchDeduplicator:
+    """
+    LRU of recently stored batch keys and their response summaries, backed by
+    the unique batch_key index of batch_logs for batches that fell out of it.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._recent = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def remember(self, key, summary):
+        with self._lock:
+            self._recent[key] = summary
+            self._recent.move_to_end(key)
+            while len(self._recent) > self.capacity:
+                self._recent.popitem(last=False)
+
+    def forget(self, key):
+        with self._lock:
+            self._recent.pop(key, None)
+
+    def lookup(self, conn, key):
+        """Summary of the batch already stored under key, or None."""
+        with self._lock:
+            summary = self._recent.get(key)
+            if summary is not None:
+                self._recent.move_to_end(key)
+                return summary
+
+        row = conn.execute(
+            f"SELECT {', '.join(SUMMARY_COLUMNS)} FROM batch_logs WHERE batch_key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        summary = dict(zip(SUMMARY_COLUMNS, row))
+        self.remember(key, summary)
+        return summary
@@ -0,0 +1,101 @@
+# devices.py - Registry of the devices that sent readings, maintained at ingest
+#
+# devices holds one row per device with when the server first and last received
+# readings from it (server clock, epoch microseconds). device_sensors holds, per
+# device and sensor table, the number of readings received (retention does not lower
+# it) and the timestamp of the newest one. insert_readings updates both in the ingest
+# transaction, so listing the devices or their "last seen" status never scans the
+# sensor tables.
+
+import time
+
+from timestamps import format_timestamp_us
+
+_UPSERT_DEVICE = '''
+    INSERT INTO devices (device_id, first_seen_us, last_seen_us) VALUES (?, ?, ?)
+    ON CONFLICT (device_id) DO UPDATE SET last_seen_us = max(last_seen_us, excluded.last_seen_us)
+'''
+
+_UPSERT_DEVICE_SENSOR = '''
+    INSERT INTO device_sensors (device_id, sensor, count, last_ts_us) VALUES (?, ?, ?, ?)
+    ON CONFLICT (device_id, sensor) DO UPDATE SET
+        count = count + excluded.count,
+        last_ts_us = max(coalesce(last_ts_us, excluded.last_ts_us), excluded.last_ts_us)
+'''
+
+
+def record_readings(c, table, rows):
+    """Account rows of a sensor table, (device_id, ..., ts_us), to their devices. Runs in the caller's transaction."""
+    per_device = {}
+    for row in rows:
+        count, last_ts_us = per_device.get(row[0], (0, row[-1]))
+        per_device[row[0]] = (count + 1, max(last_ts_us, row[-1]))
+
+    now_us = int(time.time() * 1_000_000)
+    c.executemany(_UPSERT_DEVICE, [(device_id, now_us, now_us) for device_id in per_device])
+    c.executemany(_UPSERT_DEVICE_SENSOR, [
+        (device_id, table, count, last_ts_us) for device_id, (count, last_ts_us) in per_device.items()
+    ])
+
+
+_WIDEN_DEVICE = '''
+    UPDATE devices SET first_seen_us = min(coalesce(first_seen_us, ?), ?), last_seen_us = max(coalesce(last_seen_us, ?), ?)
+    WHERE device_id = ?
+'''
+
+_WIDEN_DEVICE_SENSOR = '''
+    UPDATE device_sensors SET last_ts_us = max(coalesce(last_ts_us, ?), ?) WHERE device_id = ? AND sensor = ?
+'''
+
+
+def widen_registry(c, table, bounds):
+    """
+    Account readings of table whose ts_us was only filled in later (timestamp_migration.py),
+    bounds being {device_id: (oldest ts_us, newest ts_us)}. Runs in the caller's transaction.
+    """
+    c.executemany(_WIDEN_DEVICE, [(first_us, first_us, last_us, last_us, device_id)
+                                  for device_id, (first_us, last_us) in bounds.items()])
+    c.executemany(_WIDEN_DEVICE_SENSOR, [(last_us, last_us, device_id, table)
+                                         for device_id, (_, last_us) in bounds.items()])
+
+
+def device_ids(conn):
+    """Every registered device id, sorted."""
+    return [row[0] for row in conn.execute('SELECT device_id FROM devices ORDER BY device_id')]
+
+
+def _format_us(ts_us):
+    return format_timestamp_us(ts_us) if ts_us is not None else None
+
+
+def device_details(conn, device_id=None):
+    """
+    Registry entries, of one device or all of them (sorted by id), as dicts with
+    first_seen / last_seen and per sensor table the count and last reading timestamp.
+    """
+    query = 'SELECT device_id, first_seen_us, last_seen_us FROM devices'
+    params = []
+    if device_id is not None:
+        query += ' WHERE device_id = ?'
+        params.append(device_id)
+    devices = {}
+    for row in conn.execute(query + ' ORDER BY device_id', params):
+        devices[row['device_id']] = {
+            'device_id': row['device_id'],
+            'first_seen': _format_us(row['first_seen_us']),
+            'last_seen': _format_us(row['last_seen_us']),
+            'last_seen_us': row['last_seen_us'],
+            'sensors': {},
+        }
+
+    query = 'SELECT device_id, sensor, count, last_ts_us FROM device_sensors'
+    if device_id is not None:
+        query += ' WHERE device_id = ?'
+    for row in conn.execute(query, params):
+        if row['device_id'] in devices:
+            devices[row['device_id']]['sensors'][row['sensor']] = {
+                'count': row['count'],
+                'last_timestamp': _format_us(row['last_ts_us']),
+                'last_ts_us': row['last_ts_us'],
+            }
+    return list(devices.values())
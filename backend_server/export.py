@@ -0,0 +1,293 @@
+# export.py - Parquet export of the sensor readings, by device and time range
+#
+# Readings are read a chunk of rows at a time (rows and chunks, every partition
+# overlapping the range) and written as typed columns: int64 ts_us, float32 axes and
+# values, int32 heart rate and PPG. Memory use is bounded by the chunk size, whatever
+# the size of the range.
+#
+# export_dataset writes a hive partitioned dataset with a manifest:
+#
+#   <out>/<table>/device_id=<device>/date=<UTC day>/part-00000.parquet
+#   <out>/<table>/_manifest.json
+#
+# so that downstream jobs read column subsets and skip devices / days, e.g.
+#   pyarrow.dataset.dataset('out/accelerometer', partitioning='hive')
+#       .to_table(columns=['ts_us', 'z_value'], filter=pc.field('date') >= '2025-03-01')
+#
+# GET /api/export streams the same columns (plus device_id) as one Parquet file.
+#
+# Usage (from backend_server/):
+#   python export.py accelerometer exports/ [--device-id ID] [--start ISO] [--end ISO] [--database PATH]
+
+import argparse
+import datetime
+import json
+import os
+import time
+import urllib.parse
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import db
+from chunks import CHUNKED_STREAMS, CHUNK_TABLES, iter_chunks
+from partitions import table_partitions
+from timestamps import parse_timestamp_us
+
+# Value columns of every sensor table and their Parquet types
+EXPORT_COLUMNS = {
+    'heartrates': (('heart_rate', pa.int32()),),
+    'skin_temperature': (('value', pa.float32()),),
+    'gsr': (('value', pa.float32()),),
+    'light': (('value', pa.float32()),),
+    'ppg': (('value', pa.int32()),),
+    'accelerometer': (('x_value', pa.float32()), ('y_value', pa.float32()), ('z_value', pa.float32())),
+    'gyroscope': (('x_value', pa.float32()), ('y_value', pa.float32()), ('z_value', pa.float32())),
+}
+
+PARQUET_MIME_TYPE = 'application/vnd.apache.parquet'
+
+# Rows read from SQLite per step, which is also the Parquet row group size
+DEFAULT_CHUNK_ROWS = 100_000
+
+# Files of the dataset are split after this many rows
+DEFAULT_ROWS_PER_FILE = 2_000_000
+
+
+def export_schema(table, with_device=True):
+    fields = [('device_id', pa.string())] if with_device else []
+    return pa.schema(fields + [('ts_us', pa.int64())] + list(EXPORT_COLUMNS[table]))
+
+
+def _device_ids(conn, table, start_us, end_us):
+    devices = set()
+    sources = [table] + ([CHUNK_TABLES[table]] if table in CHUNKED_STREAMS else [])
+    for source in sources:
+        for name, _, _ in table_partitions(conn, source, start_us, end_us):
+            devices.update(row[0] for row in conn.execute(f'SELECT DISTINCT device_id FROM {name}'))
+    return sorted(devices)
+
+
+def _record_batch(table, device_id, ts_us, columns):
+    arrays = [pa.array(np.full(len(ts_us), device_id, dtype=object), pa.string()),
+              pa.array(np.asarray(ts_us, dtype=np.int64))]
+    for (_, column_type), values in zip(EXPORT_COLUMNS[table], columns):
+        values = np.asarray(values, dtype=np.float64)
+        if pa.types.is_integer(column_type):
+            values = np.rint(values)
+        arrays.append(pa.array(values.astype(column_type.to_pandas_dtype())))
+    return pa.RecordBatch.from_arrays(arrays, schema=export_schema(table))
+
+
+def iter_export_batches(conn, table, device_id=None, start_us=None, end_us=None, chunk_rows=DEFAULT_CHUNK_ROWS):
+    """
+    Readings of table as pyarrow RecordBatches of at most chunk_rows rows, ordered by
+    device and, per device, by storage (rows, then chunks) and ts_us. Rows without
+    ts_us (not converted by the timestamp migration yet) are left out.
+    """
+    names = [name for name, _ in EXPORT_COLUMNS[table]]
+    conditions = ['device_id = ?', 'ts_us IS NOT NULL']
+    bounds = []
+    if start_us is not None:
+        conditions.append('ts_us >= ?')
+        bounds.append(start_us)
+    if end_us is not None:
+        conditions.append('ts_us < ?')
+        bounds.append(end_us)
+
+    partitions = table_partitions(conn, table, start_us, end_us)
+    # Oldest first, the legacy table before the partitions
+    partitions = partitions[:1] + partitions[:0:-1]
+
+    for device in [device_id] if device_id else _device_ids(conn, table, start_us, end_us):
+        for name, _, _ in partitions:
+            cursor = conn.execute(
+                f"SELECT ts_us, {', '.join(names)} FROM {name} WHERE {' AND '.join(conditions)} ORDER BY ts_us",
+                [device] + bounds
+            )
+            while True:
+                rows = cursor.fetchmany(chunk_rows)
+                if not rows:
+                    break
+                columns = list(zip(*rows))
+                yield _record_batch(table, device, columns[0], columns[1:])
+
+        if table in CHUNKED_STREAMS:
+            pending_ts, pending_columns, pending = [], [], 0
+            for _, ts_us, columns in iter_chunks(conn, table, device, start_us, end_us):
+                pending_ts.append(ts_us)
+                pending_columns.append(columns)
+                pending += len(ts_us)
+                if pending >= chunk_rows:
+                    yield _record_batch(table, device, np.concatenate(pending_ts),
+                                        [np.concatenate(column) for column in zip(*pending_columns)])
+                    pending_ts, pending_columns, pending = [], [], 0
+            if pending:
+                yield _record_batch(table, device, np.concatenate(pending_ts),
+                                    [np.concatenate(column) for column in zip(*pending_columns)])
+
+
+class _StreamSink:
+    # Write-only file collecting what the Parquet writer produced since the last take()
+    def __init__(self):
+        self.parts = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def take(self):
+        data = b''.join(self.parts)
+        self.parts = []
+        return data
+
+
+def stream_parquet(conn, table, device_id=None, start_us=None, end_us=None, chunk_rows=DEFAULT_CHUNK_ROWS):
+    """Yield the bytes of one Parquet file of the readings, a row group at a time."""
+    sink = _StreamSink()
+    # The writer does not close files it did not open, the PythonFile must be closed
+    # explicitly (pyarrow aborts the interpreter when it is finalized open)
+    out = pa.PythonFile(sink, mode='w')
+    writer = pq.ParquetWriter(out, export_schema(table), compression='zstd')
+    try:
+        for batch in iter_export_batches(conn, table, device_id, start_us, end_us, chunk_rows):
+            writer.write_batch(batch)
+            yield sink.take()
+    finally:
+        writer.close()
+        out.close()
+    yield sink.take()
+
+
+class _DatasetWriter:
+    # Writes batches of one device at a time into device_id=/date= directories,
+    # starting a new file when the directory changes or the file is full
+    def __init__(self, root, table, rows_per_file):
+        self.root = root
+        self.schema = export_schema(table, with_device=False)
+        self.rows_per_file = rows_per_file
+        self.files = []
+        self._parts = {}
+        self._writer = None
+        self._current = None
+
+    def write(self, batch):
+        device_id = batch.column(0)[0].as_py()
+        ts_us = batch.column(1).to_numpy()
+        days = ts_us // 86_400_000_000
+        # Readings are sorted per storage, so a batch holds a few runs of days
+        boundaries = np.flatnonzero(np.diff(days)) + 1
+        for start, end in zip(np.r_[0, boundaries], np.r_[boundaries, len(days)]):
+            date = datetime.date(1970, 1, 1) + datetime.timedelta(days=int(days[start]))
+            run = batch.slice(start, end - start)
+            self._write_run(device_id, date, pa.RecordBatch.from_arrays(run.columns[1:], schema=self.schema))
+
+    def _write_run(self, device_id, date, batch):
+        directory = (device_id, date)
+        if self._current is None or self._current['directory'] != directory \
+                or (self._current['rows'] and self._current['rows'] + batch.num_rows > self.rows_per_file):
+            self._close_file()
+            self._open_file(directory)
+        self._writer.write_batch(batch)
+        ts_us = batch.column(0).to_numpy()
+        self._current['rows'] += batch.num_rows
+        self._current['min_ts_us'] = min(self._current['min_ts_us'], int(ts_us.min()))
+        self._current['max_ts_us'] = max(self._current['max_ts_us'], int(ts_us.max()))
+
+    def _open_file(self, directory):
+        device_id, date = directory
+        part = self._parts.get(directory, 0)
+        self._parts[directory] = part + 1
+        path = os.path.join(f'device_id={urllib.parse.quote(device_id, safe="")}', f'date={date.isoformat()}',
+                            f'part-{part:05d}.parquet')
+        os.makedirs(os.path.join(self.root, os.path.dirname(path)), exist_ok=True)
+        self._writer = pq.ParquetWriter(os.path.join(self.root, path), self.schema, compression='zstd')
+        self._current = {'path': path, 'directory': directory, 'rows': 0,
+                         'min_ts_us': float('inf'), 'max_ts_us': float('-inf')}
+
+    def _close_file(self):
+        if self._writer is None:
+            return
+        self._writer.close()
+        device_id, date = self._current.pop('directory')
+        self.files.append(dict(self._current, device_id=device_id, date=date.isoformat(),
+                               bytes=os.path.getsize(os.path.join(self.root, self._current['path']))))
+        self._writer = None
+        self._current = None
+
+    def close(self):
+        self._close_file()
+
+
+def export_dataset(conn, table, out_dir, device_id=None, start_us=None, end_us=None,
+                   chunk_rows=DEFAULT_CHUNK_ROWS, rows_per_file=DEFAULT_ROWS_PER_FILE):
+    """Export readings of table to <out_dir>/<table>/ as partitioned Parquet files. Returns the manifest."""
+    root = os.path.join(out_dir, table)
+    if os.path.exists(os.path.join(root, '_manifest.json')):
+        raise ValueError(f'{root} already holds an export')
+    os.makedirs(root, exist_ok=True)
+
+    started = time.time()
+    writer = _DatasetWriter(root, table, rows_per_file)
+    try:
+        for batch in iter_export_batches(conn, table, device_id, start_us, end_us, chunk_rows):
+            writer.write(batch)
+    finally:
+        writer.close()
+
+    manifest = {
+        'table': table,
+        'device_id': device_id,
+        'start_us': start_us,
+        'end_us': end_us,
+        'created_at': datetime.datetime.now().isoformat(),
+        'partitioning': ['device_id', 'date'],
+        'schema': {field.name: str(field.type) for field in export_schema(table)},
+        'rows': sum(entry['rows'] for entry in writer.files),
+        'files': writer.files,
+        'export_time_ms': int((time.time() - started) * 1000),
+    }
+    # Written last: a directory without a manifest is an incomplete export
+    with open(os.path.join(root, '_manifest.json.tmp'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(os.path.join(root, '_manifest.json.tmp'), os.path.join(root, '_manifest.json'))
+    return manifest
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export sensor readings to partitioned Parquet files')
+    parser.add_argument('table', choices=sorted(EXPORT_COLUMNS))
+    parser.add_argument('out_dir')
+    parser.add_argument('--device-id', default=None)
+    parser.add_argument('--start', default=None, help='ISO timestamp, local time unless it has an offset')
+    parser.add_argument('--end', default=None)
+    parser.add_argument('--database', default=None)
+    parser.add_argument('--chunk-rows', type=int, default=DEFAULT_CHUNK_ROWS)
+    parser.add_argument('--rows-per-file', type=int, default=DEFAULT_ROWS_PER_FILE)
+    args = parser.parse_args()
+
+    conn = db.connect(args.database)
+    try:
+        manifest = export_dataset(
+            conn, args.table, args.out_dir, args.device_id,
+            parse_timestamp_us(args.start) if args.start else None,
+            parse_timestamp_us(args.end) if args.end else None,
+            args.chunk_rows, args.rows_per_file
+        )
+    finally:
+        conn.close()
+    print(f"Exported {manifest['rows']:,} {args.table} readings to {len(manifest['files'])} files "
+          f"in {manifest['export_time_ms'] / 1000:.1f} s")
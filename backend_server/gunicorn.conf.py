@@ -0,0 +1,55 @@
+# gunicorn.conf.py - Multi-worker production server
+#
+#   gunicorn -c gunicorn.conf.py "app:create_app()"
+#
+# Serves on SERVER_HOST:SERVER_PORT with WEB_WORKERS processes of WEB_THREADS threads
+# (threads, since the live feed and WebSocket streams hold one for as long as they are
+# open). INGEST_MODE defaults to 'writer' here: the master starts the writer process
+# (writer.py) before the workers and stops it after them, so the writes of every
+# worker are committed by a single process, while reads run in all of them.
+
+import os
+import secrets
+import subprocess
+import sys
+import time
+
+os.environ.setdefault('INGEST_MODE', 'writer')
+# The workers and the writer authenticate with a key of this launch, inherited through
+# the environment (set before config is imported, the workers are forked with it)
+os.environ.setdefault('WRITER_AUTHKEY', secrets.token_hex(32))
+
+# Imported under another name, gunicorn reads every name of this file as a setting
+import config as settings  # noqa: E402
+
+bind = f'{settings.SERVER_HOST}:{settings.SERVER_PORT}'
+workers = settings.WEB_WORKERS
+threads = settings.WEB_THREADS
+worker_class = 'gthread'
+# Live feed streams stay open, a keepalive is sent every LIVE_FEED_KEEPALIVE_S
+timeout = 120
+accesslog = None
+
+_writer = None
+
+
+def on_starting(server):
+    global _writer
+    if settings.INGEST_MODE != 'writer':
+        return
+    # A socket left behind by a killed writer would look like a started one
+    if os.path.exists(settings.WRITER_ADDRESS):
+        os.unlink(settings.WRITER_ADDRESS)
+    _writer = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'writer.py')])
+    # The workers connect as soon as they start, and the writer applies the migrations first
+    deadline = time.monotonic() + 60
+    while not os.path.exists(settings.WRITER_ADDRESS):
+        if _writer.poll() is not None or time.monotonic() > deadline:
+            raise RuntimeError('The writer process did not start')
+        time.sleep(0.1)
+
+
+def on_exit(server):
+    if _writer is not None and _writer.poll() is None:
+        _writer.terminate()
+        _writer.wait()
@@ -0,0 +1,513 @@
+# ingest.py - Batch payload preparation and the write-behind ingest queue
+
+import collections
+import datetime
+import queue
+import sqlite3
+import threading
+import time
+
+import config
+import db
+import logs
+from chunks import CHUNK_TABLES, uses_chunks, write_chunk_rows
+from devices import record_readings
+from metrics import INGEST_BATCHES, INGEST_ERRORS, INGEST_LOST_READINGS, INGEST_ROWS, INGEST_STAGE_SECONDS, INGEST_TABLE_SECONDS
+from partitions import insert_rows
+from rollups import ROLLUP_TABLES, update_rollups
+from timestamps import parse_timestamp_us
+
+log = logs.get_logger('ingest')
+
+# Backoff of the queue's writer thread while the database is locked by another writer
+BUSY_RETRY_INITIAL_S = 0.05
+BUSY_RETRY_MAX_S = 2.0
+
+# Insert statement for every sensor table fed by /api/batch
+INSERT_STATEMENTS = {
+    'heartrates': 'INSERT INTO heartrates (device_id, heart_rate, timestamp, ts_us) VALUES (?, ?, ?, ?)',
+    'skin_temperature': 'INSERT INTO skin_temperature (device_id, value, timestamp, ts_us) VALUES (?, ?, ?, ?)',
+    'gsr': 'INSERT INTO gsr (device_id, value, timestamp, ts_us) VALUES (?, ?, ?, ?)',
+    'light': 'INSERT INTO light (device_id, value, timestamp, ts_us) VALUES (?, ?, ?, ?)',
+    'ppg': 'INSERT INTO ppg (device_id, value, timestamp, ts_us) VALUES (?, ?, ?, ?)',
+    'accelerometer': 'INSERT INTO accelerometer (device_id, x_value, y_value, z_value, timestamp, ts_us) VALUES (?, ?, ?, ?, ?, ?)',
+    'gyroscope': 'INSERT INTO gyroscope (device_id, x_value, y_value, z_value, timestamp, ts_us) VALUES (?, ?, ?, ?, ?, ?)',
+}
+
+# Every table holding sensor readings
+SENSOR_TABLES = tuple(INSERT_STATEMENTS)
+
+# Every time partitioned table: the sensor tables, the chunk tables (see chunks.py)
+# and the rollups (see rollups.py)
+STORAGE_TABLES = SENSOR_TABLES + tuple(CHUNK_TABLES.values()) + ROLLUP_TABLES
+
+# Sensor names of the API routes (/api/heartrate, ...) and their tables
+API_SENSORS = {
+    'heartrate': 'heartrates',
+    'skin_temperature': 'skin_temperature',
+    'gsr': 'gsr',
+    'light': 'light',
+    'ppg': 'ppg',
+    'accelerometer': 'accelerometer',
+    'gyroscope': 'gyroscope',
+}
+
+# Human readable names used in the "Inserted N ... readings" messages
+READING_NAMES = {
+    'heartrates': 'heart rate',
+    'skin_temperature': 'skin temperature',
+    'gsr': 'GSR',
+    'light': 'light',
+    'ppg': 'PPG',
+    'accelerometer': 'accelerometer',
+    'gyroscope': 'gyroscope',
+}
+
+HEALTH_DATA_TYPES = ('skin_temperature', 'gsr', 'light', 'ppg')
+MOTION_DATA_TYPES = ('accelerometer', 'gyroscope')
+
+# Sections of a batch payload holding readings
+BATCH_SECTIONS = ('heart_rate_data', 'health_data', 'motion_data')
+
+
+class PreparedBatch:
+    """A validated batch, with its readings grouped by destination table."""
+
+    def __init__(self, device_id, batch_timestamp):
+        self.device_id = device_id
+        self.batch_timestamp = batch_timestamp
+        self.rows = {table: [] for table in INSERT_STATEMENTS}
+        self.processing_time_ms = 0
+        self.enqueued_at = None
+        # Client supplied batch id (if any) and the key used to recognise retries
+        self.client_batch_id = None
+        self.batch_key = None
+        # The readings of the single-reading endpoints are queued like a batch in writer
+        # mode, but are not batches to batch_logs
+        self.logged = True
+
+    def count(self, table):
+        return len(self.rows[table])
+
+    def table_rows(self):
+        """(table, rows) pairs to insert, see write_batch_rows."""
+        return ((table, rows) for table, rows in self.rows.items() if rows)
+
+    @property
+    def heart_rate_count(self):
+        return self.count('heartrates')
+
+    @property
+    def health_data_count(self):
+        return sum(self.count(table) for table in HEALTH_DATA_TYPES)
+
+    @property
+    def motion_data_count(self):
+        return sum(self.count(table) for table in MOTION_DATA_TYPES)
+
+    @property
+    def total_records(self):
+        return self.heart_rate_count + self.health_data_count + self.motion_data_count
+
+    def summary(self):
+        return {
+            'device_id': self.device_id,
+            'total_records': self.total_records,
+            'heart_rate_count': self.heart_rate_count,
+            'health_data_count': self.health_data_count,
+            'motion_data_count': self.motion_data_count,
+            'processing_time_ms': self.processing_time_ms
+        }
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _reading_list(data, key):
+    readings = data.get(key) or []
+    if not isinstance(readings, list):
+        raise ValueError(f"'{key}' must be a list")
+    return readings
+
+
+def reading_row(section, reading):
+    """
+    Validate one reading of a batch section ('heart_rate_data', 'health_data'
+    or 'motion_data') and return its (table, values) pair, values being the
+    row without its device_id (ending with the ISO timestamp and its epoch
+    microseconds). Readings of unknown types return None.
+    """
+    if not isinstance(reading, dict):
+        raise ValueError(f"'{section}' entries must be objects")
+    timestamp = reading.get('timestamp')
+    if not timestamp:
+        raise ValueError(f"'{section}' entry is missing its timestamp")
+    # The ISO string is kept as sent, ts_us is what queries sort and filter on
+    ts_us = parse_timestamp_us(timestamp)
+
+    if section == 'heart_rate_data':
+        heart_rate = reading.get('heart_rate')
+        if not _is_number(heart_rate):
+            raise ValueError('Invalid heart rate value')
+        return 'heartrates', (heart_rate, timestamp, ts_us)
+
+    data_type = reading.get('data_type')
+    if section == 'health_data' and data_type in HEALTH_DATA_TYPES:
+        value = reading.get('value')
+        if not _is_number(value):
+            raise ValueError(f'Invalid {data_type} value')
+        return data_type, (value, timestamp, ts_us)
+
+    if section == 'motion_data' and data_type in MOTION_DATA_TYPES:
+        x_value = reading.get('x_value')
+        y_value = reading.get('y_value')
+        z_value = reading.get('z_value')
+        if not (_is_number(x_value) and _is_number(y_value) and _is_number(z_value)):
+            raise ValueError(f'Invalid {data_type} value')
+        return data_type, (x_value, y_value, z_value, timestamp, ts_us)
+
+    return None
+
+
+def prepare_batch(data):
+    """
+    Validate a /api/batch payload and group its readings by table.
+
+    Raises ValueError when the payload cannot be stored, so that queued
+    batches never fail later inside the writer thread.
+    """
+    if not isinstance(data, dict):
+        raise ValueError('Batch payload must be a JSON object')
+
+    batch = PreparedBatch(
+        data.get('device_id', 'unknown'),
+        data.get('batch_timestamp', datetime.datetime.now().isoformat())
+    )
+    batch.client_batch_id = data.get('batch_id')
+    device_key = (batch.device_id,)
+
+    # Heart rate data, health data (skin temp, GSR, light, PPG) and motion data
+    # (accelerometer, gyroscope); readings of unknown types are ignored
+    for section in BATCH_SECTIONS:
+        for reading in _reading_list(data, section):
+            row = reading_row(section, reading)
+            if row is not None:
+                table, values = row
+                batch.rows[table].append(device_key + values)
+
+    return batch
+
+
+def readings_batch(table, rows):
+    """The rows of a single-reading endpoint (all of one device) as an unlogged PreparedBatch."""
+    batch = PreparedBatch(rows[0][0], datetime.datetime.now().isoformat())
+    batch.rows[table].extend(rows)
+    batch.logged = False
+    return batch
+
+
+def insert_readings(c, table, rows):
+    """Insert rows (ending with timestamp, ts_us) of a sensor table into its time partitions."""
+    with INGEST_TABLE_SECONDS.time(table, 'insert'):
+        if uses_chunks(table):
+            write_chunk_rows(c, table, rows)
+        else:
+            insert_rows(c, table, rows, INSERT_STATEMENTS[table])
+    # Same transaction, so the rollups and the registry never disagree with the readings
+    if config.ROLLUPS == 'on':
+        with INGEST_TABLE_SECONDS.time(table, 'rollups'):
+            update_rollups(c, table, rows)
+    with INGEST_TABLE_SECONDS.time(table, 'registry'):
+        record_readings(c, table, rows)
+    INGEST_ROWS.inc(table, amount=len(rows))
+
+
+def write_batch_rows(c, batch):
+    """Insert the readings of a prepared (or streamed) batch using the given cursor."""
+    for table, rows in batch.table_rows():
+        insert_readings(c, table, rows)
+        log.debug('readings_inserted', device_id=batch.device_id, sensor=READING_NAMES[table], count=len(rows))
+
+
+def log_batch(c, batch, queue_time_ms=0, commit_time_ms=0):
+    """Record a processed batch in batch_logs."""
+    created_at = datetime.datetime.now()
+    c.execute('''
+        INSERT INTO batch_logs
+        (device_id, batch_timestamp, heart_rate_count, health_data_count, motion_data_count,
+         total_records, processing_time_ms, queue_time_ms, commit_time_ms, batch_key, created_at, created_us)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', (
+        batch.device_id, batch.batch_timestamp, batch.heart_rate_count, batch.health_data_count,
+        batch.motion_data_count, batch.total_records, batch.processing_time_ms,
+        queue_time_ms, commit_time_ms, batch.batch_key, created_at.isoformat(),
+        int(created_at.timestamp() * 1_000_000)
+    ))
+
+
+def recent_batches(conn, device_id=None, limit=50):
+    """The newest batch_logs rows (optionally of one device), as dicts, newest first."""
+    query = 'SELECT * FROM batch_logs'
+    params = []
+    if device_id:
+        query += ' WHERE device_id = ?'
+        params.append(device_id)
+    # Served by the created_us indexes, see migrations.py
+    query += ' ORDER BY created_us DESC LIMIT ?'
+    params.append(limit)
+    return [dict(row) for row in conn.execute(query, params)]
+
+
+def _is_duplicate_key(error):
+    # The unique batch_key index of batch_logs, see dedup.py
+    return 'batch_logs.batch_key' in str(error)
+
+
+class DeviceQueueFull(queue.Full):
+    """The device already has its share of the write-behind queue."""
+
+
+class DeviceQueues:
+    """
+    Bounded queue of batches served one device at a time, in turn: a device that
+    queued a hundred batches gets one of them taken per round, like every other
+    device with something queued. Takes the place of a queue.Queue (put_nowait,
+    get, task_done, join, qsize), with at most device_maxsize batches per device.
+    """
+
+    def __init__(self, maxsize, device_maxsize=0):
+        self.maxsize = maxsize
+        self.device_maxsize = device_maxsize
+        # Device id -> its batches, devices in serving order
+        self._devices = collections.OrderedDict()
+        self._size = 0
+        self._unfinished = 0
+        self._last = None
+        self._condition = threading.Condition()
+
+    def qsize(self):
+        return self._size
+
+    def device_sizes(self):
+        with self._condition:
+            return {device_id: len(batches) for device_id, batches in self._devices.items()}
+
+    def put_nowait(self, batch):
+        """Raises queue.Full when the queue is full, DeviceQueueFull when the device's share is."""
+        with self._condition:
+            if self._size >= self.maxsize:
+                raise queue.Full
+            batches = self._devices.get(batch.device_id)
+            if batches is None:
+                batches = self._devices[batch.device_id] = collections.deque()
+            elif self.device_maxsize and len(batches) >= self.device_maxsize:
+                raise DeviceQueueFull
+            batches.append(batch)
+            self._size += 1
+            self._unfinished += 1
+            self._condition.notify_all()
+
+    def put(self, item):
+        """Queue an item (the stop marker) returned once every batch has been taken."""
+        with self._condition:
+            self._last = item
+            self._unfinished += 1
+            self._condition.notify_all()
+
+    def get(self, timeout=None):
+        with self._condition:
+            if not self._condition.wait_for(lambda: self._size or self._last is not None, timeout):
+                raise queue.Empty
+            if not self._size:
+                item, self._last = self._last, None
+                return item
+            device_id, batches = self._devices.popitem(last=False)
+            batch = batches.popleft()
+            self._size -= 1
+            if batches:
+                # Back at the end of the round
+                self._devices[device_id] = batches
+            return batch
+
+    def get_nowait(self):
+        return self.get(timeout=0)
+
+    def task_done(self):
+        with self._condition:
+            self._unfinished -= 1
+            self._condition.notify_all()
+
+    def join(self):
+        with self._condition:
+            self._condition.wait_for(lambda: not self._unfinished)
+
+
+class IngestQueue:
+    """
+    Bounded write-behind queue drained by a single writer thread.
+
+    The writer collects every batch that arrives within the flush interval
+    (up to max_group_size batches and max_group_rows readings) and commits them
+    in one transaction, so concurrent devices share a single write lock
+    acquisition and fsync. Devices are served in turn (see DeviceQueues), so a
+    device with a backlog adds at most one batch to each group.
+    """
+
+    _STOP = object()
+
+    def __init__(self, db_path, maxsize, flush_interval_ms, max_group_size, on_drop=None, on_commit=None,
+                 device_maxsize=0, max_group_rows=0, on_duplicate=None):
+        self.db_path = db_path
+        self.on_drop = on_drop
+        self.on_commit = on_commit
+        self.on_duplicate = on_duplicate
+        self.flush_interval = flush_interval_ms / 1000.0
+        self.max_group_size = max_group_size
+        self.max_group_rows = max_group_rows
+        self._queue = DeviceQueues(maxsize, device_maxsize)
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='ingest-writer', daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                self._queue.put(self._STOP)
+                self._thread.join()
+            self._thread = None
+
+    def depth(self):
+        return self._queue.qsize()
+
+    def device_depths(self):
+        """Queued batches per device."""
+        return self._queue.device_sizes()
+
+    def wait_until_empty(self):
+        """Block until every queued batch has been committed (or dropped)."""
+        self._queue.join()
+
+    def submit(self, batch):
+        """
+        Queue a prepared batch. Raises queue.Full when the writer is saturated, and
+        DeviceQueueFull when the batch's device already has its share of the queue.
+        """
+        self.start()
+        batch.enqueued_at = time.time()
+        self._queue.put_nowait(batch)
+
+    def _collect_group(self):
+        group = [self._queue.get()]
+        if group[0] is self._STOP:
+            return group
+        deadline = time.time() + self.flush_interval
+        rows = group[0].total_records
+        while len(group) < self.max_group_size and not (self.max_group_rows and rows >= self.max_group_rows):
+            remaining = deadline - time.time()
+            try:
+                item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            group.append(item)
+            if item is self._STOP:
+                break
+            rows += item.total_records
+        return group
+
+    def _run(self):
+        conn = db.connect(self.db_path)
+        try:
+            while True:
+                group = self._collect_group()
+                stopping = group[-1] is self._STOP
+                batches = [item for item in group if item is not self._STOP]
+                if batches:
+                    self._commit_group(conn, batches)
+                for _ in group:
+                    self._queue.task_done()
+                if stopping:
+                    break
+        finally:
+            conn.close()
+
+    def _commit_group(self, conn, batches):
+        started = time.time()
+        try:
+            self._write_when_unlocked(conn, batches, started)
+            log.info('queued_batches_committed', batches=len(batches),
+                     elapsed_ms=int((time.time() - started) * 1000))
+        except Exception as e:
+            # One bad batch must not take the others down with it: retry them one by one
+            log.warning('group_commit_failed', batches=len(batches), error=str(e))
+            for batch in batches:
+                try:
+                    self._write_when_unlocked(conn, [batch], time.time())
+                except sqlite3.IntegrityError as batch_error:
+                    if not _is_duplicate_key(batch_error):
+                        self._dropped(batch, batch_error)
+                        continue
+                    # A retry of the batch queued next to it was committed first: nothing is
+                    # lost, and the dedup cache entry is the committed batch's
+                    log.info('queued_batch_duplicate', device_id=batch.device_id, batch_key=batch.batch_key)
+                    INGEST_BATCHES.inc('duplicate_queued')
+                    if self.on_duplicate is not None:
+                        self.on_duplicate(batch)
+                except Exception as batch_error:
+                    self._dropped(batch, batch_error)
+
+    def _dropped(self, batch, error):
+        # The device was told 202: what is dropped here is lost
+        log.error('queued_batch_dropped', device_id=batch.device_id, total_records=batch.total_records,
+                  error=str(error))
+        INGEST_ERRORS.inc('queue_dropped')
+        INGEST_LOST_READINGS.inc(type(error).__name__, amount=batch.total_records)
+        if self.on_drop is not None:
+            self.on_drop(batch)
+
+    def _write_when_unlocked(self, conn, batches, started):
+        """
+        _write, retried with backoff for as long as the database is locked (a streamed
+        batch or another process writing, a checkpoint): the batches were acknowledged,
+        only a data error may drop them. The queue fills up meanwhile and /api/batch
+        answers 503 when it is full.
+        """
+        delay = BUSY_RETRY_INITIAL_S
+        while True:
+            try:
+                return self._write(conn, batches, started)
+            except Exception as e:
+                conn.rollback()
+                if not db.is_busy(e):
+                    raise
+                log.warning('queued_batches_retried', batches=len(batches), retry_in_ms=int(delay * 1000),
+                            error=str(e))
+                time.sleep(delay)
+                delay = min(delay * 2, BUSY_RETRY_MAX_S)
+
+    def _write(self, conn, batches, started):
+        c = conn.cursor()
+        c.execute('BEGIN IMMEDIATE')
+        with INGEST_STAGE_SECONDS.time('write'):
+            for batch in batches:
+                write_batch_rows(c, batch)
+        # The log rows are part of the same transaction, so the commit time covers
+        # everything the group spent inside the transaction before the final COMMIT
+        commit_time_ms = int((time.time() - started) * 1000)
+        with INGEST_STAGE_SECONDS.time('log'):
+            for batch in batches:
+                if batch.logged:
+                    queue_time_ms = int((started - batch.enqueued_at) * 1000)
+                    log_batch(c, batch, queue_time_ms, commit_time_ms)
+        with INGEST_STAGE_SECONDS.time('commit'):
+            conn.commit()
+        for batch in batches:
+            INGEST_STAGE_SECONDS.observe(started - batch.enqueued_at, 'queue_wait')
+        if self.on_commit is not None:
+            for batch in batches:
+                self.on_commit(batch)
@@ -0,0 +1,134 @@
+# livefeed.py - In-process fan-out of committed readings to live dashboard clients
+#
+# GET /api/devices/<device_id>/live is a Server-Sent Events stream. Every ingest commit
+# publishes the new readings of its device, one event per sensor named after the API
+# sensor ('heartrate', 'gsr', ...) with a JSON list of readings shaped like the GET
+# endpoints' (oldest first, id null), so the dashboard only ever receives what it
+# does not have yet. An event is serialized once, whatever the number of subscribers.
+#
+# A 'reload' event lists sensors the client should fetch through the GET endpoints
+# instead: readings the publisher did not hold (streamed batches), more readings
+# than LIVE_FEED_MAX_READINGS, or events dropped because the client fell behind.
+
+import collections
+import json
+import threading
+
+from ingest import API_SENSORS
+from readings import reading_columns
+
+# API sensor name of every sensor table
+_SENSOR_NAMES = {table: sensor for sensor, table in API_SENSORS.items()}
+
+
+def sse_message(event, data):
+    """One Server-Sent Events message."""
+    return f'event: {event}\ndata: {json.dumps(data)}\n\n'
+
+
+class Subscription:
+    """Events of one device for one client, bounded to maxsize pending messages."""
+
+    def __init__(self, device_id, sensors, maxsize):
+        self.device_id = device_id
+        self.sensors = sensors
+        self._maxsize = maxsize
+        self._messages = collections.deque()
+        self._reload = set()
+        self._ready = threading.Condition()
+
+    def put(self, sensor, message):
+        with self._ready:
+            if sensor in self._reload:
+                # Covered by the pending reload
+                pass
+            elif len(self._messages) >= self._maxsize:
+                # The client fell behind: what it has not read is replaced by a reload
+                self._reload.update(self.sensors)
+                self._messages.clear()
+            else:
+                self._messages.append(message)
+            self._ready.notify()
+
+    def reload(self, sensors):
+        with self._ready:
+            self._reload.update(sensor for sensor in sensors if sensor in self.sensors)
+            self._ready.notify()
+
+    def get(self, timeout):
+        """The next message, or None when nothing arrived within timeout seconds."""
+        with self._ready:
+            if not self._messages and not self._reload:
+                self._ready.wait(timeout)
+            # Reloads first: the readings queued after one are newer than what it fetches
+            if self._reload:
+                sensors = sorted(self._reload)
+                self._reload.clear()
+                return sse_message('reload', sensors)
+            return self._messages.popleft() if self._messages else None
+
+
+class LiveFeed:
+    """Subscriptions by device and the publishing side used by ingest."""
+
+    def __init__(self, queue_size, max_readings):
+        self.queue_size = queue_size
+        self.max_readings = max_readings
+        self._subscriptions = collections.defaultdict(set)
+        self._lock = threading.Lock()
+
+    def subscribe(self, device_id, sensors=None):
+        subscription = Subscription(device_id, frozenset(sensors or API_SENSORS), self.queue_size)
+        with self._lock:
+            self._subscriptions[device_id].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscribers = self._subscriptions.get(subscription.device_id)
+            if subscribers is not None:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self._subscriptions[subscription.device_id]
+
+    def subscriber_count(self):
+        with self._lock:
+            return sum(len(subscribers) for subscribers in self._subscriptions.values())
+
+    def device_ids(self):
+        """Devices with at least one subscriber."""
+        with self._lock:
+            return set(self._subscriptions)
+
+    def _subscribers(self, device_id):
+        with self._lock:
+            return list(self._subscriptions.get(device_id, ()))
+
+    def publish(self, device_id, table, rows):
+        """
+        Committed rows of a sensor table, (device_id, values..., timestamp, ts_us) as
+        passed to insert_readings, or None when they are not at hand (subscribers
+        reload the sensor instead).
+        """
+        sensor = _SENSOR_NAMES[table]
+        subscribers = [s for s in self._subscribers(device_id) if sensor in s.sensors]
+        if not subscribers:
+            return
+        if rows is None or len(rows) > self.max_readings:
+            for subscription in subscribers:
+                subscription.reload([sensor])
+            return
+
+        columns = reading_columns(table)
+        readings = sorted((dict(zip(columns, (None,) + tuple(row))) for row in rows),
+                          key=lambda reading: reading['ts_us'])
+        message = sse_message(sensor, readings)
+        for subscription in subscribers:
+            subscription.put(sensor, message)
+
+    def publish_batch(self, batch):
+        """Publish the readings of a committed batch."""
+        for table, rows in batch.rows.items():
+            if batch.count(table):
+                # Streamed batches were written while parsing, only their counts are kept
+                self.publish(batch.device_id, table, rows if len(rows) == batch.count(table) else None)
@@ -0,0 +1,214 @@
+# logs.py - Structured, sampled logging that never blocks a request on its output
+#
+# Server code logs events, a name and fields:
+#   log.info('batch_processed', device_id='w1', total_records=230, processing_time_ms=12)
+# written as one line, 'text' (time level logger event key=value ...) or 'json'.
+#
+# Records go through a bounded queue to a listener thread that does the formatting and
+# the writing (logging.handlers.QueueHandler / QueueListener), so request threads never
+# wait for a terminal or a pipe. Before a record is even created, events below LOG_LEVEL
+# are skipped, sampled events (LOG_SAMPLING, e.g. 'batch_processed=0.1') are kept with
+# their probability and every event is limited to LOG_RATE_LIMIT records per second. The
+# number of records left out of an event is added to its next record as 'suppressed'.
+
+import atexit
+import datetime
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+import threading
+import time
+
+import config
+
+ROOT_LOGGER = 'health'
+
+
+class _Limiter:
+    """Sampling and per-event rate limiting, shared by every EventLogger."""
+
+    def __init__(self):
+        self.sampling = {}
+        self.rate_limit = 0
+        self._events = {}
+        self._lock = threading.Lock()
+
+    def admit(self, event):
+        """None when the record is left out, otherwise how many were left out before it."""
+        probability = self.sampling.get(event)
+        with self._lock:
+            # [start of the current second, records written in it, records left out]
+            state = self._events.get(event)
+            if state is None:
+                state = self._events[event] = [0.0, 0, 0]
+            if probability is not None and random.random() >= probability:
+                state[2] += 1
+                return None
+            if self.rate_limit:
+                now = time.monotonic()
+                if now - state[0] >= 1:
+                    state[0], state[1] = now, 0
+                if state[1] >= self.rate_limit:
+                    state[2] += 1
+                    return None
+                state[1] += 1
+            suppressed, state[2] = state[2], 0
+            return suppressed
+
+    def suppressed(self):
+        with self._lock:
+            return sum(state[2] for state in self._events.values())
+
+
+_limiter = _Limiter()
+
+
+class EventLogger:
+    """Logger of structured events, see the top of the module."""
+
+    def __init__(self, name):
+        self._logger = logging.getLogger(f'{ROOT_LOGGER}.{name}')
+
+    def _log(self, level, event, fields, exc_info=False):
+        if not self._logger.isEnabledFor(level):
+            return
+        suppressed = _limiter.admit(event)
+        if suppressed is None:
+            return
+        if suppressed:
+            fields['suppressed'] = suppressed
+        self._logger.log(level, event, exc_info=exc_info, extra={'fields': fields})
+
+    def debug(self, event, **fields):
+        self._log(logging.DEBUG, event, fields)
+
+    def info(self, event, **fields):
+        self._log(logging.INFO, event, fields)
+
+    def warning(self, event, **fields):
+        self._log(logging.WARNING, event, fields)
+
+    def error(self, event, exc_info=False, **fields):
+        self._log(logging.ERROR, event, fields, exc_info)
+
+
+def get_logger(name):
+    return EventLogger(name)
+
+
+def _text_value(value):
+    text = str(value)
+    return json.dumps(text) if not text or any(c in text for c in ' "=\n') else text
+
+
+class StructuredFormatter(logging.Formatter):
+    """One line per record, 'text' (key=value) or 'json'."""
+
+    def __init__(self, style='text'):
+        super().__init__()
+        self.style = style
+
+    def format(self, record):
+        fields = getattr(record, 'fields', {})
+        when = datetime.datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds')
+        exception = self.formatException(record.exc_info) if record.exc_info else None
+        if self.style == 'json':
+            entry = {'time': when, 'level': record.levelname, 'logger': record.name,
+                     'event': record.getMessage(), **fields}
+            if exception:
+                entry['exception'] = exception
+            return json.dumps(entry, default=str)
+        line = f'{when} {record.levelname:<7} {record.name} {record.getMessage()}'
+        if fields:
+            line += ' ' + ' '.join(f'{key}={_text_value(value)}' for key, value in fields.items())
+        return line + ('\n' + exception if exception else '')
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    # Formatting is left to the listener thread, and a full queue drops the record
+    # instead of blocking the request (or printing an error for every record)
+
+    def __init__(self, records):
+        super().__init__(records)
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+_state = {'handler': None, 'listener': None}
+
+
+def configure(level=None, style=None, sampling=None, rate_limit=None, asynchronous=None, stream=None):
+    """
+    (Re)configure the 'health' loggers, by default from the LOG_* settings of config.py.
+    Records are written to stream (stdout by default), from a listener thread unless
+    asynchronous is False.
+    """
+    level = level or config.LOG_LEVEL
+    style = style or config.LOG_FORMAT
+    sampling = config.LOG_SAMPLING if sampling is None else sampling
+    rate_limit = config.LOG_RATE_LIMIT if rate_limit is None else rate_limit
+    asynchronous = config.LOG_ASYNC == 'on' if asynchronous is None else asynchronous
+
+    shutdown()
+    _limiter.sampling = parse_sampling(sampling)
+    _limiter.rate_limit = rate_limit
+
+    output = logging.StreamHandler(stream or sys.stdout)
+    output.setFormatter(StructuredFormatter(style))
+    if asynchronous:
+        handler = _QueueHandler(queue.Queue(maxsize=config.LOG_QUEUE_SIZE))
+        listener = logging.handlers.QueueListener(handler.queue, output)
+        listener.start()
+        _state['listener'] = listener
+    else:
+        handler = output
+    _state['handler'] = handler
+
+    root = logging.getLogger(ROOT_LOGGER)
+    root.handlers = [handler]
+    root.setLevel(level.upper() if isinstance(level, str) else level)
+    root.propagate = False
+
+
+def shutdown():
+    """Write the records still queued and stop the listener thread."""
+    listener = _state['listener']
+    if listener is not None:
+        listener.stop()
+        _state['listener'] = None
+
+
+atexit.register(shutdown)
+
+
+def parse_sampling(value):
+    """'event=probability,...' to {event: probability}."""
+    if isinstance(value, dict):
+        return value
+    sampling = {}
+    for item in filter(None, (part.strip() for part in value.split(','))):
+        event, _, probability = item.partition('=')
+        sampling[event.strip()] = float(probability)
+    return sampling
+
+
+def dropped_records():
+    """Records dropped because the queue was full."""
+    handler = _state['handler']
+    return getattr(handler, 'dropped', 0)
+
+
+def suppressed_records():
+    """Records left out by sampling or rate limiting and not reported yet."""
+    return _limiter.suppressed()
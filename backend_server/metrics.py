@@ -0,0 +1,227 @@
+# metrics.py - Counters and histograms of the server, in the Prometheus text format
+#
+# Ingest records how long every stage of a batch takes (decoding, the inserts of every
+# sensor table, rollups, registry, log, commit, ...) and counts rows, batches, errors
+# and rejected payloads. GET /metrics renders them, plus gauges computed when scraped
+# (database and WAL size, queue depth, ...).
+#
+# Under gunicorn every process has its own registry. In writer mode the workers send
+# theirs (collect()) to the writer process every METRICS_PUSH_INTERVAL_S, and the worker
+# answering a scrape gets them all from it, with the writer's: render_snapshots lists
+# every metric once, with a sample per process labelled worker="<pid>" or "writer".
+#
+# Recording is meant for the hot path: a histogram observation is a bisect and two
+# additions under a lock, about a microsecond, and a batch makes a few dozen of them.
+
+import bisect
+import threading
+import time
+
+# Upper bounds in seconds, from 50 us (a small executemany) to 10 s (a stalled commit)
+DEFAULT_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _label_pairs(names, values, extra=()):
+    return [f'{name}="{_escape(value)}"' for name, value in zip(names, values)] + list(extra)
+
+
+def _sample_line(name, pairs, value):
+    return f"{name}{'{' + ','.join(pairs) + '}' if pairs else ''} {_number(value)}"
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def samples(self):
+        """(sample name, label pairs, value) of every series."""
+        raise NotImplementedError
+
+    def render(self):
+        return _family_lines(self.name, self.kind, self.documentation, self.samples())
+
+
+def _family_lines(name, kind, documentation, samples, extra=()):
+    return [f'# HELP {name} {documentation}', f'# TYPE {name} {kind}'] + [
+        _sample_line(sample, pairs + list(extra), value) for sample, pairs, value in samples]
+
+
+class Counter(_Metric):
+    """Monotonic count, per combination of label values (passed positionally)."""
+
+    kind = 'counter'
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        return [(f'{self.name}_total', _label_pairs(self.labels, key), value) for key, value in values]
+
+
+class Histogram(_Metric):
+    """Distribution of durations (seconds) in cumulative buckets, per combination of label values."""
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(label_values)
+            if state is None:
+                # [count per bucket (the last one is +Inf), sum]
+                state = self._values[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][index] += 1
+            state[1] += value
+
+    def time(self, *label_values):
+        """Context manager observing the duration of its block."""
+        return _Timer(self, label_values)
+
+    def samples(self):
+        with self._lock:
+            values = sorted((key, (list(counts), total)) for key, (counts, total) in self._values.items())
+        samples = []
+        for key, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = 'le="{}"'.format(_number(bound))
+                samples.append((f'{self.name}_bucket', _label_pairs(self.labels, key, [le]), cumulative))
+            samples.append((f'{self.name}_sum', _label_pairs(self.labels, key), total))
+            samples.append((f'{self.name}_count', _label_pairs(self.labels, key), cumulative))
+        return samples
+
+
+class _Timer:
+    __slots__ = ('histogram', 'label_values', 'started')
+
+    def __init__(self, histogram, label_values):
+        self.histogram = histogram
+        self.label_values = label_values
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started, *self.label_values)
+
+
+class Gauge(_Metric):
+    """
+    Value computed when scraped: function returns a number, or {label values: number}.
+    kind may be 'counter' for totals kept elsewhere (e.g. the response cache hits).
+    """
+
+    def __init__(self, name, documentation, function, labels=(), kind='gauge'):
+        super().__init__(name, documentation, labels)
+        self.function = function
+        self.kind = kind
+
+    def samples(self):
+        values = self.function()
+        if not isinstance(values, dict):
+            values = {(): values}
+        suffix = '_total' if self.kind == 'counter' else ''
+        return [(f'{self.name}{suffix}', _label_pairs(self.labels, key), value)
+                for key, value in sorted(values.items()) if value is not None]
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def collect(self):
+        """(name, kind, documentation, samples) of every metric, to be sent to another process."""
+        return [(metric.name, metric.kind, metric.documentation, metric.samples()) for metric in self._metrics]
+
+    def render(self):
+        """Every metric in the Prometheus text exposition format."""
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+def render_snapshots(snapshots):
+    """
+    The collect() of several processes, [(worker, metrics)], in the text exposition
+    format: every metric once (as first described), its samples labelled with the
+    worker they come from.
+    """
+    families = {}
+    for worker, collected in snapshots:
+        extra = [f'worker="{_escape(worker)}"']
+        for name, kind, documentation, samples in collected:
+            if name not in families:
+                families[name] = [f'# HELP {name} {documentation}', f'# TYPE {name} {kind}']
+            families[name].extend(_family_lines(name, kind, documentation, samples, extra)[2:])
+    return '\n'.join(line for lines in families.values() for line in lines) + '\n'
+
+
+REGISTRY = Registry()
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Stages of a batch: decode, dedup, write (all tables), log, commit, queue_wait
+# (queued mode) and stream (parsing and spooling a streamed batch)
+INGEST_STAGE_SECONDS = REGISTRY.register(Histogram(
+    'ingest_stage_seconds', 'Time spent in each stage of batch ingest.', ('stage',)))
+
+# Steps of writing the readings of one sensor table: insert (rows or chunks), rollups, registry
+INGEST_TABLE_SECONDS = REGISTRY.register(Histogram(
+    'ingest_table_seconds', 'Time spent writing the readings of a sensor table, per step.', ('table', 'step')))
+
+INGEST_ROWS = REGISTRY.register(Counter(
+    'ingest_rows', 'Readings written, per sensor table.', ('table',)))
+
+# status: stored, queued or duplicate, and duplicate_queued for a queued batch found, once
+# written, to repeat one committed meanwhile (it was counted when received too)
+INGEST_BATCHES = REGISTRY.register(Counter(
+    'ingest_batches', 'Batches received, per outcome.', ('status',)))
+
+# reason: exception (request failed), queue_dropped (a queued batch failed to commit)
+INGEST_ERRORS = REGISTRY.register(Counter(
+    'ingest_errors', 'Batches that failed while being stored.', ('reason',)))
+
+# Queued batches are acknowledged with 202 before they are written: the ones dropped
+# (data errors only, a locked database is waited out) are lost to the device
+INGEST_LOST_READINGS = REGISTRY.register(Counter(
+    'ingest_lost_readings', 'Readings of acknowledged batches that could not be stored.', ('reason',)))
+
+# reason: invalid_payload, invalid_body (undecodable or too large), queue_full,
+# writer_unavailable (INGEST_MODE=writer), and from admission control (admission.py):
+# rate_limited, too_large, device_queue_full, database_busy
+INGEST_REJECTED = REGISTRY.register(Counter(
+    'ingest_rejected', 'Payloads rejected before being stored.', ('reason',)))
+
+HTTP_REQUEST_SECONDS = REGISTRY.register(Histogram(
+    'http_request_seconds', 'Time to produce the response of a request, per route.', ('method', 'route', 'status')))
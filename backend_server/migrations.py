@@ -0,0 +1,317 @@
+# migrations.py - Versioned schema migrations, tracked in PRAGMA user_version
+#
+# Every migration runs once, in its own transaction, and bumps user_version to its
+# number. A database at version N only gets migrations N+1 onwards, so schema changes
+# are appended to MIGRATIONS and never edited once released.
+
+from ingest import SENSOR_TABLES
+from timestamps import parse_timestamp_us
+
+TABLES = {
+    'heartrates': '''
+        CREATE TABLE IF NOT EXISTS heartrates (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            device_id TEXT NOT NULL,
+            heart_rate INTEGER NOT NULL,
+            timestamp TEXT NOT NULL,
+            ts_us INTEGER
+        )
+    ''',
+    'skin_temperature': '''
+        CREATE TABLE IF NOT EXISTS skin_temperature (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            device_id TEXT NOT NULL,
+            value INTEGER NOT NULL,
+            timestamp TEXT NOT NULL,
+            ts_us INTEGER
+        )
+    ''',
+    'gsr': '''
+        CREATE TABLE IF NOT EXISTS gsr (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            device_id TEXT NOT NULL,
+            value INTEGER NOT NULL,
+            timestamp TEXT NOT NULL,
+            ts_us INTEGER
+        )
+    ''',
+    'light': '''
+        CREATE TABLE IF NOT EXISTS light (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            device_id TEXT NOT NULL,
+            value INTEGER NOT NULL,
+            timestamp TEXT NOT NULL,
+            ts_us INTEGER
+        )
+    ''',
+    'ppg': '''
+        CREATE TABLE IF NOT EXISTS ppg (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            device_id TEXT NOT NULL,
+            value INTEGER NOT NULL,
+            timestamp TEXT NOT NULL,
+            ts_us INTEGER
+        )
+    ''',
+    'accelerometer': '''
+        CREATE TABLE IF NOT EXISTS accelerometer (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            device_id TEXT NOT NULL,
+            x_value REAL NOT NULL,
+            y_value REAL NOT NULL,
+            z_value REAL NOT NULL,
+            timestamp TEXT NOT NULL,
+            ts_us INTEGER
+        )
+    ''',
+    'gyroscope': '''
+        CREATE TABLE IF NOT EXISTS gyroscope (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            device_id TEXT NOT NULL,
+            x_value REAL NOT NULL,
+            y_value REAL NOT NULL,
+            z_value REAL NOT NULL,
+            timestamp TEXT NOT NULL,
+            ts_us INTEGER
+        )
+    ''',
+    # Tracks batch processing, batch keys identify client retries (see dedup.py)
+    'batch_logs': '''
+        CREATE TABLE IF NOT EXISTS batch_logs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            device_id TEXT NOT NULL,
+            batch_timestamp TEXT NOT NULL,
+            heart_rate_count INTEGER DEFAULT 0,
+            health_data_count INTEGER DEFAULT 0,
+            motion_data_count INTEGER DEFAULT 0,
+            total_records INTEGER DEFAULT 0,
+            processing_time_ms INTEGER DEFAULT 0,
+            queue_time_ms INTEGER DEFAULT 0,
+            commit_time_ms INTEGER DEFAULT 0,
+            batch_key TEXT,
+            created_at TEXT NOT NULL
+        )
+    ''',
+}
+
+# Columns added after the first release of a table, for databases created before them
+ADDED_COLUMNS = [(table, 'ts_us', 'INTEGER') for table in SENSOR_TABLES] + [
+    ('batch_logs', 'queue_time_ms', 'INTEGER DEFAULT 0'),
+    ('batch_logs', 'commit_time_ms', 'INTEGER DEFAULT 0'),
+    ('batch_logs', 'batch_key', 'TEXT'),
+]
+
+
+def _columns(c, table):
+    c.execute(f'PRAGMA table_info({table})')
+    return [row[1] for row in c.fetchall()]
+
+
+def _baseline_schema(c):
+    # Databases from before versioning may have any subset of the tables and columns
+    for statement in TABLES.values():
+        c.execute(statement)
+    for table, column, column_type in ADDED_COLUMNS:
+        if column not in _columns(c, table):
+            c.execute(f'ALTER TABLE {table} ADD COLUMN {column} {column_type}')
+    c.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_batch_logs_batch_key ON batch_logs (batch_key)')
+
+
+def _device_time_indexes(c):
+    # Serve 'WHERE device_id = ? ORDER BY ts_us DESC LIMIT ?' from the index
+    # instead of scanning and sorting the whole table
+    for table in SENSOR_TABLES:
+        c.execute(f'CREATE INDEX IF NOT EXISTS idx_{table}_device_ts ON {table} (device_id, ts_us)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_batch_logs_device_created ON batch_logs (device_id, created_at)')
+
+
+def _partition_catalog(c):
+    # Time partitions of the sensor tables, see partitions.py. The existing tables
+    # stay in place as legacy partitions
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS sensor_partitions (
+            name TEXT PRIMARY KEY,
+            base_table TEXT NOT NULL,
+            start_us INTEGER NOT NULL,
+            end_us INTEGER NOT NULL
+        )
+    ''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_sensor_partitions_table ON sensor_partitions (base_table, end_us)')
+
+
+def _chunk_tables(c):
+    # Chunked storage of the high-rate streams, see chunks.py. Chunks live in time
+    # partitions of these tables like the readings of the sensor tables
+    for table in ('accelerometer', 'gyroscope', 'ppg'):
+        c.execute(f'''
+            CREATE TABLE IF NOT EXISTS {table}_chunks (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                device_id TEXT NOT NULL,
+                ts_us INTEGER NOT NULL,
+                first_us INTEGER NOT NULL,
+                last_us INTEGER NOT NULL,
+                count INTEGER NOT NULL,
+                data BLOB NOT NULL
+            )
+        ''')
+        c.execute(f'CREATE INDEX IF NOT EXISTS idx_{table}_chunks_device_ts ON {table}_chunks (device_id, ts_us)')
+
+
+def _rollup_tables(c):
+    # Per-device rollups of every sensor at three resolutions, see rollups.py.
+    # Partitioned by time like the sensor tables
+    for table in ('rollups_1s', 'rollups_1m', 'rollups_1h'):
+        c.execute(f'''
+            CREATE TABLE IF NOT EXISTS {table} (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                device_id TEXT NOT NULL,
+                sensor TEXT NOT NULL,
+                field TEXT NOT NULL,
+                ts_us INTEGER NOT NULL,
+                count INTEGER NOT NULL,
+                min_value REAL NOT NULL,
+                max_value REAL NOT NULL,
+                sum_value REAL NOT NULL,
+                UNIQUE (device_id, sensor, ts_us, field)
+            )
+        ''')
+
+
+def _bound(pick, a, b):
+    # min / max ignoring NULLs (readings not converted to ts_us yet)
+    return b if a is None else a if b is None else pick(a, b)
+
+
+def _device_registry(c):
+    # Devices and their per-sensor counts, maintained at ingest (see devices.py)
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS devices (
+            device_id TEXT PRIMARY KEY,
+            first_seen_us INTEGER,
+            last_seen_us INTEGER
+        )
+    ''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_devices_last_seen ON devices (last_seen_us)')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS device_sensors (
+            device_id TEXT NOT NULL,
+            sensor TEXT NOT NULL,
+            count INTEGER NOT NULL,
+            last_ts_us INTEGER,
+            PRIMARY KEY (device_id, sensor)
+        )
+    ''')
+
+    # Register the devices of the readings stored so far. Their first / last seen
+    # times are approximated by their oldest / newest reading. One pass over the
+    # (device_id, ts_us) index of every partition. Rows of an older database have no
+    # ts_us yet: timestamp_migration.py accounts them as it converts them
+    sensors = {}
+    for table in SENSOR_TABLES:
+        sources = [(table, 'SELECT device_id, COUNT(*), MIN(ts_us), MAX(ts_us) FROM {} GROUP BY device_id')]
+        if table in ('accelerometer', 'gyroscope', 'ppg'):
+            sources.append((f'{table}_chunks',
+                            'SELECT device_id, SUM(count), MIN(first_us), MAX(last_us) FROM {} GROUP BY device_id'))
+        for base_table, query in sources:
+            c.execute('SELECT name FROM sensor_partitions WHERE base_table = ?', (base_table,))
+            for name in [base_table] + [row[0] for row in c.fetchall()]:
+                c.execute(query.format(name))
+                for device_id, count, first_us, last_us in c.fetchall():
+                    entry = sensors.setdefault((device_id, table), [0, None, None])
+                    entry[0] += count
+                    entry[1] = _bound(min, entry[1], first_us)
+                    entry[2] = _bound(max, entry[2], last_us)
+
+    devices = {}
+    for (device_id, table), (count, first_us, last_us) in sensors.items():
+        seen = devices.setdefault(device_id, [None, None])
+        seen[0] = _bound(min, seen[0], first_us)
+        seen[1] = _bound(max, seen[1], last_us)
+    c.executemany('INSERT OR IGNORE INTO devices (device_id, first_seen_us, last_seen_us) VALUES (?, ?, ?)',
+                  [(device_id, first_us, last_us) for device_id, (first_us, last_us) in devices.items()])
+    c.executemany('INSERT OR IGNORE INTO device_sensors (device_id, sensor, count, last_ts_us) VALUES (?, ?, ?, ?)',
+                  [(device_id, table, count, last_us) for (device_id, table), (count, _, last_us) in sensors.items()])
+
+
+def _batch_log_times(c):
+    # Integer receive times of the batch logs, so that /api/batch/stats can select
+    # and bucket a time range through an index (see batch_stats.py)
+    if 'created_us' not in _columns(c, 'batch_logs'):
+        c.execute('ALTER TABLE batch_logs ADD COLUMN created_us INTEGER')
+    c.execute('SELECT id, created_at FROM batch_logs WHERE created_us IS NULL')
+    updates = []
+    for row_id, created_at in c.fetchall():
+        try:
+            updates.append((parse_timestamp_us(created_at), row_id))
+        except ValueError:
+            pass
+    c.executemany('UPDATE batch_logs SET created_us = ? WHERE id = ?', updates)
+    c.execute('CREATE INDEX IF NOT EXISTS idx_batch_logs_created_us ON batch_logs (created_us)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_batch_logs_device_created_us ON batch_logs (device_id, created_us)')
+
+
+def _rollup_backfill(c):
+    # Device / sensor time ranges whose rollups are not complete yet, see
+    # rollup_backfill.py. The readings stored so far are the whole registry: they may
+    # predate the rollups or have been stored with ROLLUPS=off. The ('*', '*') row asks
+    # the backfill to plan every device and sensor of the registry
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS rollup_backfill (
+            device_id TEXT NOT NULL,
+            sensor TEXT NOT NULL,
+            next_us INTEGER NOT NULL,
+            until_us INTEGER NOT NULL,
+            PRIMARY KEY (device_id, sensor)
+        )
+    ''')
+    c.execute('''
+        INSERT OR IGNORE INTO rollup_backfill (device_id, sensor, next_us, until_us)
+        SELECT '*', '*', 0, 9223372036854775807 WHERE EXISTS (SELECT 1 FROM device_sensors)
+    ''')
+
+
+# (version, description, function applying it to a cursor)
+MIGRATIONS = [
+    (1, 'baseline schema', _baseline_schema),
+    (2, 'device/time indexes on sensor tables', _device_time_indexes),
+    (3, 'time partition catalog', _partition_catalog),
+    (4, 'chunked storage tables', _chunk_tables),
+    (5, 'sensor rollup tables', _rollup_tables),
+    (6, 'device registry', _device_registry),
+    (7, 'batch log receive times', _batch_log_times),
+    (8, 'rollup backfill progress', _rollup_backfill),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def schema_version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+def migrate(conn, target=LATEST_VERSION):
+    """Apply the migrations the database is missing, up to target. Returns the applied versions."""
+    applied = []
+    if schema_version(conn) >= target:
+        return applied
+
+    c = conn.cursor()
+    for version, description, apply in MIGRATIONS:
+        if version > target:
+            break
+        # IMMEDIATE takes the write lock up front, so two servers starting on the
+        # same file cannot both apply a migration: the second one sees the new version
+        c.execute('BEGIN IMMEDIATE')
+        try:
+            if schema_version(conn) >= version:
+                conn.rollback()
+                continue
+            apply(c)
+            c.execute(f'PRAGMA user_version = {version}')
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        applied.append(version)
+        print(f"Applied migration {version}: {description}")
+    return applied
@@ -0,0 +1,279 @@
+# partitions.py - Time partitioned sensor tables and retention
+#
+# New readings of a sensor table are stored in one table per period (a UTC day or a
+# week starting on Monday, PARTITION_PERIOD), named after the table and the first day
+# of the period, e.g. accelerometer_20250106. sensor_partitions lists every partition
+# with the [start_us, end_us) range of ts_us it holds. The partitions of the current
+# and the next period are created ahead of time, in a short transaction of their own,
+# when the server starts and then every RETENTION_CHECK_INTERVAL_S: ingest never has
+# to change the schema for live readings. Older periods (a watch uploading a backlog)
+# are created by the first insert falling into them, inside the ingest transaction,
+# which holds the write lock already (BEGIN IMMEDIATE).
+#
+# The original, unpartitioned table of every sensor stays readable as the legacy
+# partition holding rows stored before partitioning.
+#
+# Retention drops whole partitions (a cheap DROP TABLE, the freed pages are reused by
+# new partitions) and trims legacy tables with short chunked DELETEs, so ingest never
+# waits behind a long delete.
+#
+# List the partitions / apply retention by hand:
+#   python partitions.py [--retention-days N] [path/to/health_data.db]
+
+import argparse
+import datetime
+import functools
+import re
+import sqlite3
+import threading
+import time
+
+import config
+import db
+import logs
+
+log = logs.get_logger('partitions')
+
+DAY_US = 86_400_000_000
+
+# (period length, offset of the period boundaries from the epoch)
+# Weeks start on Monday, 1969-12-29 being the Monday before the epoch (a Thursday)
+PERIODS = {
+    'day': (DAY_US, 0),
+    'week': (7 * DAY_US, 3 * DAY_US),
+}
+
+# Rows deleted per transaction when trimming a legacy table
+_LEGACY_DELETE_CHUNK_ROWS = 5000
+
+
+def partition_start(ts_us, period=None):
+    """Start (epoch microseconds) of the partition period containing ts_us."""
+    length, offset = PERIODS[period or config.PARTITION_PERIOD]
+    return (ts_us + offset) // length * length - offset
+
+
+def _utc_day(ts_us):
+    return datetime.datetime(1970, 1, 1) + datetime.timedelta(microseconds=ts_us)
+
+
+def partition_name(table, start_us):
+    return f'{table}_{_utc_day(start_us):%Y%m%d}'
+
+
+def create_partition(c, table, start_us, period=None):
+    """Create the partition of table starting at start_us (if needed), returns its name."""
+    length, _ = PERIODS[period or config.PARTITION_PERIOD]
+    name = partition_name(table, start_us)
+
+    # Partitions mirror the current schema and indexes of the legacy table
+    c.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (table,))
+    ddl = re.sub(r'^CREATE TABLE\s+"?\w+"?', f'CREATE TABLE IF NOT EXISTS {name}', c.fetchone()[0])
+    c.execute(ddl)
+    c.execute("SELECT name, sql FROM sqlite_master WHERE type = 'index' AND tbl_name = ? AND sql IS NOT NULL",
+              (table,))
+    for index, index_sql in c.fetchall():
+        # idx_accelerometer_device_ts becomes idx_accelerometer_20250106_device_ts
+        index_name = index.replace(f'idx_{table}_', f'idx_{name}_', 1) if index.startswith(f'idx_{table}_') \
+            else f'{index}_{name}'
+        c.execute(re.sub(r'^CREATE (UNIQUE )?INDEX\s+"?\w+"?\s+ON\s+"?\w+"?',
+                         lambda m: f'CREATE {m.group(1) or ""}INDEX IF NOT EXISTS {index_name} ON {name}',
+                         index_sql))
+    c.execute(
+        'INSERT OR IGNORE INTO sensor_partitions (name, base_table, start_us, end_us) VALUES (?, ?, ?, ?)',
+        (name, table, start_us, start_us + length)
+    )
+    return name
+
+
+def insert_rows(c, table, rows, insert_sql):
+    """
+    Insert rows of a sensor table into their partitions.
+
+    rows end with ts_us, insert_sql is the table's INSERT statement. Runs inside
+    the caller's transaction, which must be a write transaction (BEGIN IMMEDIATE):
+    partitions that do not exist yet are created in it.
+    """
+    if not rows:
+        return
+    groups = {}
+    for row in rows:
+        groups.setdefault(partition_start(row[-1]), []).append(row)
+
+    for start_us, group in groups.items():
+        name = partition_name(table, start_us)
+        sql = _partition_insert_sql(insert_sql, table, name)
+        try:
+            c.executemany(sql, group)
+        except sqlite3.OperationalError as e:
+            # First rows of a new period (or the partition was dropped by retention)
+            if 'no such table' not in str(e):
+                raise
+            create_partition(c, table, start_us)
+            c.executemany(sql, group)
+
+
+def ensure_partitions(conn, tables, now_us=None):
+    """
+    Create the partitions of the current and the next period of tables, if missing, in
+    one short transaction. Returns the names of the partitions created.
+    """
+    length, _ = PERIODS[config.PARTITION_PERIOD]
+    start_us = partition_start(int(time.time() * 1_000_000) if now_us is None else now_us)
+    existing = {row[0] for row in conn.execute('SELECT name FROM sensor_partitions')}
+    missing = [(table, period_start) for table in tables for period_start in (start_us, start_us + length)
+               if partition_name(table, period_start) not in existing]
+    if not missing:
+        return []
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        created = [create_partition(conn.cursor(), table, period_start) for table, period_start in missing]
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return created
+
+
+@functools.lru_cache(maxsize=1024)
+def _partition_insert_sql(insert_sql, table, name):
+    return insert_sql.replace(f'INSERT INTO {table} ', f'INSERT INTO {name} ', 1)
+
+
+def table_partitions(conn, table, start_us=None, end_us=None):
+    """
+    (name, start_us, end_us) of every partition of table overlapping [start_us, end_us),
+    newest first. The legacy table comes first with an unbounded range.
+    """
+    query = 'SELECT name, start_us, end_us FROM sensor_partitions WHERE base_table = ?'
+    params = [table]
+    if start_us is not None:
+        query += ' AND end_us > ?'
+        params.append(start_us)
+    if end_us is not None:
+        query += ' AND start_us < ?'
+        params.append(end_us)
+    query += ' ORDER BY end_us DESC'
+    return [(table, None, None)] + [tuple(row) for row in conn.execute(query, params)]
+
+
+def _newest_first(row):
+    # ORDER BY ts_us DESC, with rows not migrated to ts_us yet (NULL) last
+    return (row['ts_us'] is not None, row['ts_us'] or 0)
+
+
+def latest_rows(conn, table, device_id=None, limit=100):
+    """The newest rows of table (optionally of one device), as dicts, newest first."""
+    limit = int(limit)
+    where = ' WHERE device_id = ?' if device_id else ''
+    rows = []
+    for name, _, end_us in table_partitions(conn, table):
+        # Every remaining partition only holds older readings than the ones collected
+        if len(rows) >= limit and end_us is not None and rows[-1]['ts_us'] is not None \
+                and rows[-1]['ts_us'] >= end_us:
+            break
+        params = ([device_id] if device_id else []) + [limit]
+        found = conn.execute(f'SELECT * FROM {name}{where} ORDER BY ts_us DESC LIMIT ?', params).fetchall()
+        rows = sorted(rows + [dict(row) for row in found], key=_newest_first, reverse=True)[:limit]
+    return rows
+
+
+def apply_retention(conn, tables, cutoff_us):
+    """Drop the readings of the given sensor tables older than cutoff_us. Returns the dropped partitions."""
+    dropped = []
+    for table in tables:
+        for name, start_us, end_us in table_partitions(conn, table, end_us=cutoff_us):
+            if end_us is None or end_us > cutoff_us:
+                continue
+            # One short transaction per partition
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                conn.execute(f'DROP TABLE IF EXISTS {name}')
+                conn.execute('DELETE FROM sensor_partitions WHERE name = ?', (name,))
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            dropped.append(name)
+
+        # Legacy rows are deleted a chunk at a time. The rows are looked up before
+        # taking the write lock, so the scan of a large table never blocks ingest
+        while True:
+            ids = [(row[0],) for row in conn.execute(
+                f'SELECT id FROM {table} WHERE ts_us < ? ORDER BY id LIMIT ?',
+                (cutoff_us, _LEGACY_DELETE_CHUNK_ROWS)
+            )]
+            if not ids:
+                break
+            conn.execute('BEGIN IMMEDIATE')
+            conn.executemany(f'DELETE FROM {table} WHERE id = ?', ids)
+            conn.commit()
+            time.sleep(0.01)
+    return dropped
+
+
+def run_retention(tables, retention_days, path=None):
+    cutoff_us = int(time.time() * 1_000_000) - retention_days * DAY_US
+    conn = db.connect(path)
+    try:
+        dropped = apply_retention(conn, tables, cutoff_us)
+    finally:
+        conn.close()
+    if dropped:
+        log.info('retention_dropped', partitions=','.join(dropped))
+    return dropped
+
+
+def prepare_partitions(tables, path=None):
+    """ensure_partitions() on a connection of its own."""
+    conn = db.connect(path)
+    try:
+        created = ensure_partitions(conn, tables)
+    finally:
+        conn.close()
+    if created:
+        log.info('partitions_created', partitions=','.join(created))
+    return created
+
+
+def start_maintenance(tables):
+    """
+    Every RETENTION_CHECK_INTERVAL_S in a background thread: create the partitions
+    of the next period, and apply RETENTION_DAYS when set.
+    """
+    def loop():
+        while True:
+            try:
+                prepare_partitions(tables)
+            except Exception as e:
+                log.error('partitions_failed', exc_info=True, error=str(e))
+            if config.RETENTION_DAYS > 0:
+                try:
+                    run_retention(tables, config.RETENTION_DAYS)
+                except Exception as e:
+                    log.error('retention_failed', exc_info=True, error=str(e))
+            time.sleep(config.RETENTION_CHECK_INTERVAL_S)
+
+    thread = threading.Thread(target=loop, name='partitions', daemon=True)
+    thread.start()
+    return thread
+
+
+if __name__ == '__main__':
+    from ingest import STORAGE_TABLES
+
+    parser = argparse.ArgumentParser(description='List the sensor partitions and apply retention')
+    parser.add_argument('database', nargs='?', default=None)
+    parser.add_argument('--retention-days', type=int, default=0, help='drop readings older than this many days')
+    args = parser.parse_args()
+
+    if args.retention_days:
+        dropped = run_retention(STORAGE_TABLES, args.retention_days, args.database)
+        print(f"Retention: dropped {len(dropped)} partitions ({', '.join(dropped)})")
+    conn = db.connect(args.database)
+    for table in STORAGE_TABLES:
+        for name, start_us, end_us in table_partitions(conn, table):
+            count = conn.execute(f'SELECT COUNT(*) FROM {name}').fetchone()[0]
+            span = 'legacy' if start_us is None else f'{_utc_day(start_us):%Y-%m-%d} - {_utc_day(end_us):%Y-%m-%d}'
+            print(f"{name:32s} {span:24s} {count:12,d} rows")
+    conn.close()
@@ -0,0 +1,164 @@
+# readings.py - Reading sensor data regardless of how it is stored
+#
+# Readings of a sensor can be spread over row partitions (partitions.py) and, for
+# the high-rate streams, chunks (chunks.py): CHUNKED_STORAGE only decides how new
+# readings are written, both are always read.
+
+import base64
+import heapq
+import json
+
+import numpy as np
+
+from chunks import CHUNKED_STREAMS, chunk_reading_dicts, chunk_us, iter_chunks, latest_chunk_readings
+from partitions import latest_rows, table_partitions
+from rollups import ROLLUP_FIELDS
+
+
+def _newest_first(reading):
+    # ORDER BY ts_us DESC, with rows not migrated to ts_us yet (NULL) last
+    return (reading['ts_us'] is not None, reading['ts_us'] or 0)
+
+
+def latest_readings(conn, table, device_id=None, limit=100):
+    """The newest readings of table (optionally of one device), as dicts, newest first."""
+    readings = latest_rows(conn, table, device_id, limit)
+    if table in CHUNKED_STREAMS:
+        readings = sorted(readings + latest_chunk_readings(conn, table, device_id, limit),
+                          key=_newest_first, reverse=True)[:int(limit)]
+    return readings
+
+
+def readings_between(conn, table, device_id, start_us, end_us):
+    """
+    The readings of one device in [start_us, end_us) as numpy arrays, oldest first:
+    (int64 ts_us, {value column: float64 values}).
+    """
+    fields = ROLLUP_FIELDS[table]
+    ts_parts = []
+    value_parts = {field: [] for field in fields}
+    for name, _, _ in table_partitions(conn, table, start_us, end_us):
+        rows = conn.execute(
+            f"SELECT ts_us, {', '.join(fields)} FROM {name} WHERE device_id = ? AND ts_us >= ? AND ts_us < ?",
+            (device_id, start_us, end_us)
+        ).fetchall()
+        if rows:
+            columns = list(zip(*rows))
+            ts_parts.append(np.array(columns[0], dtype=np.int64))
+            for field, values in zip(fields, columns[1:]):
+                value_parts[field].append(np.array(values, dtype=np.float64))
+    if table in CHUNKED_STREAMS:
+        for _, ts_us, columns in iter_chunks(conn, table, device_id, start_us, end_us):
+            ts_parts.append(ts_us)
+            for field, values in zip(fields, columns):
+                value_parts[field].append(values.astype(np.float64))
+
+    if not ts_parts:
+        return np.empty(0, dtype=np.int64), {field: np.empty(0) for field in fields}
+    ts_us = np.concatenate(ts_parts)
+    order = np.argsort(ts_us, kind='stable')
+    return ts_us[order], {field: np.concatenate(parts)[order] for field, parts in value_parts.items()}
+
+
+def reading_columns(table):
+    """Fields of the readings of table, in the column order of its rows."""
+    return ('id', 'device_id') + ROLLUP_FIELDS[table] + ('timestamp', 'ts_us')
+
+
+def reading_key(reading):
+    """
+    Keyset pagination key of a reading: (ts_us, id). Readings stored in chunks have
+    no id (they sort before rows with the same ts_us), device_id breaks their ties.
+    """
+    return (reading['ts_us'], reading['id'] or 0, reading['device_id'])
+
+
+def encode_cursor(reading):
+    """Opaque cursor pointing after reading."""
+    return base64.urlsafe_b64encode(json.dumps(reading_key(reading)).encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        ts_us, reading_id, device_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return (int(ts_us), int(reading_id), str(device_id))
+    except (ValueError, TypeError):
+        raise ValueError(f'Invalid cursor: {cursor!r}')
+
+
+def _row_readings(conn, names, device_id, since_us, until_us, after, descending):
+    # Readings of the given (time ordered) tables, in key order, one row at a time
+    conditions = ['ts_us IS NOT NULL']
+    params = []
+    if device_id:
+        conditions.append('device_id = ?')
+        params.append(device_id)
+    if since_us is not None:
+        conditions.append('ts_us >= ?')
+        params.append(since_us)
+    if until_us is not None:
+        conditions.append('ts_us < ?')
+        params.append(until_us)
+    if after is not None:
+        # The plain ts_us bound lets the (device_id, ts_us) index skip to the cursor
+        comparison = '<' if descending else '>'
+        conditions.append(f'ts_us {comparison}= ? AND (ts_us, id, device_id) {comparison} (?, ?, ?)')
+        params.extend([after[0], *after])
+    order = 'DESC' if descending else 'ASC'
+    for name in names:
+        cursor = conn.execute(
+            f"SELECT * FROM {name} WHERE {' AND '.join(conditions)} "
+            f"ORDER BY ts_us {order}, id {order}, device_id {order}",
+            params
+        )
+        for row in cursor:
+            yield dict(row)
+
+
+def _chunked_readings(conn, table, device_id, since_us, until_us, after, descending):
+    # Chunks come ordered by window, the chunks of one window (one per device) are
+    # collected and their readings sorted together
+    window = chunk_us()
+    pending, pending_window = [], None
+
+    def flush():
+        readings = sorted(pending, key=reading_key, reverse=descending)
+        if after is not None:
+            readings = [reading for reading in readings
+                        if (reading_key(reading) < after if descending else reading_key(reading) > after)]
+        return readings
+
+    for chunk_device, ts_us, columns in iter_chunks(conn, table, device_id, since_us, until_us, descending):
+        chunk_window = int(ts_us[0]) // window * window
+        if chunk_window != pending_window:
+            yield from flush()
+            pending, pending_window = [], chunk_window
+        pending.extend(chunk_reading_dicts(table, chunk_device, ts_us, columns))
+    yield from flush()
+
+
+def iter_readings(conn, table, device_id=None, since_us=None, until_us=None, after=None, descending=True):
+    """
+    Readings of table with ts_us in [since_us, until_us) as dicts, in reading_key
+    order (newest first when descending), starting after the key after. Rows, legacy
+    rows and chunks are merged lazily, memory does not depend on the range size.
+    Readings without ts_us (not converted by the timestamp migration yet) are skipped.
+    """
+    # Nothing on the far side of the cursor needs to be read
+    if after is not None:
+        if descending:
+            until_us = after[0] + 1 if until_us is None else min(until_us, after[0] + 1)
+        else:
+            since_us = after[0] if since_us is None else max(since_us, after[0])
+
+    legacy, *partitions = [name for name, _, _ in table_partitions(conn, table, since_us, until_us)]
+    if not descending:
+        partitions.reverse()
+    # The legacy table can hold any time range, partitions follow each other
+    sources = [
+        _row_readings(conn, [legacy], device_id, since_us, until_us, after, descending),
+        _row_readings(conn, partitions, device_id, since_us, until_us, after, descending),
+    ]
+    if table in CHUNKED_STREAMS:
+        sources.append(_chunked_readings(conn, table, device_id, since_us, until_us, after, descending))
+    return heapq.merge(*sources, key=reading_key, reverse=descending)
@@ -0,0 +1,188 @@
+# rollup_backfill.py - Roll up the readings stored while the rollups were not maintained
+#
+# Readings stored before the rollups existed (migration 5), or while ROLLUPS was off,
+# have no rollups. rollup_backfill lists the device / sensor ranges [next_us, until_us)
+# still to roll up, and the backfill works through them a slice of whole minutes at a
+# time: in one short BEGIN IMMEDIATE transaction it reads the readings of the slice and
+# replaces their rollups (rollups.replace_rollups), so readings ingested meanwhile are
+# counted exactly once. The range shrinks with every slice, so an interrupted backfill
+# continues where it stopped, and timeseries.py does not read the rollups of a range
+# still listed.
+#
+# The ('*', '*') row stands for every device and sensor of the registry (devices.py):
+# migration 8 adds it for the readings stored so far, and so does every start with
+# ROLLUPS=off, the readings stored until the next start with ROLLUPS=on having none.
+#
+# It runs in a background thread when the server starts (ROLLUPS=on), or by hand:
+#   python rollup_backfill.py [path/to/health_data.db]
+
+import itertools
+import sys
+import threading
+import time
+
+import config
+import db
+import logs
+from chunks import CHUNK_TABLES, CHUNKED_STREAMS, chunk_us
+from migrations import migrate
+from partitions import table_partitions
+from readings import readings_between
+from rollups import RESOLUTIONS, ROLLUP_FIELDS, replace_rollups
+
+log = logs.get_logger('rollups')
+
+# Device and sensor of the row standing for the whole registry
+EVERYTHING = '*'
+
+_MINUTE_US = RESOLUTIONS[1][1]
+_HOUR_US = RESOLUTIONS[2][1]
+
+
+def rollups_complete(conn, device_id, table, start_us, end_us):
+    """Whether the rollups of a device's sensor table hold every reading in [start_us, end_us)."""
+    row = conn.execute('''
+        SELECT 1 FROM rollup_backfill
+        WHERE device_id IN (?, ?) AND sensor IN (?, ?) AND next_us < ? AND until_us > ?
+        LIMIT 1
+    ''', (device_id, EVERYTHING, table, EVERYTHING, end_us, start_us)).fetchone()
+    return row is None
+
+
+def mark_rollups_off(conn):
+    """Have the next start with ROLLUPS=on roll up everything stored meanwhile."""
+    conn.execute('BEGIN IMMEDIATE')
+    conn.execute('INSERT OR IGNORE INTO rollup_backfill (device_id, sensor, next_us, until_us) VALUES (?, ?, 0, ?)',
+                 (EVERYTHING, EVERYTHING, 2 ** 63 - 1))
+    conn.commit()
+
+
+def _plan(conn):
+    # Every device and sensor up to its newest reading, from the start: the first slice
+    # skips to its oldest reading
+    c = conn.cursor()
+    c.execute('BEGIN IMMEDIATE')
+    if c.execute('SELECT 1 FROM rollup_backfill WHERE device_id = ? AND sensor = ?',
+                 (EVERYTHING, EVERYTHING)).fetchone() is not None:
+        c.execute('''
+            INSERT INTO rollup_backfill (device_id, sensor, next_us, until_us)
+            SELECT device_id, sensor, 0, last_ts_us + 1 FROM device_sensors WHERE last_ts_us IS NOT NULL
+            ON CONFLICT (device_id, sensor) DO UPDATE SET
+                next_us = 0,
+                until_us = max(until_us, excluded.until_us)
+        ''')
+        c.execute('DELETE FROM rollup_backfill WHERE device_id = ? AND sensor = ?', (EVERYTHING, EVERYTHING))
+    conn.commit()
+
+
+def _next_reading_us(conn, table, device_id, after_us, until_us):
+    # Oldest reading in [after_us, until_us) (at most that of a chunk holding one), or None
+    found = []
+    for name, _, _ in table_partitions(conn, table, after_us, until_us):
+        row = conn.execute(f'SELECT MIN(ts_us) FROM {name} WHERE device_id = ? AND ts_us >= ? AND ts_us < ?',
+                           (device_id, after_us, until_us)).fetchone()
+        if row[0] is not None:
+            found.append(row[0])
+    if table in CHUNKED_STREAMS:
+        # A chunk starts at most one window before its samples
+        window_us = chunk_us()
+        for name, _, _ in table_partitions(conn, CHUNK_TABLES[table], after_us - window_us, until_us):
+            row = conn.execute(f'''
+                SELECT MIN(max(first_us, ?)) FROM {name}
+                WHERE device_id = ? AND ts_us > ? AND ts_us < ? AND last_us >= ?
+            ''', (after_us, device_id, after_us - window_us, until_us, after_us)).fetchone()
+            if row[0] is not None:
+                found.append(row[0])
+    return min(found) if found else None
+
+
+def _slice_end(conn, table, device_id, start_us, until_us, chunk_rows):
+    # Whole minutes from start_us, up to the end of its hour and about chunk_rows readings
+    end_us = min(start_us // _HOUR_US * _HOUR_US + _HOUR_US, -(-until_us // _MINUTE_US) * _MINUTE_US)
+    ts_us, _ = readings_between(conn, table, device_id, start_us, end_us)
+    if len(ts_us) > chunk_rows:
+        end_us = max(start_us + _MINUTE_US, int(ts_us[chunk_rows]) // _MINUTE_US * _MINUTE_US)
+    return end_us
+
+
+def backfill_sensor(conn, device_id, table, next_us, until_us, chunk_rows=20000, pause_seconds=0.0):
+    """Roll up the readings of a device's sensor table listed in rollup_backfill, returns how many."""
+    fields = ROLLUP_FIELDS[table]
+    total = 0
+    while True:
+        found = _next_reading_us(conn, table, device_id, next_us, until_us)
+        if found is None:
+            break
+        start_us = found // _MINUTE_US * _MINUTE_US
+        # Sized before taking the write lock, read again under it
+        end_us = _slice_end(conn, table, device_id, start_us, until_us, chunk_rows)
+
+        c = conn.cursor()
+        c.execute('BEGIN IMMEDIATE')
+        try:
+            ts_us, values = readings_between(conn, table, device_id, start_us, end_us)
+            replace_rollups(c, table, device_id, start_us, end_us, list(zip(
+                itertools.repeat(device_id, len(ts_us)), *[values[field].tolist() for field in fields],
+                ts_us.tolist())))
+            c.execute('UPDATE rollup_backfill SET next_us = ? WHERE device_id = ? AND sensor = ?',
+                      (end_us, device_id, table))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        total += len(ts_us)
+        next_us = end_us
+
+        if pause_seconds:
+            time.sleep(pause_seconds)
+
+    conn.execute('BEGIN IMMEDIATE')
+    conn.execute('DELETE FROM rollup_backfill WHERE device_id = ? AND sensor = ?', (device_id, table))
+    conn.commit()
+    return total
+
+
+def backfill_rollups(path=None, chunk_rows=20000, pause_seconds=0.0):
+    conn = db.connect(path)
+    try:
+        migrate(conn)
+        _plan(conn)
+        pending = conn.execute('SELECT device_id, sensor, next_us, until_us FROM rollup_backfill').fetchall()
+        started = time.time()
+        total = 0
+        for device_id, table, next_us, until_us in pending:
+            if table in ROLLUP_FIELDS:
+                total += backfill_sensor(conn, device_id, table, next_us, until_us, chunk_rows, pause_seconds)
+        if pending:
+            log.info('rollup_backfill_finished', sensors=len(pending), readings=total,
+                     elapsed_ms=int((time.time() - started) * 1000))
+    except Exception as e:
+        # Resumed by the next start
+        log.error('rollup_backfill_failed', error=str(e))
+    finally:
+        conn.close()
+
+
+def start_rollup_backfill():
+    """Run the backfill next to the server, yielding to ingest between slices (ROLLUPS=on)."""
+    if config.ROLLUPS != 'on':
+        conn = db.connect()
+        try:
+            mark_rollups_off(conn)
+        finally:
+            conn.close()
+        return None
+    thread = threading.Thread(
+        target=backfill_rollups,
+        kwargs={'chunk_rows': config.ROLLUP_BACKFILL_CHUNK_ROWS, 'pause_seconds': 0.01},
+        name='rollup-backfill',
+        daemon=True
+    )
+    thread.start()
+    return thread
+
+
+if __name__ == '__main__':
+    logs.configure()
+    backfill_rollups(sys.argv[1] if len(sys.argv) > 1 else None)
+    print("Rollup backfill finished")
@@ -0,0 +1,243 @@
+# rollups.py - Per-device min / max / mean of every sensor at 1 s, 1 min and 1 h
+#
+# insert_readings keeps rollups_1s, rollups_1m and rollups_1h up to date inside the
+# ingest transaction. They hold one row per device, sensor table, value column and
+# bucket, with ts_us the start of the bucket and the count, min, max and sum of the
+# readings in it. Like the sensor tables they are partitioned by time (partitions.py)
+# and fall under retention.
+#
+# rollup_series answers "this sensor of a device between start and end in at most N
+# points" from the coarsest resolution that still gives N points, so a chart of a
+# month reads hourly rows and a chart of ten minutes reads seconds: the work follows
+# the points drawn, not the readings stored.
+#
+# Readings stored before the rollups existed, or while ROLLUPS was off, are rolled up
+# by the server in the background (rollup_backfill.py, with replace_rollups). All of
+# them can also be rebuilt by hand, with the server stopped (readings stored
+# meanwhile would be counted twice):
+#   python rollups.py [path/to/health_data.db]
+
+import argparse
+import time
+
+import db
+from chunks import CHUNKED_STREAMS, iter_chunks
+from partitions import insert_rows, table_partitions
+from timestamps import format_timestamp_us
+
+# (name, bucket width in microseconds), finest first
+RESOLUTIONS = (
+    ('1s', 1_000_000),
+    ('1m', 60_000_000),
+    ('1h', 3_600_000_000),
+)
+
+ROLLUP_TABLES = tuple(f'rollups_{name}' for name, _ in RESOLUTIONS)
+
+# Value columns of every sensor table, in the order of their rows
+ROLLUP_FIELDS = {
+    'heartrates': ('heart_rate',),
+    'skin_temperature': ('value',),
+    'gsr': ('value',),
+    'light': ('value',),
+    'ppg': ('value',),
+    'accelerometer': ('x_value', 'y_value', 'z_value'),
+    'gyroscope': ('x_value', 'y_value', 'z_value'),
+}
+
+_UPSERT_STATEMENTS = {
+    table: f'''INSERT INTO {table} (device_id, sensor, field, count, min_value, max_value, sum_value, ts_us)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (device_id, sensor, ts_us, field) DO UPDATE SET
+            count = count + excluded.count,
+            min_value = min(min_value, excluded.min_value),
+            max_value = max(max_value, excluded.max_value),
+            sum_value = sum_value + excluded.sum_value'''
+    for table in ROLLUP_TABLES
+}
+
+# Rows read per transaction when rebuilding
+_REBUILD_CHUNK_ROWS = 50_000
+
+
+def _merge(stats, other):
+    # stats: [count, [min, max, sum] per value column]
+    stats[0] += other[0]
+    for mine, theirs in zip(stats[1:], other[1:]):
+        if theirs[0] < mine[0]:
+            mine[0] = theirs[0]
+        if theirs[1] > mine[1]:
+            mine[1] = theirs[1]
+        mine[2] += theirs[2]
+
+
+def update_rollups(c, table, rows):
+    """
+    Add rows of a sensor table, (device_id, values..., [timestamp,] ts_us), to the
+    rollups. Runs inside the caller's transaction.
+    """
+    n_fields = len(ROLLUP_FIELDS[table])
+    _, width = RESOLUTIONS[0]
+    buckets = {}
+    for row in rows:
+        key = (row[0], row[-1] // width * width)
+        values = row[1:1 + n_fields]
+        stats = buckets.get(key)
+        if stats is None:
+            buckets[key] = [1] + [[value, value, value] for value in values]
+        else:
+            _merge(stats, [1] + [[value, value, value] for value in values])
+
+    # Every coarser resolution is built from the one before it
+    for (_, width), rollup_table in zip(RESOLUTIONS, ROLLUP_TABLES):
+        if rollup_table != ROLLUP_TABLES[0]:
+            coarser = {}
+            for (device_id, start_us), stats in buckets.items():
+                key = (device_id, start_us // width * width)
+                if key in coarser:
+                    _merge(coarser[key], stats)
+                else:
+                    coarser[key] = [stats[0]] + [list(field) for field in stats[1:]]
+            buckets = coarser
+        insert_rows(c, rollup_table, [
+            (device_id, table, field, stats[0], *stats[1 + i], start_us)
+            for (device_id, start_us), stats in buckets.items()
+            for i, field in enumerate(ROLLUP_FIELDS[table])
+        ], _UPSERT_STATEMENTS[rollup_table])
+
+
+def replace_rollups(c, table, device_id, start_us, end_us, rows):
+    """
+    Replace the rollups of a device's sensor table over [start_us, end_us), whole minutes,
+    by those of rows: all of its readings in that range, as for update_rollups. The hours
+    it touches are recomputed from their minutes. Runs inside the caller's write
+    transaction, so readings committed later add to the result as usual.
+    """
+    fine_tables, hour_table = ROLLUP_TABLES[:-1], ROLLUP_TABLES[-1]
+    _, hour = RESOLUTIONS[-1]
+    for rollup_table in fine_tables:
+        for name, _, _ in table_partitions(c, rollup_table, start_us, end_us):
+            c.execute(f'DELETE FROM {name} WHERE device_id = ? AND sensor = ? AND ts_us >= ? AND ts_us < ?',
+                      (device_id, table, start_us, end_us))
+    update_rollups(c, table, rows)
+
+    for hour_us in range(start_us // hour * hour, end_us, hour):
+        totals = []
+        for name, _, _ in table_partitions(c, fine_tables[-1], hour_us, hour_us + hour):
+            totals += c.execute(f'''
+                SELECT device_id, sensor, field, SUM(count), MIN(min_value), MAX(max_value), SUM(sum_value), ?
+                FROM {name}
+                WHERE device_id = ? AND sensor = ? AND ts_us >= ? AND ts_us < ?
+                GROUP BY field
+            ''', (hour_us, device_id, table, hour_us, hour_us + hour)).fetchall()
+        for name, _, _ in table_partitions(c, hour_table, hour_us, hour_us + hour):
+            c.execute(f'DELETE FROM {name} WHERE device_id = ? AND sensor = ? AND ts_us = ?',
+                      (device_id, table, hour_us))
+        insert_rows(c, hour_table, totals, _UPSERT_STATEMENTS[hour_table])
+
+
+def rollup_series(conn, table, device_id, start_us, end_us, max_points=500):
+    """
+    A sensor table of one device over [start_us, end_us) in at most max_points points.
+
+    Returns (resolution name, step in microseconds, points), points being dicts with
+    ts_us, timestamp (start of the step), count and <field>_min / _max / _mean for
+    every value column, oldest first. Steps are multiples of the resolution read.
+    """
+    fields = ROLLUP_FIELDS[table]
+    step = max(1, -(-(end_us - start_us) // int(max_points)))
+    # Coarsest resolution not wider than a step, the finest one for short ranges
+    index = 0
+    for i, (_, width) in enumerate(RESOLUTIONS):
+        if width <= step:
+            index = i
+    name, width = RESOLUTIONS[index]
+    step = -(-step // width) * width
+
+    groups = {}
+    for partition, _, _ in table_partitions(conn, ROLLUP_TABLES[index], start_us, end_us):
+        for row in conn.execute(f'''
+            SELECT ts_us / ? * ? AS step_us, field, SUM(count), MIN(min_value), MAX(max_value), SUM(sum_value)
+            FROM {partition}
+            WHERE device_id = ? AND sensor = ? AND ts_us >= ? AND ts_us < ?
+            GROUP BY step_us, field
+        ''', (step, step, device_id, table, start_us // width * width, end_us)):
+            step_us, field, count, min_value, max_value, sum_value = row
+            # A step can span two partitions
+            stats = groups.setdefault(step_us, {}).get(field)
+            if stats is None:
+                groups[step_us][field] = [count, min_value, max_value, sum_value]
+            else:
+                stats[0] += count
+                stats[1] = min(stats[1], min_value)
+                stats[2] = max(stats[2], max_value)
+                stats[3] += sum_value
+
+    points = []
+    for step_us in sorted(groups):
+        by_field = groups[step_us]
+        point = {'ts_us': step_us, 'timestamp': format_timestamp_us(step_us),
+                 'count': max(stats[0] for stats in by_field.values())}
+        for field in fields:
+            count, min_value, max_value, sum_value = by_field.get(field, (0, None, None, None))
+            point[f'{field}_min'] = min_value
+            point[f'{field}_max'] = max_value
+            point[f'{field}_mean'] = sum_value / count if count else None
+        points.append(point)
+    return name, step, points
+
+
+def rebuild_rollups(conn):
+    """Recompute every rollup from the stored readings, rows and chunks."""
+    for rollup_table in ROLLUP_TABLES:
+        for name, _, _ in table_partitions(conn, rollup_table):
+            conn.execute(f'DELETE FROM {name}')
+    conn.commit()
+
+    for table, fields in ROLLUP_FIELDS.items():
+        started = time.time()
+        total = 0
+        for name, _, _ in table_partitions(conn, table):
+            last_id = 0
+            while True:
+                # Readings are looked up before taking the write lock, so ingest
+                # only waits for the upserts of one chunk at a time
+                rows = conn.execute(
+                    f"SELECT id, device_id, {', '.join(fields)}, ts_us FROM {name} "
+                    "WHERE id > ? AND ts_us IS NOT NULL ORDER BY id LIMIT ?",
+                    (last_id, _REBUILD_CHUNK_ROWS)
+                ).fetchall()
+                if not rows:
+                    break
+                last_id = rows[-1][0]
+                c = conn.cursor()
+                c.execute('BEGIN IMMEDIATE')
+                update_rollups(c, table, [tuple(row)[1:] for row in rows])
+                conn.commit()
+                total += len(rows)
+
+        if table in CHUNKED_STREAMS:
+            for device_id, ts_us, columns in iter_chunks(conn, table):
+                c = conn.cursor()
+                c.execute('BEGIN IMMEDIATE')
+                update_rollups(c, table, list(zip([device_id] * len(ts_us), *[column.tolist() for column in columns],
+                                                  ts_us.tolist())))
+                conn.commit()
+                total += len(ts_us)
+        print(f"Rolled up {total:,} {table} readings in {time.time() - started:.1f} s")
+
+    # Nothing is left for the background backfill
+    conn.execute('DELETE FROM rollup_backfill')
+    conn.commit()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Rebuild the sensor rollups from the stored readings')
+    parser.add_argument('database', nargs='?', default=None)
+    args = parser.parse_args()
+
+    conn = db.connect(args.database)
+    try:
+        rebuild_rollups(conn)
+    finally:
+        conn.close()
@@ -0,0 +1,42 @@
+# snapshot.py - Everything the device page shows, as of one moment
+#
+# The device page used to open with one request per sensor, each on its own pooled
+# connection and read transaction, so its tables could disagree by whatever ingest
+# committed in between. device_snapshot reads the registry entry, the newest readings
+# of every sensor and the recent batches of a device in one read transaction: in WAL
+# mode all of its queries see the database as of the first one, while ingest goes on.
+
+import datetime
+
+from devices import device_details
+from ingest import API_SENSORS, recent_batches
+from readings import latest_readings
+
+
+def device_snapshot(conn, device_id, limit=100, batch_limit=10):
+    """
+    The registry entry of a device, its newest limit readings of every sensor (by API
+    sensor name, newest first) and its newest batch_limit batch_logs rows, all read
+    in a single transaction. Returns None for an unknown device.
+    """
+    conn.execute('BEGIN')
+    try:
+        details = device_details(conn, device_id)
+        if not details:
+            return None
+        readings = {sensor: latest_readings(conn, table, device_id, limit) for sensor, table in API_SENSORS.items()}
+        batches = recent_batches(conn, device_id, batch_limit)
+    finally:
+        # Nothing was written, this only ends the read transaction
+        conn.rollback()
+
+    device = details[0]
+    sensor_names = {table: sensor for sensor, table in API_SENSORS.items()}
+    device['sensors'] = {sensor_names[table]: info for table, info in device['sensors'].items()}
+    return {
+        'device_id': device_id,
+        'as_of': datetime.datetime.now().isoformat(),
+        'device': device,
+        'readings': readings,
+        'batches': batches,
+    }
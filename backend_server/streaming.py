@@ -0,0 +1,187 @@
+# streaming.py - Incremental parsing of large JSON /api/batch payloads
+#
+# The readings are spooled to a temporary file while the body is read, and written
+# once it has been read whole, in one short transaction: a watch uploading slowly
+# (or stalling) would otherwise hold the SQLite write lock for as long as its upload.
+
+import datetime
+import pickle
+import tempfile
+
+import ijson
+
+import logs
+from dedup import content_hasher
+from ingest import PreparedBatch, INSERT_STATEMENTS, READING_NAMES, BATCH_SECTIONS, reading_row
+
+log = logs.get_logger('streaming')
+
+
+class StreamedBatch(PreparedBatch):
+    """
+    A batch parsed from a stream: its rows are spooled to a temporary file in chunks,
+    only the counts are kept in memory. close() deletes the spool file.
+    """
+
+    def __init__(self):
+        super().__init__('unknown', None)
+        self.counts = {table: 0 for table in INSERT_STATEMENTS}
+        self.content_digest = None
+        self._spool = None
+
+    def count(self, table):
+        return self.counts[table]
+
+    def spool_rows(self, table, rows):
+        if self._spool is None:
+            self._spool = tempfile.TemporaryFile(prefix='streamed-batch-')
+        pickle.dump((table, rows), self._spool, protocol=pickle.HIGHEST_PROTOCOL)
+        self.counts[table] += len(rows)
+
+    def table_rows(self):
+        if self._spool is None:
+            return
+        self._spool.seek(0)
+        while True:
+            try:
+                yield pickle.load(self._spool)
+            except EOFError:
+                return
+
+    def close(self):
+        if self._spool is not None:
+            self._spool.close()
+            self._spool = None
+
+    def __getstate__(self):
+        # Commit notices pass it to other processes with its counts only
+        state = dict(self.__dict__)
+        state['_spool'] = None
+        return state
+
+
+class _HashingReader:
+    """
+    Feeds ijson while hashing the body, so retries of streamed batches can be
+    recognised by content. ijson probes its input with read(0), which
+    werkzeug's LimitedStream takes for a client disconnect; that probe is
+    answered without touching the stream.
+    """
+
+    def __init__(self, stream):
+        self._stream = stream
+        self.hasher = content_hasher()
+
+    def read(self, size=-1):
+        if not size:
+            return b''
+        data = self._stream.read(size)
+        self.hasher.update(data)
+        return data
+
+
+def _is_scalar(event):
+    return event in ('string', 'number', 'boolean', 'null')
+
+
+def spool_streamed_batch(stream, chunk_rows, before_flush=None):
+    """
+    Parse a JSON batch payload from a file-like stream and spool its readings in
+    chunks of at most chunk_rows rows per table. Write the returned batch with
+    write_batch_rows like any other, then close() it.
+
+    Only the reading being parsed and the pending chunks are held in memory,
+    so peak memory does not depend on the payload size. Rows are buffered
+    until device_id has been seen; the watch sends it as the first key, so
+    in practice chunks are flushed as soon as they fill up.
+
+    before_flush(device_id, readings) is called before every chunk is spooled, with
+    the number of readings the batch will then hold, and may raise to stop it. It is
+    also called with 0 readings as soon as device_id has been read, before the readings
+    are parsed.
+
+    Raises ValueError for payloads that cannot be stored. Nothing is left behind
+    when it raises.
+    """
+    batch = StreamedBatch()
+    try:
+        return _parse_into(batch, stream, chunk_rows, before_flush)
+    except BaseException:
+        batch.close()
+        raise
+
+
+def _parse_into(batch, stream, chunk_rows, before_flush):
+    pending = {table: [] for table in INSERT_STATEMENTS}
+    device_key = None
+    section_items = {section + '.item': section for section in BATCH_SECTIONS}
+
+    def flush(table):
+        rows = pending[table]
+        if rows:
+            if before_flush is not None:
+                before_flush(device_key[0], batch.total_records + len(rows))
+            batch.spool_rows(table, [device_key + values for values in rows])
+            pending[table] = []
+
+    reading = None
+    reading_prefix = None
+    reader = _HashingReader(stream)
+    try:
+        events = ijson.parse(reader, use_float=True)
+        prefix, event, value = next(events, ('', None, None))
+        if event != 'start_map':
+            raise ValueError('Batch payload must be a JSON object')
+
+        for prefix, event, value in events:
+            if reading is not None:
+                # Inside a reading: keep its scalar fields, close it on end_map
+                if event == 'end_map' and prefix == reading_prefix:
+                    row = reading_row(section_items[reading_prefix], reading)
+                    reading = None
+                    if row is not None:
+                        table, values = row
+                        pending[table].append(values)
+                        if device_key is not None and len(pending[table]) >= chunk_rows:
+                            flush(table)
+                elif _is_scalar(event) and prefix.startswith(reading_prefix + '.'):
+                    key = prefix[len(reading_prefix) + 1:]
+                    if '.' not in key:
+                        reading[key] = value
+                continue
+
+            if prefix in section_items:
+                if event == 'start_map':
+                    reading = {}
+                    reading_prefix = prefix
+                else:
+                    raise ValueError(f"'{section_items[prefix]}' entries must be objects")
+            elif prefix in BATCH_SECTIONS and event not in ('start_array', 'end_array', 'null'):
+                raise ValueError(f"'{prefix}' must be a list")
+            elif prefix == 'device_id' and _is_scalar(event):
+                batch.device_id = value
+                device_key = (value,)
+                if before_flush is not None:
+                    before_flush(value, batch.total_records)
+                for table in INSERT_STATEMENTS:
+                    if len(pending[table]) >= chunk_rows:
+                        flush(table)
+            elif prefix == 'batch_timestamp' and _is_scalar(event):
+                batch.batch_timestamp = value
+            elif prefix == 'batch_id' and _is_scalar(event):
+                batch.client_batch_id = value
+    except ijson.JSONError as e:
+        raise ValueError(f'Invalid JSON: {str(e)}')
+
+    batch.content_digest = reader.hasher.hexdigest()
+    if device_key is None:
+        device_key = (batch.device_id,)
+    if batch.batch_timestamp is None:
+        batch.batch_timestamp = datetime.datetime.now().isoformat()
+    for table in INSERT_STATEMENTS:
+        flush(table)
+        if batch.counts[table]:
+            log.debug('readings_spooled', device_id=batch.device_id, sensor=READING_NAMES[table],
+                      count=batch.counts[table])
+
+    return batch
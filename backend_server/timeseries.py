@@ -0,0 +1,151 @@
+# timeseries.py - Several sensors of a device aligned to one time grid
+#
+# The grid starts at start_us and has a point every step_us up to end_us. Every value
+# column of every requested sensor becomes one array of grid length:
+#
+#   'mean'  mean of the readings in [t, t + step), None for empty steps. Steps that are
+#           a multiple of a rollup resolution (and start on one) are computed from the
+#           rollups (rollups.py) instead of the readings, unless some readings of the
+#           range are not rolled up yet (rollup_backfill.py)
+#   'asof'  the last reading at or before t, if it is at most tolerance_us older
+#
+# Both are vectorized with numpy (bincount / searchsorted), no per-reading Python work.
+
+import re
+
+import numpy as np
+
+import config
+from partitions import table_partitions
+from readings import readings_between
+from rollup_backfill import rollups_complete
+from rollups import RESOLUTIONS, ROLLUP_FIELDS, ROLLUP_TABLES
+
+METHODS = ('mean', 'asof')
+
+_DURATION = re.compile(r'^(\d+(?:\.\d+)?)(us|ms|s|m|h|d)?$')
+_UNIT_US = {'us': 1, 'ms': 1_000, 's': 1_000_000, 'm': 60_000_000, 'h': 3_600_000_000, 'd': 86_400_000_000}
+
+
+def parse_duration_us(value):
+    """'250ms', '1s', '5m', '1h', ... (plain numbers are seconds) to microseconds."""
+    match = _DURATION.match(value.strip()) if isinstance(value, str) else None
+    if match is None:
+        raise ValueError(f'Invalid duration: {value!r}')
+    number, unit = match.groups()
+    duration = int(float(number) * _UNIT_US[unit or 's'])
+    if duration <= 0:
+        raise ValueError(f'Invalid duration: {value!r}')
+    return duration
+
+
+def _rollup_resolution(start_us, step_us):
+    # Coarsest rollup whose buckets tile the grid steps exactly
+    if config.ROLLUPS != 'on':
+        return None
+    found = None
+    for index, (_, width) in enumerate(RESOLUTIONS):
+        if step_us % width == 0 and start_us % width == 0:
+            found = index
+    return found
+
+
+def _mean_from_rollups(conn, table, device_id, start_us, end_us, step_us, points, index):
+    fields = ROLLUP_FIELDS[table]
+    counts = {field: np.zeros(points) for field in fields}
+    sums = {field: np.zeros(points) for field in fields}
+    for name, _, _ in table_partitions(conn, ROLLUP_TABLES[index], start_us, end_us):
+        rows = conn.execute(
+            f'SELECT ts_us, field, count, sum_value FROM {name} '
+            'WHERE device_id = ? AND sensor = ? AND ts_us >= ? AND ts_us < ?',
+            (device_id, table, start_us, end_us)
+        ).fetchall()
+        if not rows:
+            continue
+        ts_us, row_fields, row_counts, row_sums = zip(*rows)
+        bins = (np.array(ts_us, dtype=np.int64) - start_us) // step_us
+        row_fields = np.array(row_fields)
+        for field in fields:
+            mask = row_fields == field
+            counts[field] += np.bincount(bins[mask], weights=np.array(row_counts, dtype=np.float64)[mask],
+                                         minlength=points)
+            sums[field] += np.bincount(bins[mask], weights=np.array(row_sums, dtype=np.float64)[mask],
+                                       minlength=points)
+    return {field: _divide(sums[field], counts[field]) for field in fields}
+
+
+def _divide(sums, counts):
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(counts > 0, sums / counts, np.nan)
+
+
+def _mean_from_readings(conn, table, device_id, start_us, end_us, step_us, points):
+    ts_us, values = readings_between(conn, table, device_id, start_us, end_us)
+    bins = (ts_us - start_us) // step_us
+    counts = np.bincount(bins, minlength=points).astype(np.float64)
+    return {field: _divide(np.bincount(bins, weights=column, minlength=points), counts)
+            for field, column in values.items()}
+
+
+def _asof(conn, table, device_id, grid, tolerance_us):
+    ts_us, values = readings_between(conn, table, device_id, int(grid[0]) - tolerance_us, int(grid[-1]) + 1)
+    # Index of the last reading at or before every grid point
+    last = np.searchsorted(ts_us, grid, side='right') - 1
+    found = last >= 0
+    found[found] &= grid[found] - ts_us[last[found]] <= tolerance_us
+    return {field: np.where(found, column[np.maximum(last, 0)] if len(column) else np.nan, np.nan)
+            for field, column in values.items()}
+
+
+def _json_values(column):
+    # NaN (no reading) becomes None / null
+    values = column.astype(object)
+    values[np.isnan(column)] = None
+    return values.tolist()
+
+
+def aligned_series(conn, device_id, tables, start_us, end_us, step_us, method='mean', tolerance_us=None):
+    """
+    The value columns of the given sensor tables of a device on the grid
+    start_us, start_us + step_us, ... < end_us.
+
+    Returns (grid as int64 ts_us, {table: {column: float64 values, NaN where missing}},
+    {table: source}), source being the rollup table or 'readings'.
+    """
+    if method not in METHODS:
+        raise ValueError(f"Unknown method '{method}', expected one of {', '.join(METHODS)}")
+    grid = np.arange(start_us, end_us, step_us, dtype=np.int64)
+    points = len(grid)
+    tolerance_us = step_us if tolerance_us is None else tolerance_us
+    end_us = start_us + points * step_us
+
+    channels, sources = {}, {}
+    for table in tables:
+        if method == 'asof':
+            channels[table] = _asof(conn, table, device_id, grid, tolerance_us)
+            sources[table] = 'readings'
+            continue
+        index = _rollup_resolution(start_us, step_us)
+        # Readings without rollups would read as empty steps
+        if index is not None and rollups_complete(conn, device_id, table, start_us, end_us):
+            channels[table] = _mean_from_rollups(conn, table, device_id, start_us, end_us, step_us, points, index)
+            sources[table] = ROLLUP_TABLES[index]
+        else:
+            channels[table] = _mean_from_readings(conn, table, device_id, start_us, end_us, step_us, points)
+            sources[table] = 'readings'
+    return grid, channels, sources
+
+
+def timeseries_response(device_id, sensors, grid, channels, sources, step_us, method):
+    """Columnar JSON body of /api/timeseries, sensors mapping API names to tables."""
+    return {
+        'device_id': device_id,
+        'step_ms': step_us / 1000,
+        'method': method,
+        'ts_us': grid.tolist(),
+        'channels': {
+            sensor: {column: _json_values(values) for column, values in channels[table].items()}
+            for sensor, table in sensors.items()
+        },
+        'sources': {sensor: sources[table] for sensor, table in sensors.items()},
+    }
@@ -0,0 +1,132 @@
+# timestamp_migration.py - Fill the ts_us column of rows stored before integer timestamps
+#
+# The migration is chunked and resumable: every chunk converts up to chunk_rows rows
+# in its own short transaction (so ingest keeps running in between) and records the
+# last converted id per table in timestamp_migration_progress. An interrupted run
+# continues where it stopped. The same transaction widens the first / last seen times
+# of the device registry (devices.py) to the converted readings: it was filled when
+# these rows had no ts_us yet. It adds them to the rollups too (rollups.py), like
+# readings just ingested.
+#
+# It runs in a background thread when the server starts (TIMESTAMP_MIGRATION=background),
+# or by hand:  python timestamp_migration.py [path/to/health_data.db]
+
+import sys
+import threading
+import time
+
+import config
+import db
+from devices import widen_registry
+from migrations import migrate
+from ingest import SENSOR_TABLES
+from rollups import ROLLUP_FIELDS, update_rollups
+from timestamps import parse_timestamp_us
+
+
+def _ensure_progress_table(conn):
+    # Databases that were never opened by the current server lack the column itself
+    migrate(conn)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS timestamp_migration_progress (
+            table_name TEXT PRIMARY KEY,
+            last_id INTEGER NOT NULL,
+            converted INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            done INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    conn.commit()
+
+
+def migrate_table(conn, table, chunk_rows=5000, pause_seconds=0.0):
+    """Convert the timestamps of one table, returns (converted, failed) for this run."""
+    row = conn.execute(
+        'SELECT last_id, done FROM timestamp_migration_progress WHERE table_name = ?', (table,)
+    ).fetchone()
+    if row is not None and row[1]:
+        return 0, 0
+    last_id = row[0] if row is not None else 0
+
+    fields = ROLLUP_FIELDS[table]
+    converted = failed = 0
+    while True:
+        rows = conn.execute(
+            f"SELECT id, device_id, timestamp, {', '.join(fields)} FROM {table} "
+            "WHERE id > ? AND ts_us IS NULL ORDER BY id LIMIT ?",
+            (last_id, chunk_rows)
+        ).fetchall()
+        if not rows:
+            break
+
+        updates = []
+        rolled_up = []
+        bounds = {}
+        for row_id, device_id, timestamp, *values in rows:
+            try:
+                ts_us = parse_timestamp_us(timestamp)
+                updates.append((ts_us, row_id))
+                rolled_up.append((device_id, *values, ts_us))
+                first_us, last_us = bounds.get(device_id, (ts_us, ts_us))
+                bounds[device_id] = (min(first_us, ts_us), max(last_us, ts_us))
+            except ValueError:
+                # Unparseable legacy values keep a NULL ts_us and are skipped
+                failed += 1
+        last_id = rows[-1][0]
+
+        c = conn.cursor()
+        c.execute('BEGIN IMMEDIATE')
+        c.executemany(f'UPDATE {table} SET ts_us = ? WHERE id = ?', updates)
+        widen_registry(c, table, bounds)
+        if config.ROLLUPS == 'on':
+            update_rollups(c, table, rolled_up)
+        c.execute('''
+            INSERT INTO timestamp_migration_progress (table_name, last_id, converted, failed)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT (table_name) DO UPDATE SET
+                last_id = excluded.last_id,
+                converted = converted + excluded.converted,
+                failed = failed + excluded.failed
+        ''', (table, last_id, len(updates), len(rows) - len(updates)))
+        conn.commit()
+        converted += len(updates)
+
+        if pause_seconds:
+            time.sleep(pause_seconds)
+
+    # Rows inserted from now on carry ts_us already, so the table is finished
+    conn.execute('''
+        INSERT INTO timestamp_migration_progress (table_name, last_id, done) VALUES (?, ?, 1)
+        ON CONFLICT (table_name) DO UPDATE SET done = 1
+    ''', (table, last_id))
+    conn.commit()
+    return converted, failed
+
+
+def migrate_timestamps(path=None, chunk_rows=5000, pause_seconds=0.0):
+    conn = db.connect(path)
+    try:
+        _ensure_progress_table(conn)
+        for table in SENSOR_TABLES:
+            converted, failed = migrate_table(conn, table, chunk_rows, pause_seconds)
+            if converted or failed:
+                print(f"Timestamp migration: {table}: {converted} rows converted, {failed} unparseable")
+    finally:
+        conn.close()
+
+
+def start_background_migration():
+    """Run the migration next to the server, yielding to ingest between chunks."""
+    thread = threading.Thread(
+        target=migrate_timestamps,
+        kwargs={'chunk_rows': config.TIMESTAMP_MIGRATION_CHUNK_ROWS, 'pause_seconds': 0.01},
+        name='timestamp-migration',
+        daemon=True
+    )
+    thread.start()
+    return thread
+
+
+if __name__ == '__main__':
+    migrate_timestamps(sys.argv[1] if len(sys.argv) > 1 else None)
+    print("Timestamp migration finished")
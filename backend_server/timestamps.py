@@ -0,0 +1,48 @@
+# timestamps.py - Conversion of reading timestamps to INTEGER epoch microseconds
+
+import datetime
+import functools
+import re
+
+# 'yyyy-MM-ddTHH:mm:ss' optionally followed by a fraction, the format sent by the watch
+_WATCH_FORMAT = re.compile(r'^(\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}:\d{2})(?:\.(\d{1,6}))?$')
+
+_EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+@functools.lru_cache(maxsize=4096)
+def _local_second_to_epoch(second):
+    # Readings of one batch share a handful of distinct seconds, so the
+    # (comparatively slow) local time conversion is cached per second
+    return int(datetime.datetime.fromisoformat(second).timestamp())
+
+
+def parse_timestamp_us(value):
+    """
+    Convert an ISO 8601 timestamp to epoch microseconds.
+
+    Timestamps without a UTC offset (what the watch sends) are wall-clock
+    time of the server's timezone. Raises ValueError for anything else.
+    """
+    if not isinstance(value, str):
+        raise ValueError(f'Invalid timestamp: {value!r}')
+
+    match = _WATCH_FORMAT.match(value)
+    if match:
+        second, fraction = match.groups()
+        micros = int(fraction.ljust(6, '0')) if fraction else 0
+        return _local_second_to_epoch(second) * 1_000_000 + micros
+
+    try:
+        parsed = datetime.datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        raise ValueError(f'Invalid timestamp: {value!r}')
+    if parsed.tzinfo is None:
+        return int(parsed.replace(microsecond=0).timestamp()) * 1_000_000 + parsed.microsecond
+    return (parsed - _EPOCH) // datetime.timedelta(microseconds=1)
+
+
+def format_timestamp_us(ts_us):
+    """Render epoch microseconds as a local ISO string, like the watch timestamps."""
+    local = datetime.datetime.fromtimestamp(ts_us // 1_000_000) + datetime.timedelta(microseconds=ts_us % 1_000_000)
+    return local.isoformat(timespec='milliseconds')
@@ -0,0 +1,106 @@
+# stream_client.py - Stands in for a watch streaming over the /api/stream WebSocket
+#
+# Sends a frame of synthetic readings every --interval seconds over one persistent
+# connection, waits for the server's ack of each frame and prints the ack latency.
+#
+# Usage (from backend_server/):
+#   python tools/stream_client.py [--url ws://localhost:5000/api/stream] [--device-id test-watch]
+#                                 [--interval 1.0] [--frames 0] [--motion-hz 50] [--columnar]
+
+import argparse
+import json
+import math
+import os
+import random
+import sys
+import time
+
+import simple_websocket
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from columnar import encode_columnar_batch  # noqa: E402
+
+
+def iso(epoch_ms):
+    # Same local 'yyyy-MM-ddTHH:mm:ss.SSS' format as the watch
+    return time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(epoch_ms / 1000)) + f'.{int(epoch_ms) % 1000:03d}'
+
+
+def sample_times(start_ms, interval_s, hz):
+    count = max(1, int(round(interval_s * hz)))
+    return [start_ms + int(i * 1000 / hz) for i in range(count)]
+
+
+def json_frame(seq, start_ms, interval_s, motion_hz):
+    hr_times = sample_times(start_ms, interval_s, 1)
+    motion_times = sample_times(start_ms, interval_s, motion_hz)
+    return json.dumps({
+        'seq': seq,
+        'heart_rate_data': [{'heart_rate': random.randint(60, 90), 'timestamp': iso(t)} for t in hr_times],
+        'health_data': [{'data_type': 'ppg', 'value': random.randint(0, 4096), 'timestamp': iso(t)}
+                        for t in sample_times(start_ms, interval_s, 25)],
+        'motion_data': [
+            {'data_type': sensor, 'x_value': math.sin(t / 500), 'y_value': math.cos(t / 500),
+             'z_value': 9.81 + random.gauss(0, 0.05), 'timestamp': iso(t)}
+            for sensor in ('accelerometer', 'gyroscope') for t in motion_times
+        ]
+    })
+
+
+def columnar_frame(device_id, seq, start_ms, interval_s, motion_hz):
+    hr_times = sample_times(start_ms, interval_s, 1)
+    motion_times = sample_times(start_ms, interval_s, motion_hz)
+    motion = (motion_times, [math.sin(t / 500) for t in motion_times],
+              [math.cos(t / 500) for t in motion_times], [9.81] * len(motion_times))
+    return encode_columnar_batch(device_id, iso(start_ms), {
+        'heartrates': (hr_times, [random.randint(60, 90) for _ in hr_times]),
+        'accelerometer': motion,
+        'gyroscope': motion,
+    }, batch_id=f'{device_id}-{seq}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Stream synthetic watch readings over /api/stream')
+    parser.add_argument('--url', default='ws://localhost:5000/api/stream')
+    parser.add_argument('--device-id', default='test-watch')
+    parser.add_argument('--interval', type=float, default=1.0, help='seconds of readings per frame')
+    parser.add_argument('--frames', type=int, default=0, help='frames to send, 0 streams until interrupted')
+    parser.add_argument('--motion-hz', type=float, default=50)
+    parser.add_argument('--columnar', action='store_true', help='send binary columnar frames instead of JSON')
+    args = parser.parse_args()
+
+    ws = simple_websocket.Client.connect(f'{args.url}?device_id={args.device_id}')
+    latencies = []
+    seq = 0
+    try:
+        while args.frames == 0 or seq < args.frames:
+            seq += 1
+            start_ms = int(time.time() * 1000)
+            if args.columnar:
+                frame = columnar_frame(args.device_id, seq, start_ms, args.interval, args.motion_hz)
+            else:
+                frame = json_frame(seq, start_ms, args.interval, args.motion_hz)
+
+            sent = time.perf_counter()
+            ws.send(frame)
+            ack = json.loads(ws.receive())
+            latencies.append(time.perf_counter() - sent)
+
+            records = ack.get('summary', {}).get('total_records', 0)
+            print(f"frame {ack['seq']}: {ack['status']} {records} records, "
+                  f"ack after {latencies[-1] * 1000:.1f} ms{'  ' + ack['error'] if 'error' in ack else ''}")
+            time.sleep(max(0.0, args.interval - (time.perf_counter() - sent)))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        ws.close()
+
+    if latencies:
+        latencies.sort()
+        print(f"{len(latencies)} frames, ack latency p50 {latencies[len(latencies) // 2] * 1000:.1f} ms, "
+              f"max {latencies[-1] * 1000:.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
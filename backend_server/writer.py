@@ -0,0 +1,480 @@
+# writer.py - Single writer process for multi-worker deployments (INGEST_MODE=writer)
+#
+# SQLite has one write lock per database. Worker processes each committing their own
+# batches take turns on it through busy_timeout, and under load they start failing with
+# 'database is locked'. In writer mode the workers parse and validate what they receive
+# and send it over a Unix socket (multiprocessing.connection) to this process, which
+# makes every write:
+#   batches          committed through one IngestQueue, so the batches of every worker
+#                    share group commits instead of competing for the lock
+#   streamed batches spooled by the worker, then sent here a chunk at a time after
+#                    the batch and spooled again, before going through the same queue
+#   single readings  (/api/heartrate, ...) queued as a batch of their own, not logged in
+#                    batch_logs, so every write goes through the queue's connection
+# Reads stay in the workers.
+#
+# A batch not written within COMMIT_WAIT_SHARE of WRITER_TIMEOUT_S is answered 503
+# (writer_timeout) before the worker gives up on the writer. It stays queued and may
+# still be committed: the device retries it with the same Idempotency-Key, and gets
+# 'duplicate' if it was.
+#
+# Every worker also subscribes to commit notices: the writes made here are passed on to
+# the other workers, which invalidate their response cache and feed their live feed. The
+# readings of a batch are only sent to the workers with live feed subscribers for its
+# device, the others get its counts: unpickling every batch in every worker cost more
+# than the commits themselves.
+#
+# The workers also send their metrics here every METRICS_PUSH_INTERVAL_S, and the worker
+# answering a scrape of /metrics gets those of every process from here (see metrics.py).
+#
+# Admission control (admission.py) runs here too, so the rate limits of a device hold
+# whichever worker its batches reach: the workers ask the writer to admit the chunks of
+# their streamed batches while reading them, and for the ingest stats.
+#
+# gunicorn.conf.py starts this process before the workers, with a random
+# WRITER_AUTHKEY; with another server run
+#   WRITER_AUTHKEY=<secret> python writer.py
+# next to it, with the same environment (and key).
+
+import os
+import pickle
+import queue
+import signal
+import sys
+import threading
+import time
+from multiprocessing.connection import AuthenticationError, Client, Listener
+
+import config
+import db
+import logs
+import metrics
+from admission import AdmissionControl, AdmissionRejected, ingest_stats
+from ingest import STORAGE_TABLES, DeviceQueueFull, IngestQueue, readings_batch
+from migrations import migrate
+from partitions import prepare_partitions, start_maintenance
+from streaming import StreamedBatch
+from rollup_backfill import start_rollup_backfill
+from timestamp_migration import start_background_migration
+
+log = logs.get_logger('writer')
+
+# Share of WRITER_TIMEOUT_S the writer waits for a batch to be written, so that the
+# worker gets its answer before it stops waiting for one
+COMMIT_WAIT_SHARE = 0.8
+
+
+class WriterUnavailable(Exception):
+    """The writer process cannot be reached, or did not answer in time."""
+
+
+class WriterServer:
+    """Commits the batches sent by the workers and passes commit notices between them."""
+
+    def __init__(self, address=None, authkey=None, db_path=None):
+        self.address = address or config.WRITER_ADDRESS
+        self.authkey = _authkey(authkey)
+        self.db_path = db_path or config.DATABASE_PATH
+        self.ingest_queue = IngestQueue(
+            self.db_path,
+            maxsize=config.INGEST_QUEUE_SIZE,
+            flush_interval_ms=config.INGEST_FLUSH_INTERVAL_MS,
+            max_group_size=config.INGEST_MAX_GROUP_SIZE,
+            on_drop=lambda batch: self._finished(batch, False),
+            on_commit=lambda batch: self._finished(batch, True),
+            # The worker finds the batch committed first in batch_logs and answers duplicate
+            on_duplicate=lambda batch: self._finished(batch, False),
+            device_maxsize=config.INGEST_DEVICE_QUEUE_SIZE,
+            max_group_rows=config.INGEST_MAX_GROUP_ROWS
+        )
+        self.admission = AdmissionControl(
+            config.INGEST_DEVICE_ROWS_PER_S, config.INGEST_DEVICE_BURST_ROWS, config.INGEST_MAX_BATCH_ROWS)
+        # id(batch) -> [event set once written, whether it was committed, and for a batch
+        # _store gave up waiting for, the commit notice _finished passes on]
+        self._pending = {}
+        # Worker pid -> queue of pickled notices sent to it, and the devices it has live
+        # feed subscribers for
+        self._subscribers = {}
+        self._watched = {}
+        # Worker pid -> (time received, metrics collected in it), see _metrics
+        self._worker_metrics = {}
+        self._lock = threading.Lock()
+
+    def serve_forever(self):
+        # A socket left behind by a writer that was killed would make bind fail
+        if os.path.exists(self.address):
+            os.unlink(self.address)
+        # Only this user may connect, the authentication key being the second guard
+        umask = os.umask(0o177)
+        try:
+            listener = Listener(self.address, 'AF_UNIX', authkey=self.authkey)
+        finally:
+            os.umask(umask)
+        with listener:
+            log.info('writer_ready', address=self.address)
+            while True:
+                try:
+                    conn = listener.accept()
+                except (AuthenticationError, OSError) as e:
+                    log.warning('writer_connection_refused', error=str(e))
+                    continue
+                threading.Thread(target=self._serve, args=(conn,), name='writer-connection', daemon=True).start()
+
+    def _serve(self, conn):
+        # A worker connection carries one request at a time
+        try:
+            while True:
+                message = conn.recv()
+                if message[0] == 'subscribe':
+                    self._feed(conn, message[1], message[2])
+                    return
+                if message[0] == 'batch':
+                    reply = self._store(message[1], message[2])
+                elif message[0] == 'stream':
+                    reply = self._store_stream(conn, message[1], message[2])
+                elif message[0] == 'readings':
+                    reply = self._store_readings(*message[1:])
+                elif message[0] == 'admission':
+                    reply = self._admission(message[1], message[2])
+                elif message[0] == 'metrics':
+                    reply = self._metrics(*message[1:])
+                else:
+                    with self._lock:
+                        self._watched[message[1]] = message[2]
+                    reply = ('ok', None)
+                conn.send(reply)
+        except (EOFError, OSError):
+            pass
+        finally:
+            conn.close()
+
+    def _store(self, batch, pid, streamed=False, notice=None):
+        # The commit notice passed on to the other workers, with the device it is about
+        # when the readings only go to the workers watching it
+        notice = notice or (('batch', batch), batch.device_id)
+        try:
+            if streamed:
+                # Its chunks were admitted while the worker read it, it is charged now
+                self.admission.charge(batch.device_id, batch.total_records)
+            else:
+                self.admission.admit(batch.device_id, batch.total_records)
+        except AdmissionRejected as e:
+            return ('rejected', _rejection(e))
+        done = threading.Event()
+        with self._lock:
+            self._pending[id(batch)] = [done, False, None]
+        try:
+            self.ingest_queue.submit(batch)
+        except queue.Full as e:
+            with self._lock:
+                del self._pending[id(batch)]
+            return ('rejected', _rejection(self.admission.queue_full(
+                batch.device_id, batch.total_records, isinstance(e, DeviceQueueFull), config.INGEST_RETRY_AFTER_S)))
+        done.wait(config.WRITER_TIMEOUT_S * COMMIT_WAIT_SHARE)
+        with self._lock:
+            # Checked under the lock, _finished sets it under the lock too
+            if not done.is_set():
+                self._pending[id(batch)][2] = notice
+                waited = True
+            else:
+                _, committed, _ = self._pending.pop(id(batch))
+                waited = False
+        if waited:
+            log.warning('writer_commit_timeout', device_id=batch.device_id, total_records=batch.total_records,
+                        queue_depth=self.ingest_queue.depth())
+            return ('rejected', (503, 'writer_timeout',
+                                 'Not committed in time, it may still be stored: a batch retried with the same '
+                                 'Idempotency-Key is answered as a duplicate if it was', config.INGEST_RETRY_AFTER_S))
+        if not committed:
+            return ('error', 'Batch could not be committed')
+        self._broadcast(pid, *notice)
+        return ('stored', batch.summary())
+
+    def _store_stream(self, conn, batch, pid):
+        # The batch came with its counts only, its rows follow until ('end',)
+        batch.counts = dict.fromkeys(batch.counts, 0)
+        try:
+            while True:
+                message = conn.recv()
+                if message[0] == 'end':
+                    break
+                batch.spool_rows(message[1], message[2])
+            return self._store(batch, pid, streamed=True)
+        finally:
+            # A batch still queued when _store gave up waiting is closed by _finished
+            with self._lock:
+                queued = id(batch) in self._pending
+            if not queued:
+                batch.close()
+
+    def _store_readings(self, table, rows, pid):
+        # Through the queue like a batch, but passed on as readings to every worker
+        batch = readings_batch(table, rows)
+        return self._store(batch, pid, notice=(('readings', batch.device_id, table, rows), None))
+
+    def _admission(self, call, args):
+        # The admission control calls the workers make for streamed batches
+        try:
+            if call == 'admit_stream':
+                self.admission.admit_stream(*args)
+            else:
+                return ('ok', ingest_stats(self.admission, self.ingest_queue))
+        except AdmissionRejected as e:
+            return ('rejected', _rejection(e))
+        return ('ok', None)
+
+    def _metrics(self, pid, collected, scrape):
+        # Workers that stopped sending theirs are gone: their series end
+        now = time.monotonic()
+        with self._lock:
+            self._worker_metrics[pid] = (now, collected)
+            for other, (received, _) in list(self._worker_metrics.items()):
+                if received < now - 3 * config.METRICS_PUSH_INTERVAL_S:
+                    del self._worker_metrics[other]
+            workers = sorted(self._worker_metrics.items())
+        if not scrape:
+            return ('ok', None)
+        return ('ok', [('writer', metrics.REGISTRY.collect())] + [(str(worker), collected)
+                                                                 for worker, (_, collected) in workers])
+
+    def _finished(self, batch, committed):
+        with self._lock:
+            entry = self._pending[id(batch)]
+            entry[1] = committed
+            entry[0].set()
+            late_notice = entry[2]
+            if late_notice is not None:
+                del self._pending[id(batch)]
+        if late_notice is None:
+            return
+        # Written after _store answered writer_timeout: every worker is told, the one
+        # that sent it too
+        log.warning('late_batch_written', device_id=batch.device_id, committed=committed)
+        if committed:
+            self._broadcast(None, *late_notice)
+        if isinstance(batch, StreamedBatch):
+            batch.close()
+
+    def _feed(self, conn, pid, watched):
+        notices = queue.Queue(maxsize=config.WRITER_NOTICE_QUEUE_SIZE)
+        with self._lock:
+            self._subscribers[pid] = notices
+            self._watched[pid] = watched
+        try:
+            while True:
+                conn.send_bytes(notices.get())
+        finally:
+            with self._lock:
+                if self._subscribers.get(pid) is notices:
+                    del self._subscribers[pid]
+                    self._watched.pop(pid, None)
+
+    def _broadcast(self, origin_pid, notice, device_id=None):
+        """
+        Pass a notice to every worker but the one that made the write. For a batch
+        (device_id given), workers not watching the device get its counts only.
+        """
+        with self._lock:
+            targets = [(pid, notices, device_id is None or device_id in self._watched.get(pid, ()))
+                       for pid, notices in self._subscribers.items() if pid != origin_pid]
+        # Pickled once for all the workers getting the same notice
+        payloads = {}
+        for pid, notices, full in targets:
+            if full not in payloads:
+                payloads[full] = pickle.dumps(notice if full else ('batch', _counts_only(notice[1])),
+                                              protocol=pickle.HIGHEST_PROTOCOL)
+            try:
+                notices.put_nowait(payloads[full])
+            except queue.Full:
+                # Its cached responses stay stale for at most RESPONSE_CACHE_TTL_S
+                log.warning('commit_notice_dropped', worker_pid=pid)
+
+
+def _authkey(authkey):
+    authkey = authkey or config.WRITER_AUTHKEY
+    if not authkey:
+        raise RuntimeError('WRITER_AUTHKEY is not set: give the writer and the workers the same secret key')
+    return authkey
+
+
+def _rejection(error):
+    return (error.status, error.reason, str(error), error.retry_after_s)
+
+
+def _counts_only(batch):
+    # Like a streamed batch: live feed subscribers reload the sensors instead
+    counts = StreamedBatch()
+    counts.device_id = batch.device_id
+    counts.counts = {table: batch.count(table) for table in counts.counts}
+    return counts
+
+
+class WriterClient:
+    """The connections of a worker process to the writer, one request in flight on each."""
+
+    def __init__(self, address=None, authkey=None, timeout_s=None):
+        self.address = address or config.WRITER_ADDRESS
+        self.authkey = _authkey(authkey)
+        self.timeout_s = config.WRITER_TIMEOUT_S if timeout_s is None else timeout_s
+        self._idle = []
+        self._watched = frozenset()
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        # The writer may still be starting (or restarting), give it the timeout
+        deadline = time.monotonic() + self.timeout_s
+        while True:
+            try:
+                return Client(self.address, 'AF_UNIX', authkey=self.authkey)
+            except (OSError, EOFError) as e:
+                if time.monotonic() >= deadline:
+                    raise WriterUnavailable(f'Cannot connect to the writer: {str(e)}')
+                time.sleep(0.1)
+
+    def _request(self, message, chunks=None):
+        with self._lock:
+            conn = self._idle.pop() if self._idle else None
+        if conn is None:
+            conn = self._connect()
+        try:
+            conn.send(message)
+            if chunks is not None:
+                for table, rows in chunks:
+                    conn.send(('chunk', table, rows))
+                conn.send(('end',))
+            if not conn.poll(self.timeout_s):
+                raise WriterUnavailable('The writer did not answer in time')
+            reply = conn.recv()
+        except (EOFError, OSError, WriterUnavailable) as e:
+            conn.close()
+            if isinstance(e, WriterUnavailable):
+                raise
+            raise WriterUnavailable(f'Lost the connection to the writer: {str(e)}')
+        with self._lock:
+            self._idle.append(conn)
+        return reply
+
+    def submit(self, batch):
+        """
+        Have the writer commit a prepared batch and return its summary. Raises
+        AdmissionRejected when the writer refused it (rate limited, too large, queue full)
+        and RuntimeError when the batch was not committed. The rows of a streamed batch
+        are sent after it, a chunk of its spool file at a time.
+        """
+        if isinstance(batch, StreamedBatch):
+            status, payload = self._request(('stream', batch, os.getpid()), chunks=batch.table_rows())
+        else:
+            status, payload = self._request(('batch', batch, os.getpid()))
+        if status == 'rejected':
+            raise AdmissionRejected(*payload)
+        if status == 'error':
+            raise RuntimeError(payload)
+        return payload
+
+    def admission(self, call, *args):
+        """Call the writer's admission control (see RemoteAdmission)."""
+        status, payload = self._request(('admission', call, args))
+        if status == 'rejected':
+            raise AdmissionRejected(*payload)
+        return payload
+
+    def store_readings(self, table, rows):
+        """
+        Have the writer admit and commit readings of a single-reading endpoint. Raises
+        AdmissionRejected when it refused them and RuntimeError when they were not committed.
+        """
+        status, payload = self._request(('readings', table, rows, os.getpid()))
+        if status == 'rejected':
+            raise AdmissionRejected(*payload)
+        if status == 'error':
+            raise RuntimeError(payload)
+
+    def metrics(self, collected):
+        """The metrics of every process, [(worker, collected)], this one's being collected."""
+        return self._request(('metrics', os.getpid(), collected, True))[1]
+
+    def share_metrics(self, collect):
+        """Send collect() to the writer every METRICS_PUSH_INTERVAL_S, from a background thread."""
+        def loop():
+            while True:
+                time.sleep(config.METRICS_PUSH_INTERVAL_S)
+                try:
+                    self._request(('metrics', os.getpid(), collect(), False))
+                except WriterUnavailable as e:
+                    log.debug('metrics_not_shared', error=str(e))
+
+        thread = threading.Thread(target=loop, name='writer-metrics', daemon=True)
+        thread.start()
+        return thread
+
+    def watch(self, device_ids):
+        """Ask for the readings of the batches of these devices, not only their counts."""
+        self._watched = frozenset(device_ids)
+        self._request(('watch', os.getpid(), self._watched))
+
+    def subscribe(self, callback):
+        """Call callback(notice) for the writes of the other workers, from a background thread."""
+        def loop():
+            while True:
+                try:
+                    conn = self._connect()
+                    conn.send(('subscribe', os.getpid(), self._watched))
+                    while True:
+                        callback(conn.recv())
+                except Exception as e:
+                    log.warning('writer_subscription_lost', error=str(e))
+                    time.sleep(1)
+
+        thread = threading.Thread(target=loop, name='writer-notices', daemon=True)
+        thread.start()
+        return thread
+
+
+class RemoteAdmission:
+    """The AdmissionControl of the writer, as used by the workers while streaming batches and for the stats."""
+
+    def __init__(self, client):
+        self.client = client
+
+    def admit_stream(self, device_id, rows):
+        self.client.admission('admit_stream', device_id, rows)
+
+    def stats(self):
+        """The writer's ingest_stats(): admission and write-behind queue."""
+        return self.client.admission('stats')
+
+
+def main():
+    logs.configure()
+    conn = db.connect()
+    try:
+        migrate(conn)
+    finally:
+        conn.close()
+    prepare_partitions(STORAGE_TABLES)
+
+    # Background writes of the server run here, next to ingest, not in every worker
+    if config.TIMESTAMP_MIGRATION == 'background':
+        start_background_migration()
+    start_rollup_backfill()
+    start_maintenance(STORAGE_TABLES)
+
+    # Exit cleanly on SIGTERM: the batches still queued are committed first
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    server = WriterServer()
+    # Gauges of the ingest done here, the workers leave them out
+    metrics.REGISTRY.register(metrics.Gauge(
+        'ingest_queue_depth', 'Batches waiting for the writer thread.', server.ingest_queue.depth))
+    metrics.REGISTRY.register(metrics.Gauge(
+        'ingest_throttled_devices', 'Devices rejected by admission control recently, or over their rate.',
+        lambda: len(server.admission.stats()['throttled_devices'])))
+    try:
+        server.serve_forever()
+    finally:
+        server.ingest_queue.stop()
+        if os.path.exists(server.address):
+            os.unlink(server.address)
+
+
+if __name__ == '__main__':
+    main()
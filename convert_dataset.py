@@ -2,24 +2,115 @@ import sqlite3
 import numpy as np
 import pandas as pd
 from datetime import datetime, timedelta
+from dateutil import tz
 import os
 
-def load_accelerometer_data(db_path):
-    """Load accelerometer data from SQLite database."""
-    conn = sqlite3.connect(db_path)
-    
-    # Load accelerometer data, sorted by timestamp
-    query = """
-    SELECT id, x_value, y_value, z_value, timestamp 
-    FROM accelerometer 
-    ORDER BY timestamp
+def _to_epoch_us(value):
+    # Local wall-clock time (like the watch timestamps) to epoch microseconds
+    return pd.Timestamp(value).tz_localize(tz.tzlocal()).value // 1000
+
+def partition_tables(conn, table, start_us=None, end_us=None):
+    """
+    Tables holding readings of table between start_us and end_us: the legacy table
+    plus the time partitions of the server (see backend_server/partitions.py)
+    overlapping the range.
+    """
+    existing = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+    tables = [table] if table in existing else []
+    if 'sensor_partitions' in existing:
+        query = "SELECT name FROM sensor_partitions WHERE base_table = ?"
+        params = [table]
+        if start_us is not None:
+            query += " AND end_us > ?"
+            params.append(start_us)
+        if end_us is not None:
+            query += " AND start_us < ?"
+            params.append(end_us)
+        tables += [row[0] for row in conn.execute(query + " ORDER BY start_us", params)]
+    return tables
+
+def load_accelerometer_chunks(conn, start_us=None, end_us=None):
+    """
+    Accelerometer readings the server stored as chunks (CHUNKED_STORAGE=on), decoded
+    with numpy. Layout of a chunk: int32 timestamp deltas from first_us, then float32
+    x, y and z columns (see backend_server/chunks.py).
+    """
+    conditions = []
+    params = []
+    if start_us is not None:
+        conditions.append("last_us >= ?")
+        params.append(start_us)
+    if end_us is not None:
+        conditions.append("first_us < ?")
+        params.append(end_us)
+    where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+    
+    ts_parts, axes_parts = [], []
+    for table in partition_tables(conn, 'accelerometer_chunks', start_us, end_us):
+        for first_us, count, data in conn.execute(f"SELECT first_us, count, data FROM {table}{where}", params):
+            ts_parts.append(first_us + np.cumsum(np.frombuffer(data, dtype='<i4', count=count), dtype=np.int64))
+            axes_parts.append(np.frombuffer(data, dtype='<f4', count=3 * count, offset=4 * count).reshape(3, count))
+    
+    if not ts_parts:
+        return pd.DataFrame(columns=['id', 'x_value', 'y_value', 'z_value', 'ts_us', 'timestamp'])
+    ts_us = np.concatenate(ts_parts)
+    axes = np.concatenate(axes_parts, axis=1).astype(np.float64)
+    df = pd.DataFrame({'id': None, 'x_value': axes[0], 'y_value': axes[1], 'z_value': axes[2],
+                       'ts_us': ts_us, 'timestamp': None})
+    if start_us is not None:
+        df = df[df['ts_us'] >= start_us]
+    if end_us is not None:
+        df = df[df['ts_us'] < end_us]
+    return df
+
+def load_accelerometer_data(db_path, start=None, end=None):
     """
+    Load accelerometer data from SQLite database.
     
-    df = pd.read_sql_query(query, conn)
+    Args:
+        db_path: Path to the server database
+        start, end: Optional local time range [start, end) to load, e.g. '2025-01-06 08:00';
+                    only the partitions overlapping it are read
+    """
+    conn = sqlite3.connect(db_path)
+    start_us = _to_epoch_us(start) if start is not None else None
+    end_us = _to_epoch_us(end) if end is not None else None
+    
+    conditions = []
+    params = []
+    if start_us is not None:
+        conditions.append("ts_us >= ?")
+        params.append(start_us)
+    if end_us is not None:
+        conditions.append("ts_us < ?")
+        params.append(end_us)
+    where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+    
+    # Load accelerometer data of every overlapping partition, sorted by its integer
+    # epoch-microsecond timestamp
+    frames = [
+        pd.read_sql_query(
+            f"SELECT id, x_value, y_value, z_value, ts_us, timestamp FROM {table}{where} ORDER BY ts_us",
+            conn, params=params
+        )
+        for table in partition_tables(conn, 'accelerometer', start_us, end_us)
+    ]
+    frames.append(load_accelerometer_chunks(conn, start_us, end_us))
+    df = pd.concat(frames, ignore_index=True)
     conn.close()
     
-    # Convert timestamp to datetime
-    df['timestamp'] = pd.to_datetime(df['timestamp'])
+    # Convert epoch microseconds to local wall-clock time, the same clock the watch
+    # timestamps (and the labeling rules) use
+    timestamps = pd.to_datetime(df['ts_us'], unit='us', utc=True).dt.tz_convert(tz.tzlocal()).dt.tz_localize(None)
+    
+    # Rows the server has not migrated to ts_us yet still need their ISO string parsed
+    missing = df['ts_us'].isna()
+    if missing.any():
+        timestamps[missing] = pd.to_datetime(df.loc[missing, 'timestamp'])
+        print(f"Parsed {missing.sum()} timestamps not yet migrated to ts_us")
+    
+    df['timestamp'] = timestamps
+    df = df.drop(columns=['ts_us']).sort_values('timestamp', kind='stable').reset_index(drop=True)
     
     print(f"Loaded {len(df)} accelerometer samples")
     print(f"Time range: {df['timestamp'].min()} to {df['timestamp'].max()}")